@@ -65,11 +65,28 @@ class cmd_git_serve(Command):
     takes_options = [
         Option('directory',
                help='serve contents of directory',
-               type=unicode)
+               type=unicode),
+        Option('port',
+               help='listen on this port instead of the default git port',
+               type=int),
+        Option('mode',
+               help='how to serve concurrent connections: '
+                    'single, thread, fork or async (default: thread)',
+               type=str),
+        Option('max-connections',
+               help='maximum number of connections served at the same time',
+               type=int),
+        Option('timeout',
+               help='drop connections that are idle for this many seconds',
+               type=float),
     ]
 
-    def run(self, directory=None):
-        from dulwich.server import TCPGitServer
+    def run(self, directory=None, port=None, mode=None, max_connections=None,
+            timeout=None):
+        from dulwich.server import (DEFAULT_MAX_CONNECTIONS, make_server,
+            server_modes)
+        from dulwich.protocol import TCP_GIT_PORT
+        from bzrlib.errors import BzrCommandError
         from bzrlib.plugins.git.server import BzrBackend
         from bzrlib.trace import warning
         import os
@@ -78,11 +95,25 @@ class cmd_git_serve(Command):
 
         if directory is None:
             directory = os.getcwd()
+        if port is None:
+            port = TCP_GIT_PORT
+        if mode is None:
+            mode = "thread"
+        if mode not in server_modes:
+            raise BzrCommandError("Unknown server mode %r; use one of: %s" % 
+                (mode, ", ".join(sorted(server_modes))))
+        if max_connections is None:
+            max_connections = DEFAULT_MAX_CONNECTIONS
 
         backend = BzrBackend(directory)
 
-        server = TCPGitServer(backend, 'localhost')
-        server.serve_forever()
+        server = make_server(backend, 'localhost', port, mode, 
+                             connection_timeout=timeout,
+                             max_connections=max_connections)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
 
 register_command(cmd_git_serve)
 
@@ -93,11 +124,16 @@ class cmd_git_import(Command):
     """
 
     takes_args = ["src_location", "dest_location"]
+    takes_options = [
+        Option('workers',
+               help='number of processes to convert commits in',
+               type=int),
+    ]
 
-    def run(self, src_location, dest_location):
+    def run(self, src_location, dest_location, workers=None):
         from bzrlib.bzrdir import BzrDir, format_registry
         from bzrlib.errors import NoRepositoryPresent, NotBranchError
-        from bzrlib.repository import Repository
+        from bzrlib.repository import InterRepository, Repository
         source_repo = Repository.open(src_location)
         format = format_registry.make_bzrdir('rich-root-pack')
         try:
@@ -109,7 +145,7 @@ class cmd_git_import(Command):
         except NoRepositoryPresent:
             target_repo = target_bzrdir.create_repository(shared=True)
 
-        target_repo.fetch(source_repo)
+        InterRepository.get(source_repo, target_repo).fetch(workers=workers)
         for name, ref in source_repo._git.heads().iteritems():
             head_loc = os.path.join(dest_location, name)
             try:
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# bench_fetch.py -- Benchmark fetching between local repositories
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Measure the time taken to fetch all history into an empty repository.
+
+Repo.fetch, which copies the stored objects from the packs of the source
+into a new pack, is compared with the path a fetch over the git protocol
+takes: the objects are inflated, compressed into a new pack by the
+server and inflated again by the client to index it.
+
+The source is the git repository given on the command line, which should
+be packed with git gc to have deltas, or a generated repository of
+NUM_COMMITS commits that each change one of NUM_FILES files.
+
+Run from the top of the dulwich tree:
+
+    PYTHONPATH=. python benchmarks/bench_fetch.py [REPOSITORY]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from dulwich.client import SkippingFetchGraphWalker
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.pack import write_pack_data
+from dulwich.repo import Repo
+
+NUM_COMMITS = 500
+NUM_FILES = 50
+
+
+def make_repo(path):
+    os.mkdir(path)
+    Repo.init_bare(path)
+    repo = Repo(path)
+    texts = ["%d\n" % i * 100 for i in range(NUM_FILES)]
+    objects = []
+    parents = []
+    for i in range(NUM_COMMITS):
+        texts[i % NUM_FILES] += "commit %d\n" % i
+        tree = Tree()
+        for j, text in enumerate(texts):
+            blob = Blob.from_string(text)
+            objects.append(blob)
+            tree.add(0100644, "file%d" % j, blob.id)
+        tree.serialize()
+        objects.append(tree)
+        commit = Commit()
+        commit._tree = tree.id
+        commit._parents = parents
+        commit._author = commit._committer = "Joe Foo <joe@foo.com>"
+        commit._commit_time = 1234567890 + i
+        commit._message = "commit %d\n" % i
+        commit.serialize()
+        objects.append(commit)
+        parents = [commit.id]
+    repo.object_store.add_objects(objects)
+    repo.set_ref("refs/heads/master", parents[0])
+    return Repo(path)
+
+
+def make_target(path):
+    os.mkdir(path)
+    Repo.init_bare(path)
+    return Repo(path)
+
+
+def protocol_fetch(source, target):
+    """Fetch the way it is done over the git protocol."""
+    graph_walker = SkippingFetchGraphWalker(target.heads().values(),
+        target.get_parents, target.get_commit_time)
+    determine_wants = lambda refs: [sha for sha in refs.values()
+                                    if not sha in target.object_store]
+    num, objects = source.fetch_objects(determine_wants, graph_walker,
+                                        lambda message: None)
+    f, commit = target.object_store.add_pack()
+    try:
+        write_pack_data(f, objects, num)
+    finally:
+        f.close()
+    commit()
+
+
+def main():
+    tempdir = tempfile.mkdtemp()
+    try:
+        if len(sys.argv) > 1:
+            source = Repo(sys.argv[1])
+        else:
+            source = make_repo(os.path.join(tempdir, "source"))
+        for name, fetch in [
+            ("protocol", protocol_fetch),
+            ("pack copy", lambda source, target: source.fetch(target))]:
+            target = make_target(os.path.join(tempdir, name))
+            start = time.time()
+            fetch(source, target)
+            elapsed = time.time() - start
+            num_objects = sum([len(p) for p in target.object_store.packs])
+            print "%s: %d objects in %.2fs" % (name, num_objects, elapsed)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# bench_graph_walker.py -- Benchmark the fetch graph walkers
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Count the haves the graph walkers send to find the common history.
+
+The local history is NUM_COMMITS commits long, with a merged side branch
+every MERGE_INTERVAL commits; the server has all but the newest
+NUM_LOCAL of them. Acknowledgements arrive a batch late, as they do
+with a pipelined client. Besides the number of haves, the number of
+commits the server would send although we already have them is shown.
+
+Run from the top of the dulwich tree:
+
+    PYTHONPATH=. python benchmarks/bench_graph_walker.py
+"""
+
+import time
+
+from dulwich.client import (
+    HAVES_PER_FLUSH,
+    SimpleFetchGraphWalker,
+    SkippingFetchGraphWalker,
+    )
+
+NUM_COMMITS = 100000
+MERGE_INTERVAL = 50
+NUM_LOCAL = [10, 1000, 20000]
+
+
+def make_history():
+    parents = {}
+    times = {}
+    order = []
+    head = None
+    for i in range(NUM_COMMITS):
+        sha = "c%d" % i
+        ps = []
+        if head is not None:
+            ps.append(head)
+        if i % MERGE_INTERVAL == 0 and head is not None:
+            side = "s%d" % i
+            parents[side] = [head]
+            times[side] = i
+            ps.append(side)
+        parents[sha] = ps
+        times[sha] = i
+        order.append(sha)
+        head = sha
+    return parents, times, order
+
+
+def ancestry(parents, heads):
+    seen = set()
+    todo = list(heads)
+    while todo:
+        sha = todo.pop()
+        if sha not in seen:
+            seen.add(sha)
+            todo.extend(parents[sha])
+    return seen
+
+
+def negotiate(walker, remote):
+    """Negotiate with a server that has the commits in remote.
+
+    :return: tuple with the number of haves sent and the common commits
+        the server found
+    """
+    haves = []
+    have = walker.next()
+    while have:
+        haves.append(have)
+        if len(haves) % HAVES_PER_FLUSH == 0 and len(haves) > HAVES_PER_FLUSH:
+            for sha in haves[-2 * HAVES_PER_FLUSH:-HAVES_PER_FLUSH]:
+                if sha in remote:
+                    walker.ack(sha)
+        have = walker.next()
+    return len(haves), [sha for sha in haves if sha in remote]
+
+
+def main():
+    parents, times, order = make_history()
+    for num_local in NUM_LOCAL:
+        remote = set(order[:-num_local])
+        remote.update(sha for sha in parents if sha[0] == "s" and
+                      int(sha[1:]) < NUM_COMMITS - num_local)
+        for name, make_walker in [
+                ("simple", lambda: SimpleFetchGraphWalker(
+                    [order[-1]], parents.__getitem__)),
+                ("skipping", lambda: SkippingFetchGraphWalker(
+                    [order[-1]], parents.__getitem__, times.__getitem__))]:
+            start = time.time()
+            haves, common = negotiate(make_walker(), remote)
+            duration = time.time() - start
+            # Commits we have that the server will send us anyway
+            extra = len(remote - ancestry(parents, common))
+            print "%6d local commits %-10s %8d haves %8d extra %8.2fs" % (
+                num_local, name, haves, extra, duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# bench_negotiation.py -- Benchmark fetch negotiation over a slow link
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Measure how long fetch negotiation takes over a link with latency.
+
+The client has a long history in common with the server, plus a number
+of commits of its own, and fetches the few commits it's missing through
+a local proxy that delays all data by LATENCY seconds each way.
+
+Run from the top of the dulwich tree:
+
+    PYTHONPATH=. python benchmarks/bench_negotiation.py
+"""
+
+import heapq
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+from dulwich.client import SimpleFetchGraphWalker, TCPGitClient
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.repo import Repo
+from dulwich.server import GitBackend, ThreadedTCPGitServer
+
+# One-way delay added by the proxy, in seconds
+LATENCY = 0.05
+NUM_COMMON = 2000
+NUM_LOCAL = 320
+NUM_NEW = 10
+
+
+def add_commits(repo, parents, count, prefix):
+    """Add a linear history of count commits on top of parents.
+
+    :return: sha of the last commit
+    """
+    objects = []
+    for i in range(count):
+        blob = Blob.from_string("%s contents %d\n" % (prefix, i))
+        tree = Tree()
+        tree.add(0100644, "file", blob.id)
+        tree.serialize()
+        commit = Commit()
+        commit._tree = tree.id
+        commit._parents = parents
+        commit._author = commit._committer = "Joe Foo <joe@foo.com>"
+        commit._commit_time = 1234567890 + len(objects)
+        commit._message = "%s commit %d\n" % (prefix, i)
+        commit.serialize()
+        objects.extend([blob, tree, commit])
+        parents = [commit.id]
+    repo.object_store.add_objects(objects)
+    return parents[0]
+
+
+def make_repo(path, parts):
+    os.mkdir(path)
+    Repo.init_bare(path)
+    repo = Repo(path)
+    parents = []
+    for prefix, count in parts:
+        parents = [add_commits(repo, parents, count, prefix)]
+    repo.set_ref("refs/heads/master", parents[0])
+    return repo
+
+
+class DelayProxy(object):
+    """Forward connections to a server, delaying all data on the way."""
+
+    def __init__(self, port, latency):
+        self.port = port
+        self.latency = latency
+        self._listener = socket.socket()
+        self._listener.bind(("localhost", 0))
+        self._listener.listen(5)
+        self.address = self._listener.getsockname()
+        thread = threading.Thread(target=self._accept)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _accept(self):
+        while True:
+            client, addr = self._listener.accept()
+            server = socket.create_connection(("localhost", self.port))
+            for src, dst in [(client, server), (server, client)]:
+                self._forward(src, dst)
+
+    def _forward(self, src, dst):
+        queue = []
+        cond = threading.Condition()
+        def read():
+            while True:
+                data = src.recv(65536)
+                cond.acquire()
+                heapq.heappush(queue, (time.time() + self.latency, data))
+                cond.notify()
+                cond.release()
+                if not data:
+                    return
+        def write():
+            while True:
+                cond.acquire()
+                while not queue:
+                    cond.wait()
+                due, data = heapq.heappop(queue)
+                cond.release()
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                if not data:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                dst.sendall(data)
+        for fn in (read, write):
+            thread = threading.Thread(target=fn)
+            thread.setDaemon(True)
+            thread.start()
+
+
+class CountingGraphWalker(SimpleFetchGraphWalker):
+
+    def __init__(self, local_heads, get_parents):
+        SimpleFetchGraphWalker.__init__(self, local_heads, get_parents)
+        self.haves = 0
+
+    def next(self):
+        ret = SimpleFetchGraphWalker.next(self)
+        if ret is not None:
+            self.haves += 1
+        return ret
+
+
+class SingleAckClient(TCPGitClient):
+
+    def fetch_capabilities(self, server_capabilities):
+        return ["side-band-64k"]
+
+
+class MultiAckClient(TCPGitClient):
+
+    def fetch_capabilities(self, server_capabilities):
+        return ["multi_ack", "side-band-64k"]
+
+
+def fetch(client_class, address, local):
+    walker = CountingGraphWalker(local.heads().values(), local.get_parents)
+    data = []
+    client = client_class(*address)
+    start = time.time()
+    try:
+        client.fetch_pack("/", lambda refs: refs.values(), walker,
+                          data.append, lambda x: None)
+    finally:
+        client._socket.close()
+    return time.time() - start, walker.haves, len("".join(data))
+
+
+def main():
+    tempdir = tempfile.mkdtemp()
+    try:
+        make_repo(os.path.join(tempdir, "remote"),
+                  [("common", NUM_COMMON), ("new", NUM_NEW)])
+        local = make_repo(os.path.join(tempdir, "local"),
+                          [("common", NUM_COMMON), ("local", NUM_LOCAL)])
+        server = ThreadedTCPGitServer(
+            GitBackend(os.path.join(tempdir, "remote")), "localhost", 0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        proxy = DelayProxy(server.server_address[1], LATENCY)
+        print "%d common commits, %d local, %d new, %.0fms round trip" % (
+            NUM_COMMON, NUM_LOCAL, NUM_NEW, LATENCY * 2000)
+        for name, client_class in [
+                ("single ack", SingleAckClient),
+                ("multi_ack", MultiAckClient),
+                ("multi_ack_detailed no-done", TCPGitClient)]:
+            duration, haves, size = fetch(client_class, proxy.address, local)
+            print "%-30s %8.2fs %8d haves %10d bytes" % (name, duration,
+                haves, size)
+        server.shutdown()
+        server.server_close()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    main()
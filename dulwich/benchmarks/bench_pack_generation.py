@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# bench_pack_generation.py -- Compare ways of generating packs for a clone
+# 
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Measure time-to-first-byte and total time of pack generation.
+
+Compares finding all objects before writing the pack (write_pack_data) 
+with the pipelined writer used by the server (write_pack_pipelined).
+
+Run from the top of the dulwich tree:
+
+    PYTHONPATH=. python benchmarks/bench_pack_generation.py [NUM_COMMITS]
+"""
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.pack import write_pack_data, write_pack_pipelined
+from dulwich.repo import Repo
+
+
+class TimingWriter(object):
+    """File-like object that remembers when data was first written."""
+
+    def __init__(self, start):
+        self.start = start
+        self.first_write = None
+        self.first_progress = None
+        self.size = 0
+
+    def write(self, data):
+        if self.first_write is None:
+            self.first_write = time.time() - self.start
+        self.size += len(data)
+
+    def tell(self):
+        return self.size
+
+    def progress(self, message):
+        if self.first_progress is None:
+            self.first_progress = time.time() - self.start
+
+
+class NoHaves(object):
+
+    def next(self):
+        return None
+
+    def ack(self, sha):
+        pass
+
+
+def make_repo(path, num_commits):
+    os.mkdir(path)
+    Repo.init_bare(path)
+    repo = Repo(path)
+    objects = []
+    parents = []
+    for i in range(num_commits):
+        blobs = [Blob.from_string("file %d, revision %d\n" % (j, i) * 50)
+                 for j in range(3)]
+        subtree = Tree()
+        for j, blob in enumerate(blobs):
+            subtree.add(0100644, "file%d" % j, blob.id)
+        subtree.serialize()
+        tree = Tree()
+        tree.add(stat.S_IFDIR, "dir", subtree.id)
+        tree.serialize()
+        commit = Commit()
+        commit._tree = tree.id
+        commit._parents = parents
+        commit._author = commit._committer = "Joe Foo <joe@foo.com>"
+        commit._commit_time = 1234567890 + i
+        commit._message = "commit %d\n" % i
+        commit.serialize()
+        objects.extend(blobs + [subtree, tree, commit])
+        parents = [commit.id]
+    repo.object_store.add_objects(objects)
+    repo.set_ref("refs/heads/master", parents[0])
+    return Repo(path)
+
+
+def bench_write_pack_data(repo, head):
+    start = time.time()
+    out = TimingWriter(start)
+    num_objects, objects = repo.fetch_objects(lambda refs: [head], 
+        NoHaves(), out.progress)
+    write_pack_data(out, objects, num_objects)
+    return out, time.time() - start
+
+
+def bench_write_pack_pipelined(repo, head):
+    start = time.time()
+    out = TimingWriter(start)
+    shas = repo.iter_missing_objects(lambda refs: [head], NoHaves(), 
+        out.progress)
+    write_pack_pipelined(out, shas, repo.object_store.get_raw, out.progress)
+    return out, time.time() - start
+
+
+def main():
+    num_commits = 2000
+    if len(sys.argv) > 1:
+        num_commits = int(sys.argv[1])
+    tempdir = tempfile.mkdtemp()
+    try:
+        repo = make_repo(os.path.join(tempdir, "repo"), num_commits)
+        head = repo.ref("refs/heads/master")
+        print "%d commits, %d objects" % (num_commits, num_commits * 6)
+        print "%-22s %12s %12s %10s" % ("", "first byte", "first pack", 
+                                          "total")
+        for name, fn in [("write_pack_data", bench_write_pack_data),
+                         ("write_pack_pipelined", bench_write_pack_pipelined)]:
+            out, total = fn(repo, head)
+            print "%-22s %11.2fs %11.2fs %9.2fs" % (name, 
+                min(out.first_progress or total, out.first_write), 
+                out.first_write, total)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    main()
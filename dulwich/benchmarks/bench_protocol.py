@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# bench_protocol.py -- Micro-benchmarks for pkt-line handling
+# 
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Measure pkt-line throughput of dulwich.protocol.
+
+Run from the top of the dulwich tree:
+
+    PYTHONPATH=. python benchmarks/bench_protocol.py
+"""
+
+from cStringIO import StringIO
+import time
+
+from dulwich.protocol import Protocol
+
+NUM_LINES = 100000
+LINE = "have %s\n" % ("a" * 40)
+SIDEBAND_SIZE = 16 * 1024 * 1024
+
+
+class NullWriter(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.calls += 1
+        self.bytes += len(data)
+
+
+def timed(name, fn, amount, unit):
+    start = time.time()
+    calls = fn()
+    duration = time.time() - start
+    print "%-30s %8.2fs %12.0f %s/s %8d calls" % (name, duration, 
+        amount / duration, unit, calls)
+
+
+def bench_write_pkt_lines():
+    out = NullWriter()
+    proto = Protocol(None, out.write)
+    for i in xrange(NUM_LINES):
+        proto.write_pkt_line(LINE)
+    proto.write_pkt_line(None)
+    proto.flush()
+    return out.calls
+
+
+def bench_read_pkt_lines(data, buffered):
+    f = StringIO(data)
+    calls = [0]
+    def counting(fn):
+        def wrapper(*args):
+            calls[0] += 1
+            return fn(*args)
+        return wrapper
+    if buffered:
+        proto = Protocol(None, None, counting(f.read))
+    else:
+        proto = Protocol(counting(f.read), None)
+    for pkt in proto.read_pkt_seq():
+        pass
+    return calls[0]
+
+
+def bench_write_sideband():
+    out = NullWriter()
+    proto = Protocol(None, out.write)
+    proto.write_sideband(1, "x" * SIDEBAND_SIZE)
+    proto.flush()
+    return out.calls
+
+
+def main():
+    out = StringIO()
+    proto = Protocol(None, out.write)
+    for i in xrange(NUM_LINES):
+        proto.write_pkt_line(LINE)
+    proto.write_pkt_line(None)
+    proto.flush()
+    data = out.getvalue()
+
+    timed("write pkt-lines", bench_write_pkt_lines, NUM_LINES, "lines")
+    timed("read pkt-lines (unbuffered)", 
+          lambda: bench_read_pkt_lines(data, False), NUM_LINES, "lines")
+    timed("read pkt-lines (buffered)", 
+          lambda: bench_read_pkt_lines(data, True), NUM_LINES, "lines")
+    timed("write sideband", bench_write_sideband, 
+          SIDEBAND_SIZE / (1024 * 1024), "MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# bench_revision_history.py -- Benchmark Repo.revision_history
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Measure the time taken to list the history of a long branch.
+
+The history is NUM_COMMITS commits long, with a merged side branch of
+one commit every MERGE_INTERVAL commits. The time until the first
+commit is available and the time to list the whole history are shown.
+The old list based algorithm, which is quadratic in the length of the
+history, is timed on the newest OLD_NUM_COMMITS commits only.
+
+Run from the top of the dulwich tree:
+
+    PYTHONPATH=. python benchmarks/bench_revision_history.py [NUM_COMMITS]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from dulwich.objects import Commit, Tree
+from dulwich.repo import Repo
+
+MERGE_INTERVAL = 50
+OLD_NUM_COMMITS = 500
+
+
+def make_commit(tree, parents, commit_time):
+    commit = Commit()
+    commit._tree = tree
+    commit._parents = parents
+    commit._author = commit._committer = "Joe Foo <joe@foo.com>"
+    commit._commit_time = commit_time
+    commit._message = "commit %d\n" % commit_time
+    commit.serialize()
+    return commit
+
+
+def make_repo(path, num_commits):
+    os.mkdir(path)
+    Repo.init_bare(path)
+    repo = Repo(path)
+    tree = Tree()
+    tree.serialize()
+    objects = [tree]
+    parents = []
+    for i in range(num_commits):
+        commit_time = 1234567890 + 2 * i
+        if i % MERGE_INTERVAL == 0 and parents:
+            side = make_commit(tree.id, list(parents), commit_time - 1)
+            objects.append(side)
+            parents.append(side.id)
+        commit = make_commit(tree.id, parents, commit_time)
+        objects.append(commit)
+        parents = [commit.id]
+    repo.object_store.add_objects(objects)
+    repo.set_ref("refs/heads/master", parents[0])
+    return Repo(path)
+
+
+def old_revision_history(repo, head, limit):
+    """The list based revision_history, stopping after limit commits."""
+    pending_commits = [head]
+    history = []
+    while pending_commits != [] and len(history) < limit:
+        head = pending_commits.pop(0)
+        commit = repo.commit(head)
+        if commit in history:
+            continue
+        i = 0
+        for known_commit in history:
+            if known_commit.commit_time > commit.commit_time:
+                break
+            i += 1
+        history.insert(i, commit)
+        pending_commits += commit.parents
+    history.reverse()
+    return history
+
+
+def main():
+    num_commits = 50000
+    if len(sys.argv) > 1:
+        num_commits = int(sys.argv[1])
+    tempdir = tempfile.mkdtemp()
+    try:
+        repo = make_repo(os.path.join(tempdir, "repo"), num_commits)
+        head = repo.ref("refs/heads/master")
+        start = time.time()
+        repo.iter_revision_history(head).next()
+        first = time.time() - start
+        start = time.time()
+        history = repo.revision_history(head)
+        total = time.time() - start
+        print "%d commits: first commit %.3fs, revision_history %.2fs" % (
+            len(history), first, total)
+        start = time.time()
+        history = old_revision_history(repo, head, OLD_NUM_COMMITS)
+        print "%d commits: old revision_history %.2fs" % (len(history),
+            time.time() - start)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,519 @@
+# async_server.py -- Event loop based server for the git protocol
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Git server that multiplexes connections on a single event loop.
+
+Reading the command, advertising the refs and reading the client's
+request all happen on the event loop, so idle connections (such as clients
+that only look at the refs, or that haven't made up their mind yet) don't
+tie up a thread. Backend calls - listing the refs, finding and packing the
+objects to send and applying received packs - are blocking, so they run on
+a small pool of worker threads. While a worker owns a connection it talks
+to the client through a Protocol whose reads and writes are passed on to
+the event loop.
+"""
+
+import asyncore
+import errno
+import fcntl
+import os
+import select
+import socket
+import sys
+import threading
+import time
+import traceback
+from Queue import Queue
+
+from dulwich.errors import HangupException
+from dulwich.protocol import Protocol, RECV_SIZE, TCP_GIT_PORT
+from dulwich.server import (
+        DEFAULT_MAX_CONNECTIONS,
+        ReceivePackHandler,
+        UploadPackHandler,
+        )
+
+# Maximum amount of received data to buffer for a connection before
+# we stop reading from it
+MAX_INPUT_BUFFER = 1024 * 1024
+
+# Maximum amount of outgoing data to buffer for a connection before
+# a worker writing to it has to wait
+MAX_OUTPUT_BUFFER = 1024 * 1024
+
+
+class WorkerPool(object):
+    """Fixed set of threads that run blocking jobs for the event loop."""
+
+    def __init__(self, num_workers, call_soon):
+        """Create a new WorkerPool.
+
+        :param num_workers: Number of threads
+        :param call_soon: Function used to schedule a callback on the
+            event loop
+        """
+        self._jobs = Queue()
+        self._call_soon = call_soon
+        self._threads = []
+        for i in range(num_workers):
+            t = threading.Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, fn, args, callback):
+        """Run fn(*args) on a worker thread.
+
+        callback(result, exc_info) is called on the event loop when it is
+        done; exc_info is None unless fn raised an exception.
+        """
+        self._jobs.put((fn, args, callback))
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            fn, args, callback = job
+            try:
+                result, exc_info = fn(*args), None
+            except:
+                result, exc_info = None, sys.exc_info()
+            self._call_soon(callback, result, exc_info)
+
+    def stop(self):
+        """Wait for the submitted jobs to finish and stop the threads."""
+        for t in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+
+class _Trigger(asyncore.file_dispatcher):
+    """Pipe that wakes up the event loop when another thread writes to it."""
+
+    def __init__(self, server, map):
+        r, self._wfd = os.pipe()
+        fcntl.fcntl(self._wfd, fcntl.F_SETFL,
+                    fcntl.fcntl(self._wfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, r, map)
+        os.close(r)
+        self.server = server
+
+    def pull(self):
+        try:
+            os.write(self._wfd, "x")
+        except OSError, e:
+            # A full pipe will wake up the loop just as well
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(512)
+        self.server._run_pending()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._wfd)
+
+
+class AsyncGitConnection(asyncore.dispatcher):
+    """A single git protocol session.
+
+    Incoming data is collected in a buffer. While the session is handled
+    by the event loop, data is only handed out to the Protocol once a
+    complete request has arrived, so reading it never blocks the loop.
+    """
+
+    def __init__(self, server, sock):
+        asyncore.dispatcher.__init__(self, sock, server._map)
+        self.server = server
+        self.last_activity = time.time()
+        self._cond = threading.Condition()
+        self._inbuf = ""
+        # Number of bytes at the start of _inbuf the Protocol may read
+        self._released = 0
+        self._eof = False
+        self._closed = False
+        self._outbuf = []
+        self._outbuf_len = 0
+        # Close the connection once all output has been sent
+        self._closing = False
+        # A worker thread is running a job for this connection
+        self._in_worker = False
+        # Function that parses the next request, while on the event loop
+        self._state = self._read_command
+        self.proto = Protocol(None, self._queue_write, self._recv)
+        self.handler = None
+
+    def _recv(self, size):
+        self._cond.acquire()
+        try:
+            deadline = None
+            while not self._released and not self._eof and not self._closed:
+                if not self._in_worker:
+                    raise AssertionError("read beyond the current request")
+                timeout = self.server.connection_timeout
+                if timeout is not None:
+                    if deadline is None:
+                        deadline = time.time() + timeout
+                    elif time.time() >= deadline:
+                        raise socket.timeout("timed out")
+                    self._cond.wait(deadline - time.time())
+                else:
+                    self._cond.wait()
+            size = min(size, self._released)
+            data = self._inbuf[:size]
+            was_full = len(self._inbuf) >= MAX_INPUT_BUFFER
+            self._inbuf = self._inbuf[size:]
+            self._released -= size
+        finally:
+            self._cond.release()
+        if was_full:
+            # We may have stopped reading from the socket
+            self.server.trigger.pull()
+        return data
+
+    def _queue_write(self, data):
+        self._cond.acquire()
+        try:
+            if self._in_worker:
+                while (self._outbuf_len >= MAX_OUTPUT_BUFFER and
+                       not self._closed):
+                    self._cond.wait()
+            if self._closed:
+                raise socket.error(errno.EPIPE, "connection closed")
+            self._outbuf.append(data)
+            self._outbuf_len += len(data)
+            in_worker = self._in_worker
+        finally:
+            self._cond.release()
+        if in_worker:
+            self.server.trigger.pull()
+
+    def _release_request(self, until_flush):
+        """Make the next request available to the Protocol.
+
+        :param until_flush: Whether the request is a sequence of pkt-lines
+            ending in a flush-pkt, rather than a single pkt-line.
+        :return: True if the complete request has been received
+        """
+        self._cond.acquire()
+        try:
+            data = self._inbuf
+            pos = self._released
+            while len(data) - pos >= 4:
+                size = int(data[pos:pos+4], 16)
+                if size == 0:
+                    size = 4
+                elif size < 4:
+                    raise ValueError("invalid pkt-line length %d" % size)
+                if len(data) - pos < size:
+                    break
+                pos += size
+                if size == 4 or not until_flush:
+                    self._released = pos
+                    return True
+            return False
+        finally:
+            self._cond.release()
+
+    def _run_in_worker(self, fn, callback):
+        self._state = None
+        self._cond.acquire()
+        try:
+            self._in_worker = True
+            # Everything that has been received is up for grabs
+            self._released = len(self._inbuf)
+        finally:
+            self._cond.release()
+        self.server.pool.submit(fn, (), callback)
+
+    def _run_in_worker_done(self, exc_info):
+        self._cond.acquire()
+        try:
+            self._in_worker = False
+            self._released = 0
+        finally:
+            self._cond.release()
+        if exc_info is not None:
+            self.server.handle_session_error(exc_info)
+            self.close()
+            return False
+        if self._closed:
+            return False
+        if self._eof:
+            # The client has stopped sending, so there is nothing left to do
+            self._finish()
+            return False
+        return True
+
+    def _read_command(self):
+        if not self._release_request(False):
+            return
+        command, args = self.proto.read_cmd()
+        if command == 'git-upload-pack':
+            cls = UploadPackHandler
+        elif command == 'git-receive-pack':
+            cls = ReceivePackHandler
+        else:
+            self.close()
+            return
+        self.handler = cls(self.server.backend, self.proto)
+        self._run_in_worker(self.server.backend.get_refs, self._advertise)
+
+    def _advertise(self, refs, exc_info):
+        if not self._run_in_worker_done(exc_info):
+            return
+        self.handler.advertise_refs(refs)
+        self.proto.flush()
+        if isinstance(self.handler, UploadPackHandler):
+            self._state = self._read_wants
+        else:
+            self._state = self._read_ref_updates
+        self._state()
+
+    def _read_wants(self):
+        if not self._release_request(True):
+            return
+        wants = self.handler.read_wants()
+        if not wants:
+            self._finish()
+            return
+        def determine_wants(heads):
+            self.handler.wants = wants
+            return wants
+        def send_objects():
+            self.handler.send_objects(determine_wants)
+            self.proto.flush()
+        self._run_in_worker(send_objects, self._session_done)
+
+    def _read_ref_updates(self):
+        if not self._release_request(True):
+            return
+        client_refs = self.handler.read_ref_updates()
+        if not client_refs:
+            self._finish()
+            return
+        def receive_pack():
+            self.handler.receive_pack(client_refs)
+            self.proto.flush()
+        self._run_in_worker(receive_pack, self._session_done)
+
+    def _session_done(self, result, exc_info):
+        if self._run_in_worker_done(exc_info):
+            self._finish()
+
+    def _finish(self):
+        self.proto.flush()
+        self._closing = True
+        if not self._outbuf:
+            self.close()
+
+    def is_idle(self):
+        """Check whether the connection is waiting for the client."""
+        return self._state is not None and not self._outbuf
+
+    def readable(self):
+        return (not self._eof and not self._closing and
+                len(self._inbuf) < MAX_INPUT_BUFFER)
+
+    def writable(self):
+        return bool(self._outbuf)
+
+    def handle_read(self):
+        try:
+            data = self.socket.recv(RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self.last_activity = time.time()
+        self._cond.acquire()
+        try:
+            if data:
+                self._inbuf += data
+                if self._in_worker:
+                    self._released = len(self._inbuf)
+            else:
+                self._eof = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        if not data:
+            # The client has stopped sending, but a worker may still 
+            # have output for it
+            if not self._in_worker:
+                self.close()
+        elif self._state is not None:
+            self._state()
+
+    def handle_write(self):
+        self._cond.acquire()
+        try:
+            data = "".join(self._outbuf)
+            sent = self.send(data)
+            if sent < len(data):
+                self._outbuf = [data[sent:]]
+            else:
+                self._outbuf = []
+            self._outbuf_len = len(data) - sent
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        if sent:
+            self.last_activity = time.time()
+        if self._closing and not self._outbuf:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        self.server.handle_session_error(sys.exc_info())
+        self.close()
+
+    def close(self):
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._outbuf = []
+            self._outbuf_len = 0
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        asyncore.dispatcher.close(self)
+
+
+class AsyncTCPGitServer(asyncore.dispatcher):
+    """Git server that serves all connections from a single event loop.
+
+    The interface matches that of TCPGitServer.
+
+    :ivar connection_timeout: Number of seconds a session may wait for the
+        client before it is dropped, or None to wait forever.
+    """
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT,
+                 connection_timeout=None, max_workers=DEFAULT_MAX_CONNECTIONS):
+        self._map = {}
+        asyncore.dispatcher.__init__(self, map=self._map)
+        self.backend = backend
+        self.connection_timeout = connection_timeout
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((listen_addr, port))
+        self.listen(socket.SOMAXCONN)
+        self.server_address = self.socket.getsockname()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self.trigger = _Trigger(self, self._map)
+        self.pool = WorkerPool(max_workers, self.call_soon)
+        self._stopping = False
+        self._stopped = threading.Event()
+        self._stopped.set()
+
+    def call_soon(self, fn, *args):
+        """Schedule fn(*args) to be called on the event loop.
+
+        This can be used from any thread.
+        """
+        self._pending_lock.acquire()
+        try:
+            self._pending.append((fn, args))
+        finally:
+            self._pending_lock.release()
+        self.trigger.pull()
+
+    def _run_pending(self):
+        self._pending_lock.acquire()
+        try:
+            pending, self._pending = self._pending, []
+        finally:
+            self._pending_lock.release()
+        for fn, args in pending:
+            fn(*args)
+
+    def connections(self):
+        return [c for c in self._map.values()
+                if isinstance(c, AsyncGitConnection)]
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        AsyncGitConnection(self, pair[0])
+
+    def handle_session_error(self, exc_info):
+        """Report an error that ended a session.
+
+        Clients disconnecting or timing out are not reported.
+        """
+        if isinstance(exc_info[1], (HangupException, socket.error)):
+            return
+        traceback.print_exception(*exc_info)
+
+    def _close_idle(self, now):
+        for conn in self.connections():
+            if not conn.is_idle():
+                continue
+            if (self._stopping or
+                now - conn.last_activity > self.connection_timeout):
+                conn.close()
+
+    def serve_forever(self, poll_interval=0.5):
+        """Handle connections until shutdown() is called.
+
+        After shutdown() the server stops accepting connections and waits
+        for the sessions in progress to finish.
+        """
+        self._stopped.clear()
+        try:
+            while not self._stopping or self.connections():
+                asyncore.loop(poll_interval, hasattr(select, "poll"),
+                              self._map, 1)
+                self._run_pending()
+                if self._stopping and self.accepting:
+                    asyncore.dispatcher.close(self)
+                if self._stopping or self.connection_timeout is not None:
+                    self._close_idle(time.time())
+        finally:
+            self._stopped.set()
+
+    serve = serve_forever
+
+    def shutdown(self):
+        """Stop serve_forever and wait for it to return."""
+        self._stopping = True
+        self.trigger.pull()
+        self._stopped.wait()
+
+    def server_close(self):
+        """Release the resources used by the server."""
+        for conn in self.connections():
+            conn.close()
+        if self.accepting:
+            asyncore.dispatcher.close(self)
+        self.pool.stop()
+        self.trigger.close()
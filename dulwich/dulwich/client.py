@@ -16,10 +16,14 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA  02110-1301, USA.
 
-import select
+import heapq
 import socket
+from dulwich.errors import GitProtocolError
 from dulwich.protocol import Protocol, TCP_GIT_PORT, extract_capabilities
 
+# Number of haves to send before asking the server for acknowledgements
+HAVES_PER_FLUSH = 32
+
 class SimpleFetchGraphWalker(object):
 
     def __init__(self, local_heads, get_parents):
@@ -28,11 +32,17 @@ class SimpleFetchGraphWalker(object):
         self.parents = {}
 
     def ack(self, ref):
-        if ref in self.heads:
-            self.heads.remove(ref)
-        if ref in self.parents:
-            for p in self.parents[ref]:
-                self.ack(p)
+        # Acks may arrive long after the commits were walked, so don't 
+        # recurse through their ancestry
+        todo = [ref]
+        seen = set()
+        while todo:
+            ref = todo.pop()
+            if ref in seen:
+                continue
+            seen.add(ref)
+            self.heads.discard(ref)
+            todo.extend(self.parents.get(ref, []))
 
     def next(self):
         if self.heads:
@@ -44,18 +54,224 @@ class SimpleFetchGraphWalker(object):
         return None
 
 
+class SkippingFetchGraphWalker(object):
+    """Graph walker that finds the common history with few haves.
+
+    Like git's skipping negotiator, commits are walked newest first and 
+    the gaps between the commits sent as haves grow exponentially while 
+    they aren't known to be common. Once the server acknowledges a 
+    commit, it and everything reachable from it is left out. On long 
+    histories this finds where they diverge in a number of haves that is 
+    logarithmic rather than linear in the number of commits we have that 
+    the server doesn't, at the cost of sometimes receiving commits that 
+    were skipped over.
+    """
+
+    def __init__(self, local_heads, get_parents, get_commit_time):
+        """Create a new graph walker.
+
+        :param local_heads: Commits to start walking from
+        :param get_parents: Callable returning the parents of a commit
+        :param get_commit_time: Callable returning the commit time of a 
+            commit; raises KeyError for commits that aren't present.
+        """
+        self.get_parents = get_parents
+        self.get_commit_time = get_commit_time
+        self.parents = {}
+        # Commits that have been queued, with their remaining and original 
+        # number of commits to skip
+        self._entries = {}
+        self._queue = []
+        self._popped = set()
+        self._common = set()
+        self._non_common = 0
+        for head in local_heads:
+            if head not in self._entries:
+                try:
+                    self._push(head)
+                except KeyError:
+                    pass
+
+    def _push(self, sha):
+        time = self.get_commit_time(sha)
+        entry = [0, 0]
+        self._entries[sha] = entry
+        heapq.heappush(self._queue, (-time, len(self._entries), sha))
+        self._non_common += 1
+        return entry
+
+    def _mark_common(self, sha):
+        todo = [sha]
+        while todo:
+            sha = todo.pop()
+            if sha in self._common or sha not in self._entries:
+                continue
+            self._common.add(sha)
+            if sha not in self._popped:
+                self._non_common -= 1
+            todo.extend(self.parents.get(sha, []))
+
+    def _push_parent(self, sha, entry, parent):
+        if parent in self._entries:
+            if parent in self._popped:
+                # Only possible with clock skew; pretend it isn't there
+                return False
+            parent_entry = self._entries[parent]
+        else:
+            try:
+                parent_entry = self._push(parent)
+            except KeyError:
+                return False
+        if sha in self._common:
+            self._mark_common(parent)
+        else:
+            (ttl, original_ttl) = entry
+            if ttl:
+                new_original_ttl, new_ttl = original_ttl, ttl - 1
+            else:
+                new_original_ttl = original_ttl * 3 / 2 + 1
+                new_ttl = new_original_ttl
+            if parent_entry[1] < new_original_ttl:
+                parent_entry[:] = [new_ttl, new_original_ttl]
+        return True
+
+    def ack(self, ref):
+        self._mark_common(ref)
+
+    def next(self):
+        while self._queue and self._non_common:
+            sha = heapq.heappop(self._queue)[2]
+            entry = self._entries[sha]
+            self._popped.add(sha)
+            common = sha in self._common
+            if not common:
+                self._non_common -= 1
+            parents = self.get_parents(sha)
+            self.parents[sha] = parents
+            pushed = False
+            for parent in parents:
+                if self._push_parent(sha, entry, parent):
+                    pushed = True
+            # Commits without parents left to walk are sent regardless, 
+            # so the server gets to see the end of each line of history
+            if not common and (entry[0] == 0 or not pushed):
+                return sha
+        return None
+
+
 class GitClient(object):
     """Git smart server client.
 
     """
 
-    def __init__(self, fileno, read, write):
-        self.proto = Protocol(read, write)
+    def __init__(self, fileno, read, write, recv=None):
+        self.proto = Protocol(read, write, recv)
         self.fileno = fileno
 
     def capabilities(self):
         return "multi_ack side-band-64k thin-pack ofs-delta"
 
+    def fetch_capabilities(self, server_capabilities):
+        """Determine the capabilities to ask for when fetching.
+
+        :param server_capabilities: List of capabilities the server offers
+        :return: List of capabilities to send with the first want
+        """
+        wanted = ["side-band-64k", "thin-pack", "ofs-delta"]
+        if "multi_ack_detailed" in server_capabilities:
+            wanted[:0] = ["multi_ack_detailed", "no-done"]
+        else:
+            wanted.insert(0, "multi_ack")
+        return [c for c in wanted if c in server_capabilities]
+
+    def _send_wants(self, wants, capabilities):
+        self.proto.write_pkt_line("want %s %s\n" % (wants[0], " ".join(capabilities)))
+        for want in wants[1:]:
+            self.proto.write_pkt_line("want %s\n" % want)
+        self.proto.write_pkt_line(None)
+
+    def _read_ack(self, graph_walker):
+        """Read an acknowledgement from the server.
+
+        :return: None for a NAK, otherwise the status of the ACK ("common", 
+            "continue", "ready", or "" for the final one)
+        """
+        pkt = self.proto.read_pkt_line()
+        parts = pkt.rstrip("\n").split(" ")
+        if parts[0] == "NAK":
+            return None
+        if parts[0] != "ACK":
+            raise GitProtocolError("Expected ACK or NAK, got %r" % pkt)
+        graph_walker.ack(parts[1])
+        if len(parts) < 3:
+            return ""
+        return parts[2]
+
+    def _negotiate_multi_ack(self, wants, capabilities, graph_walker):
+        """Send the haves in batches, without waiting for each response.
+
+        Every HAVES_PER_FLUSH haves are followed by a flush-pkt, to which the 
+        server responds with the haves it has in common with us and a NAK. 
+        One batch is kept in flight, so the server is never waiting on us 
+        and we only wait for a response when we're a batch ahead of it.
+        """
+        no_done = "no-done" in capabilities
+        self._send_wants(wants, capabilities)
+        count = 0
+        in_flight = 0
+        ready = False
+        finished = False
+        have = graph_walker.next()
+        while have:
+            self.proto.write_pkt_line("have %s\n" % have)
+            count += 1
+            if count % HAVES_PER_FLUSH == 0:
+                self.proto.write_pkt_line(None)
+                self.proto.flush()
+                in_flight += 1
+                if in_flight > 1:
+                    status = self._read_ack(graph_walker)
+                    while status not in (None, ""):
+                        ready = ready or status == "ready"
+                        status = self._read_ack(graph_walker)
+                    in_flight -= 1
+                    # A plain ACK means the server won't say anything more
+                    finished = (status == "")
+                    if ready or finished:
+                        break
+            have = graph_walker.next()
+        # With no-done the server doesn't wait for "done" once it has said 
+        # it is ready, and won't respond to the batches still in flight. It 
+        # does read up to the "done" after sending the pack though, so the 
+        # haves we sent in the meantime aren't left unread.
+        self.proto.write_pkt_line("done\n")
+        self.proto.flush()
+        while not finished:
+            status = self._read_ack(graph_walker)
+            if status == "":
+                finished = True
+            elif status == "ready":
+                ready = True
+            elif status is None:
+                if ready and no_done:
+                    # The final ACK follows straight away
+                    continue
+                if in_flight == 0:
+                    finished = True
+                in_flight -= 1
+
+    def _negotiate_single_ack(self, wants, capabilities, graph_walker):
+        self._send_wants(wants, capabilities)
+        have = graph_walker.next()
+        while have:
+            self.proto.write_pkt_line("have %s\n" % have)
+            have = graph_walker.next()
+        self.proto.write_pkt_line("done\n")
+        self.proto.flush()
+        # A single ACK for the first common commit, or a NAK if there was 
+        # none, ends the negotiation
+        self._read_ack(graph_walker)
+
     def read_refs(self):
         server_capabilities = None
         refs = {}
@@ -73,6 +289,7 @@ class GitClient(object):
         changed_refs = [] # FIXME
         if not changed_refs:
             self.proto.write_pkt_line(None)
+            self.proto.flush()
             return
         self.proto.write_pkt_line("%s %s %s\0%s" % (changed_refs[0][0], changed_refs[0][1], changed_refs[0][2], self.capabilities()))
         want = []
@@ -83,6 +300,7 @@ class GitClient(object):
             if changed_refs[0] != "0"*40:
                 have.append(changed_refs[0])
         self.proto.write_pkt_line(None)
+        self.proto.flush()
         # FIXME: This is implementation specific
         # shas = generate_pack_contents(want, have, None)
         # write_pack_data(self.write, shas, len(shas))
@@ -100,30 +318,14 @@ class GitClient(object):
         wants = determine_wants(refs)
         if not wants:
             self.proto.write_pkt_line(None)
+            self.proto.flush()
             return
-        self.proto.write_pkt_line("want %s %s\n" % (wants[0], self.capabilities()))
-        for want in wants[1:]:
-            self.proto.write_pkt_line("want %s\n" % want)
-        self.proto.write_pkt_line(None)
-        have = graph_walker.next()
-        while have:
-            self.proto.write_pkt_line("have %s\n" % have)
-            if len(select.select([self.fileno], [], [], 0)[0]) > 0:
-                pkt = self.proto.read_pkt_line()
-                parts = pkt.rstrip("\n").split(" ")
-                if parts[0] == "ACK":
-                    graph_walker.ack(parts[1])
-                    assert parts[2] == "continue"
-            have = graph_walker.next()
-        self.proto.write_pkt_line("done\n")
-        pkt = self.proto.read_pkt_line()
-        while pkt:
-            parts = pkt.rstrip("\n").split(" ")
-            if parts[0] == "ACK":
-                graph_walker.ack(pkt.split(" ")[1])
-            if len(parts) < 3 or parts[2] != "continue":
-                break
-            pkt = self.proto.read_pkt_line()
+        server_capabilities = " ".join(server_capabilities or []).split()
+        capabilities = self.fetch_capabilities(server_capabilities)
+        if "multi_ack_detailed" in capabilities or "multi_ack" in capabilities:
+            self._negotiate_multi_ack(wants, capabilities, graph_walker)
+        else:
+            self._negotiate_single_ack(wants, capabilities, graph_walker)
         for pkt in self.proto.read_pkt_seq():
             channel = ord(pkt[0])
             pkt = pkt[1:]
@@ -140,10 +342,10 @@ class TCPGitClient(GitClient):
     def __init__(self, host, port=TCP_GIT_PORT):
         self._socket = socket.socket(type=socket.SOCK_STREAM)
         self._socket.connect((host, port))
-        self.rfile = self._socket.makefile('rb', -1)
         self.wfile = self._socket.makefile('wb', 0)
         self.host = host
-        super(TCPGitClient, self).__init__(self._socket.fileno(), self.rfile.read, self.wfile.write)
+        super(TCPGitClient, self).__init__(self._socket.fileno(), None, 
+            self.wfile.write, self._socket.recv)
 
     def send_pack(self, path):
         self.proto.send_cmd("git-receive-pack", path, "host=%s" % self.host)
@@ -0,0 +1,392 @@
+# commit_graph.py -- Reading and writing git commit-graph files
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Classes for dealing with git commit-graph files.
+
+A commit-graph file stores the parents, root tree, commit time and
+generation number of a set of commits, so that history can be walked
+without inflating and parsing the commits themselves. It lives in
+objects/info/commit-graph, uses the same format as the files written by
+"git commit-graph write" and is closed under parents: the parents of
+every commit in it are in it as well.
+
+The generation number of a commit is one more than the largest
+generation number of its parents, or one for a commit without parents.
+A commit can only be an ancestor of commits with a larger generation
+number.
+
+A commit-graph can also be split into layers, as "git commit-graph write
+--split" does, so that new commits can be added without rewriting the
+commits that are in it already. The layers are kept in
+objects/info/commit-graphs, and listed from the bottom up in the
+commit-graph-chain file there. Each layer refers to the commits in the
+layers below it by their positions in the whole chain.
+"""
+
+import hashlib
+import os
+import struct
+
+from objects import (
+        hex_to_sha,
+        sha_to_hex,
+        )
+from pack import (
+        SHA1Writer,
+        simple_mmap,
+        )
+
+COMMIT_GRAPH_SIGNATURE = "CGPH"
+COMMIT_GRAPH_VERSION = 1
+# Identifies SHA-1 as the hash function
+COMMIT_GRAPH_HASH_VERSION = 1
+
+CHUNK_OID_FANOUT = "OIDF"
+CHUNK_OID_LOOKUP = "OIDL"
+CHUNK_COMMIT_DATA = "CDAT"
+CHUNK_EXTRA_EDGES = "EDGE"
+CHUNK_BASE_GRAPHS = "BIDX"
+
+# Size of an entry in the commit data chunk: the tree, two parent
+# positions and the generation number and commit time
+COMMIT_DATA_SIZE = 36
+
+PARENT_NONE = 0x70000000
+# Set on the second parent of octopus merges, which is then an index in
+# to the extra edges chunk, and on the last of their parents in that chunk
+PARENT_EXTRA_EDGES = 0x80000000
+GENERATION_NUMBER_MAX = 0x3FFFFFFF
+# Generation number of commits that aren't in a commit-graph
+GENERATION_NUMBER_INFINITY = 0xFFFFFFFF
+
+
+class CommitGraph(object):
+  """A commit-graph file.
+
+  Commits are found the same way as objects in a pack index: a fan-out
+  table of 256 entries indexed by the first byte of the sha gives the
+  range of the sorted list of shas to bisect. The position of the sha
+  in that list is the position of the commit's data, in which parents
+  are referred to by their positions as well.
+  """
+
+  def __init__(self, filename, base=None):
+    """Open a commit-graph file.
+
+    :param filename: Path of the file
+    :param base: CommitGraph of the layers below this one, if this is a
+        layer of a split commit-graph
+    """
+    self._filename = filename
+    self.base = base
+    if base is None:
+      self._num_base = 0
+    else:
+      self._num_base = len(base)
+    self._size = os.path.getsize(filename)
+    self._file = open(filename, 'rb')
+    self._contents = simple_mmap(self._file, 0, self._size)
+    (signature, version, hash_version, num_chunks, num_base_graphs) = \
+        struct.unpack_from(">4sBBBB", self._contents, 0)
+    assert signature == COMMIT_GRAPH_SIGNATURE, \
+        "Not a commit-graph file: %s" % filename
+    assert version == COMMIT_GRAPH_VERSION, "Version was %d" % version
+    assert hash_version == COMMIT_GRAPH_HASH_VERSION, \
+        "Hash version was %d" % hash_version
+    if base is None:
+      assert num_base_graphs == 0, "Base of %s is missing" % filename
+    else:
+      assert num_base_graphs == len(base.layers()), \
+          "Number of base layers was %d" % num_base_graphs
+    chunks = {}
+    for i in range(num_chunks):
+      (chunk_id, offset) = struct.unpack_from(">4sQ", self._contents,
+                                              8 + i * 12)
+      chunks[chunk_id] = offset
+    self._fan_out_table = struct.unpack_from(">256L", self._contents,
+                                             chunks[CHUNK_OID_FANOUT])
+    self._name_table_offset = chunks[CHUNK_OID_LOOKUP]
+    self._data_table_offset = chunks[CHUNK_COMMIT_DATA]
+    self._edge_table_offset = chunks.get(CHUNK_EXTRA_EDGES)
+
+  def close(self):
+    """Close this commit-graph, including the layers below it."""
+    self.close_layer()
+    if self.base is not None:
+      self.base.close()
+
+  def close_layer(self):
+    """Close the file of this layer only."""
+    self._file.close()
+
+  def layers(self):
+    """Return the layers of this commit-graph, from the bottom up."""
+    if self.base is None:
+      return [self]
+    return self.base.layers() + [self]
+
+  def layer_size(self):
+    """Return the number of commits in this layer alone."""
+    return self._fan_out_table[-1]
+
+  def get_checksum(self):
+    """Return the checksum of this layer, which also names it."""
+    return str(self._contents[-20:])
+
+  def __len__(self):
+    """Return the number of commits in this commit-graph."""
+    return self._num_base + self.layer_size()
+
+  def __contains__(self, sha):
+    return self._global_position(hex_to_sha(sha)) is not None
+
+  def __iter__(self):
+    if self.base is not None:
+      for sha in self.base:
+        yield sha
+    for i in range(self.layer_size()):
+      yield sha_to_hex(self._unpack_name(i))
+
+  def _global_position(self, sha):
+    """Find the position of a commit in the whole chain of layers."""
+    i = self._position(sha)
+    if i is not None:
+      return self._num_base + i
+    if self.base is not None:
+      return self.base._global_position(sha)
+    return None
+
+  def _name_at(self, position):
+    """Return the binary sha of the commit at a position in the chain."""
+    if position < self._num_base:
+      return self.base._name_at(position)
+    return self._unpack_name(position - self._num_base)
+
+  def _unpack_name(self, i):
+    offset = self._name_table_offset + i * 20
+    return self._contents[offset:offset+20]
+
+  def _position(self, sha):
+    idx = ord(sha[0])
+    if idx == 0:
+      start = 0
+    else:
+      start = self._fan_out_table[idx-1]
+    end = self._fan_out_table[idx]
+    while start < end:
+      i = (start + end) / 2
+      file_sha = self._unpack_name(i)
+      if file_sha < sha:
+        start = i + 1
+      elif file_sha > sha:
+        end = i
+      else:
+        return i
+    return None
+
+  def _unpack_entry(self, i):
+    """Unpack the data of the i-th commit of this layer.
+
+    :return: Tuple with the binary sha of the tree, the positions of the
+        parents in the chain, the generation number and the commit time.
+    """
+    (tree, parent1, parent2, generation, commit_time) = struct.unpack_from(
+        ">20sLLLL", self._contents,
+        self._data_table_offset + i * COMMIT_DATA_SIZE)
+    # The top two bits of the commit time are stored with the generation
+    commit_time |= (generation & 3) << 32
+    generation >>= 2
+    parents = []
+    if parent1 != PARENT_NONE:
+      parents.append(parent1)
+    if parent2 & PARENT_EXTRA_EDGES:
+      offset = self._edge_table_offset + (parent2 & ~PARENT_EXTRA_EDGES) * 4
+      while True:
+        (edge, ) = struct.unpack_from(">L", self._contents, offset)
+        parents.append(edge & ~PARENT_EXTRA_EDGES)
+        if edge & PARENT_EXTRA_EDGES:
+          break
+        offset += 4
+    elif parent2 != PARENT_NONE:
+      parents.append(parent2)
+    return (tree, parents, generation, commit_time)
+
+  def get_entry(self, sha):
+    """Look up a commit.
+
+    :param sha: Hex sha of the commit
+    :return: Tuple with the tree, the parents, the generation number and
+        the commit time of the commit.
+    :raise KeyError: If the commit is not in this commit-graph
+    """
+    i = self._position(hex_to_sha(sha))
+    if i is None:
+      if self.base is not None:
+        return self.base.get_entry(sha)
+      raise KeyError(sha)
+    (tree, parents, generation, commit_time) = self._unpack_entry(i)
+    return (sha_to_hex(tree),
+            [sha_to_hex(self._name_at(p)) for p in parents],
+            generation, commit_time)
+
+  def get_parents(self, sha):
+    return self.get_entry(sha)[1]
+
+  def get_generation(self, sha):
+    return self.get_entry(sha)[2]
+
+  def get_commit_time(self, sha):
+    return self.get_entry(sha)[3]
+
+  def iterentries(self, include_base=True):
+    """Iterate over the commits in this commit-graph.
+
+    Will yield tuples with the sha, tree, parents, generation number and
+    commit time of each commit, layer by layer from the bottom up and in
+    the order of their shas within a layer.
+
+    :param include_base: Whether to include the layers below this one
+    """
+    if include_base and self.base is not None:
+      for entry in self.base.iterentries():
+        yield entry
+    for i in range(self.layer_size()):
+      (tree, parents, generation, commit_time) = self._unpack_entry(i)
+      yield (sha_to_hex(self._unpack_name(i)), sha_to_hex(tree),
+             [sha_to_hex(self._name_at(p)) for p in parents],
+             generation, commit_time)
+
+  def check(self):
+    """Check that the stored checksum matches the actual checksum."""
+    return (hashlib.sha1(self._contents[:-20]).digest() ==
+            str(self._contents[-20:]))
+
+
+def compute_generations(parents, base=None):
+  """Compute the generation numbers of a set of commits.
+
+  :param parents: Dictionary mapping the commits to their parents, which
+      must all be in it as well, or in base.
+  :param base: Optional CommitGraph to look up the generation numbers of
+      parents that are not in parents in
+  :return: Dictionary mapping the commits to their generation numbers
+  """
+  generations = {}
+  if base is not None:
+    for sha_parents in parents.itervalues():
+      for p in sha_parents:
+        if p not in parents:
+          generations[p] = base.get_generation(p)
+  for sha in parents:
+    todo = [sha]
+    while todo:
+      sha = todo[-1]
+      if sha in generations:
+        todo.pop()
+        continue
+      pending = [p for p in parents[sha] if p not in generations]
+      if pending:
+        todo.extend(pending)
+        continue
+      todo.pop()
+      generation = 1
+      for p in parents[sha]:
+        generation = max(generation, generations[p] + 1)
+      generations[sha] = min(generation, GENERATION_NUMBER_MAX)
+  return dict((sha, generations[sha]) for sha in parents)
+
+
+def write_commit_graph(filename, entries, base=None):
+  """Write a new commit-graph file.
+
+  :param filename: The filename of the new commit-graph file.
+  :param entries: Dictionary mapping the hex shas of the commits to tuples
+      with their tree, parents and commit time. The parents of every commit
+      must be in it as well, or in base.
+  :param base: Optional CommitGraph to write the file as a new layer on
+      top of. entries should not contain commits that are in it.
+  :return: The checksum of the file
+  """
+  shas = sorted(hex_to_sha(sha) for sha in entries)
+  if base is None:
+    num_base = 0
+  else:
+    num_base = len(base)
+  positions = dict((sha_to_hex(sha), num_base + i)
+                   for (i, sha) in enumerate(shas))
+  def get_position(sha):
+    try:
+      return positions[sha]
+    except KeyError:
+      position = base._global_position(hex_to_sha(sha))
+      if position is None:
+        raise KeyError(sha)
+      return position
+  generations = compute_generations(
+      dict((sha, entry[1]) for (sha, entry) in entries.iteritems()), base)
+  fan_out_table = [0] * 0x100
+  for sha in shas:
+    fan_out_table[ord(sha[0])] += 1
+  for i in range(1, 0x100):
+    fan_out_table[i] += fan_out_table[i-1]
+  data = []
+  edges = []
+  for sha in shas:
+    hexsha = sha_to_hex(sha)
+    (tree, parents, commit_time) = entries[hexsha]
+    parents = [get_position(p) for p in parents]
+    if len(parents) == 0:
+      parent1 = parent2 = PARENT_NONE
+    elif len(parents) == 1:
+      parent1, parent2 = parents[0], PARENT_NONE
+    elif len(parents) == 2:
+      parent1, parent2 = parents
+    else:
+      parent1 = parents[0]
+      parent2 = PARENT_EXTRA_EDGES | len(edges)
+      edges.extend(parents[1:])
+      edges[-1] |= PARENT_EXTRA_EDGES
+    data.append(struct.pack(">20sLLLL", hex_to_sha(tree), parent1, parent2,
+        (generations[hexsha] << 2) | ((commit_time >> 32) & 3),
+        commit_time & 0xFFFFFFFF))
+  chunks = [(CHUNK_OID_FANOUT, struct.pack(">256L", *fan_out_table)),
+            (CHUNK_OID_LOOKUP, "".join(shas)),
+            (CHUNK_COMMIT_DATA, "".join(data))]
+  if edges:
+    chunks.append((CHUNK_EXTRA_EDGES,
+                   struct.pack(">%dL" % len(edges), *edges)))
+  if base is None:
+    base_layers = []
+  else:
+    base_layers = base.layers()
+    chunks.append((CHUNK_BASE_GRAPHS,
+                   "".join(layer.get_checksum() for layer in base_layers)))
+  f = SHA1Writer(open(filename, 'wb'))
+  f.write(struct.pack(">4sBBBB", COMMIT_GRAPH_SIGNATURE,
+      COMMIT_GRAPH_VERSION, COMMIT_GRAPH_HASH_VERSION, len(chunks),
+      len(base_layers)))
+  # The table of contents ends with an entry pointing at the end of the
+  # last chunk
+  offset = 8 + (len(chunks) + 1) * 12
+  for (chunk_id, chunk) in chunks:
+    f.write(struct.pack(">4sQ", chunk_id, offset))
+    offset += len(chunk)
+  f.write(struct.pack(">4sQ", "\0\0\0\0", offset))
+  for (chunk_id, chunk) in chunks:
+    f.write(chunk)
+  return f.close()
@@ -16,37 +16,199 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA  02110-1301, USA.
 
+from commit_graph import (
+        CommitGraph,
+        write_commit_graph,
+        )
 from objects import (
+        Commit,
         ShaFile,
         hex_to_sha,
+        read_loose_object_chunks,
+        sha_to_hex,
         )
+import errno
 import os, tempfile
 from pack import (
+        SHA1Writer,
+        complete_thin_pack,
         iter_sha1, 
         load_packs, 
+        pack_object_header,
+        write_pack_data,
         write_pack_index_v2,
+        Pack,
         PackData, 
+        PackReceiver,
         )
+import sha
+import struct
 import tempfile
-import urllib2
+import zlib
 PACKDIR = 'pack'
+COMMIT_GRAPH = os.path.join('info', 'commit-graph')
+COMMIT_GRAPHS_DIR = os.path.join('info', 'commit-graphs')
+COMMIT_GRAPH_CHAIN = os.path.join(COMMIT_GRAPHS_DIR, 'commit-graph-chain')
 
 class ObjectStore(object):
 
+    # add_objects() writes sets of objects no larger than these limits 
+    # as loose objects rather than as a new pack
+    max_loose_objects = 100
+    max_loose_size = 1024 * 1024
+
     def __init__(self, path):
         self.path = path
         self._packs = None
+        self._commit_graph = None
+        self._commit_graph_loaded = False
 
     def pack_dir(self):
         return os.path.join(self.path, PACKDIR)
 
-    def __contains__(self, sha):
-        # TODO: This can be more efficient
+    def commit_graph_path(self):
+        return os.path.join(self.path, COMMIT_GRAPH)
+
+    def commit_graph_chain_path(self):
+        return os.path.join(self.path, COMMIT_GRAPH_CHAIN)
+
+    def _commit_graph_layer_path(self, checksum):
+        return os.path.join(self.path, COMMIT_GRAPHS_DIR, 
+                            "graph-%s.graph" % sha_to_hex(checksum))
+
+    def _load_commit_graph_chain(self):
+        f = open(self.commit_graph_chain_path(), 'r')
         try:
-            self[sha]
-            return True
-        except KeyError:
-            return False
+            names = f.read().split()
+        finally:
+            f.close()
+        graph = None
+        for name in names:
+            graph = CommitGraph(self._commit_graph_layer_path(
+                hex_to_sha(name)), graph)
+        return graph
+
+    @property
+    def commit_graph(self):
+        """The commit-graph of this object store, None if it has none."""
+        if not self._commit_graph_loaded:
+            if os.path.exists(self.commit_graph_chain_path()):
+                self._commit_graph = self._load_commit_graph_chain()
+            elif os.path.exists(self.commit_graph_path()):
+                self._commit_graph = CommitGraph(self.commit_graph_path())
+            self._commit_graph_loaded = True
+        return self._commit_graph
+
+    def add_to_commit_graph(self, shas):
+        """Add commits and their ancestors to the commit-graph.
+
+        Only commits that aren't in the commit-graph yet are read, so this 
+        is cheap to call after every fetch. The commit-graph is created if 
+        it doesn't exist yet. Commits with ancestors that are missing, as 
+        in shallow clones, are left out.
+
+        The new commits are written as a new layer of a split commit-graph. 
+        Layers on top that are not more than twice as large as the new 
+        layer are merged into it, so that the number of layers stays 
+        logarithmic in the number of commits.
+
+        :param shas: Hex shas of the commits to add; shas of other objects 
+            are ignored.
+        """
+        graph = self.commit_graph
+        entries = {}
+        missing = set()
+        todo = list(shas)
+        while todo:
+            sha = todo.pop()
+            if sha in entries or sha in missing or (graph is not None and 
+                                                    sha in graph):
+                continue
+            try:
+                obj = self[sha]
+            except KeyError:
+                missing.add(sha)
+                continue
+            if obj._type != Commit._type:
+                continue
+            entries[sha] = (obj.tree, obj.parents, obj.commit_time)
+            todo.extend(obj.parents)
+        if missing:
+            children = {}
+            for sha, (tree, parents, commit_time) in entries.iteritems():
+                for parent in parents:
+                    children.setdefault(parent, []).append(sha)
+            todo = list(missing)
+            while todo:
+                for child in children.get(todo.pop(), []):
+                    if child in entries:
+                        del entries[child]
+                        todo.append(child)
+        if not entries:
+            return
+        graphs_dir = os.path.join(self.path, COMMIT_GRAPHS_DIR)
+        for d in (os.path.dirname(graphs_dir), graphs_dir):
+            try:
+                os.mkdir(d)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        if graph is not None and graph.base is None and \
+                not os.path.exists(self.commit_graph_chain_path()):
+            # Move a commit-graph that isn't split into the chain, 
+            # as its bottom layer
+            layer_path = self._commit_graph_layer_path(graph.get_checksum())
+            graph.close()
+            os.rename(self.commit_graph_path(), layer_path)
+            graph = CommitGraph(layer_path)
+        if graph is None:
+            layers = []
+        else:
+            layers = graph.layers()
+        merged = []
+        while layers and 2 * len(entries) >= layers[-1].layer_size():
+            layer = layers.pop()
+            for sha, tree, parents, generation, commit_time in \
+                    layer.iterentries(include_base=False):
+                entries[sha] = (tree, parents, commit_time)
+            merged.append(layer)
+        if layers:
+            base = layers[-1]
+        else:
+            base = None
+        fd, path = tempfile.mkstemp(dir=graphs_dir, prefix="tmp_graph_")
+        os.close(fd)
+        try:
+            checksum = write_commit_graph(path, entries, base)
+            layer_path = self._commit_graph_layer_path(checksum)
+            os.rename(path, layer_path)
+        except:
+            os.remove(path)
+            raise
+        fd, path = tempfile.mkstemp(dir=graphs_dir, prefix="tmp_chain_")
+        f = os.fdopen(fd, 'w')
+        try:
+            try:
+                for layer in layers:
+                    f.write("%s\n" % sha_to_hex(layer.get_checksum()))
+                f.write("%s\n" % sha_to_hex(checksum))
+            finally:
+                f.close()
+            os.rename(path, self.commit_graph_chain_path())
+        except:
+            os.remove(path)
+            raise
+        for layer in merged:
+            merged_path = self._commit_graph_layer_path(layer.get_checksum())
+            layer.close_layer()
+            os.remove(merged_path)
+        self._commit_graph = CommitGraph(layer_path, base)
+
+    def __contains__(self, sha):
+        for pack in self.packs:
+            if sha in pack:
+                return True
+        return os.path.exists(self._get_shafile_path(sha))
 
     @property
     def packs(self):
@@ -55,11 +217,14 @@ class ObjectStore(object):
             self._packs = list(load_packs(self.pack_dir()))
         return self._packs
 
-    def _get_shafile(self, sha):
+    def _get_shafile_path(self, sha):
         dir = sha[:2]
         file = sha[2:]
         # Check from object dir
-        path = os.path.join(self.path, dir, file)
+        return os.path.join(self.path, dir, file)
+
+    def _get_shafile(self, sha):
+        path = self._get_shafile_path(sha)
         if os.path.exists(path):
           return ShaFile.from_file(path)
         return None
@@ -70,6 +235,8 @@ class ObjectStore(object):
         :param sha: Sha for the object.
         :return: tuple with object type and object contents.
         """
+        if len(sha) == 20:
+            sha = sha_to_hex(sha)
         for pack in self.packs:
             if sha in pack:
                 return pack.get_raw(sha, self.get_raw)
@@ -79,6 +246,100 @@ class ObjectStore(object):
             return ret.as_raw_string()
         raise KeyError(sha)
 
+    def get_raw_many(self, shas, ordered=False):
+        """Obtain the raw text for several objects.
+
+        Objects are grouped by the pack they live in and read in the order 
+        in which they appear in that pack, sharing a cache of delta bases. 
+        This avoids seeking back and forth through the packs.
+
+        :param shas: Iterable over the shas of the objects to retrieve.
+        :param ordered: Whether to return the objects in the order in which 
+            they were requested. This may require keeping objects that 
+            were read early in memory until they can be returned.
+        :return: Iterator over (sha, type, contents) tuples.
+        """
+        unique_shas = []
+        seen = set()
+        for sha in shas:
+            if not sha in seen:
+                seen.add(sha)
+                unique_shas.append(sha)
+        shas = unique_shas
+        results = self._iter_raw_many(shas)
+        if not ordered:
+            return results
+        return self._iter_in_order(shas, results)
+
+    def _iter_raw_many(self, shas):
+        packs = self.packs
+        by_pack = [[] for pack in packs]
+        loose = []
+        for sha in shas:
+            for i, pack in enumerate(packs):
+                if sha in pack:
+                    by_pack[i].append(sha)
+                    break
+            else:
+                loose.append(sha)
+        for pack, pack_shas in zip(packs, by_pack):
+            for ret in pack.get_raw_many(pack_shas, self.get_raw):
+                yield ret
+        for sha in loose:
+            type, text = self.get_raw(sha)
+            yield sha, type, text
+
+    def _iter_in_order(self, shas, results):
+        pending = {}
+        i = 0
+        for sha, type, text in results:
+            pending[sha] = (type, text)
+            while i < len(shas) and shas[i] in pending:
+                type, text = pending.pop(shas[i])
+                yield shas[i], type, text
+                i += 1
+
+    def iter_objects(self, shas, ordered=False):
+        """Retrieve several objects, in pack order.
+
+        :param shas: Iterable over the shas of the objects to retrieve.
+        :param ordered: Whether to return the objects in the order in which 
+            they were requested.
+        :return: Iterator over ShaFile objects.
+        :seealso: get_raw_many
+        """
+        for sha, type, text in self.get_raw_many(shas, ordered):
+            yield ShaFile.from_raw_string(type, text)
+
+    def get_object_size(self, sha):
+        """Find the size of the contents of an object without reading it.
+
+        :param sha: Sha for the object.
+        :return: Size of the object contents.
+        """
+        for pack in self.packs:
+            if sha in pack:
+                return pack.get_object_size(sha)
+        path = self._get_shafile_path(sha)
+        if os.path.exists(path):
+            return read_loose_object_chunks(path)[1]
+        raise KeyError(sha)
+
+    def get_raw_chunks(self, sha):
+        """Obtain the raw text for an object, without reading it all at once.
+
+        :param sha: Sha for the object.
+        :return: tuple with object type, size of the object contents and 
+            an iterator over chunks of the object contents.
+        """
+        for pack in self.packs:
+            if sha in pack:
+                return pack.get_raw_chunks(sha, self.get_raw)
+        path = self._get_shafile_path(sha)
+        if os.path.exists(path):
+            return read_loose_object_chunks(path)
+        raise KeyError(sha)
+
     def __getitem__(self, sha):
         assert len(sha) == 40, "Incorrect length sha: %s" % str(sha)
         ret = self._get_shafile(sha)
@@ -88,22 +349,36 @@ class ObjectStore(object):
         type, uncomp = self.get_raw(sha)
         return ShaFile.from_raw_string(type, uncomp)
 
+    def _move_in_indexed_pack(self, path, entries, pack_checksum):
+        """Move a pack whose entries are known into the pack directory.
+
+        :param entries: List with (name, offset, crc32 checksum) entries
+        :return: The new pack
+        """
+        entries = sorted(entries)
+        basename = os.path.join(self.pack_dir(), 
+            "pack-%s" % iter_sha1(entry[0] for entry in entries))
+        write_pack_index_v2(basename+".idx", entries, pack_checksum)
+        os.rename(path, basename + ".pack")
+        ret = Pack(basename)
+        if self._packs is not None:
+            self._packs.append(ret)
+        return ret
+
     def move_in_thin_pack(self, path):
-        """Move a specific file containing a pack into the pack directory.
+        """Move a specific file containing a thin pack into the pack directory.
+
+        The delta bases that are missing from the pack are appended to it 
+        from this object store, so the entries that are in the pack are not 
+        rewritten.
 
         :note: The file should be on the same file system as the 
             packs directory.
 
         :param path: Path to the pack file.
         """
-        p = PackData(path)
-        temppath = os.path.join(self.pack_dir(), sha_to_hex(urllib2.randombytes(20))+".temppack")
-        write_pack(temppath, p.iterobjects(self.get_raw), len(p))
-        pack_sha = PackIndex(temppath+".idx").objects_sha1()
-        os.rename(temppath+".pack", 
-            os.path.join(self.pack_dir(), "pack-%s.pack" % pack_sha))
-        os.rename(temppath+".idx", 
-            os.path.join(self.pack_dir(), "pack-%s.idx" % pack_sha))
+        entries, pack_checksum = complete_thin_pack(path, self.get_raw)
+        self._move_in_indexed_pack(path, entries, pack_checksum)
 
     def move_in_pack(self, path):
         """Move a specific file containing a pack into the pack directory.
@@ -114,23 +389,26 @@ class ObjectStore(object):
         :param path: Path to the pack file.
         """
         p = PackData(path)
-        entries = p.sorted_entries()
-        basename = os.path.join(self.pack_dir(), 
-            "pack-%s" % iter_sha1(entry[0] for entry in entries))
-        write_pack_index_v2(basename+".idx", entries, p.calculate_checksum())
-        os.rename(path, basename + ".pack")
+        self._move_in_indexed_pack(path, p.sorted_entries(), 
+                                   p.calculate_checksum())
 
     def add_thin_pack(self):
         """Add a new thin pack to this object store.
 
         Thin packs are packs that contain deltas with parents that exist 
-        in a different pack.
+        in a different pack. The pack is indexed while it is written, 
+        and the missing bases are appended to it when it is closed.
+
+        :return: PackReceiver to write the pack to and a commit function 
+            to call once it has been closed.
         """
         fd, path = tempfile.mkstemp(dir=self.pack_dir(), suffix=".pack")
-        f = os.fdopen(fd, 'w')
+        f = PackReceiver(os.fdopen(fd, 'w+b'), self.get_raw, fix_thin=True)
         def commit():
-            if os.path.getsize(path) > 0:
-                self.move_in_thin_pack(path)
+            if f.entries is None:
+                os.remove(path)
+            else:
+                self._move_in_indexed_pack(path, f.entries, f.pack_checksum)
         return f, commit
 
     def add_pack(self):
@@ -146,9 +424,175 @@ class ObjectStore(object):
                 self.move_in_pack(path)
         return f, commit
 
+    def _plan_copy(self, source, shas):
+        """Find the entries to copy from another object store.
+
+        Deltas are copied as they are, so their bases are copied too, 
+        before them, even if they were not requested. An object that is 
+        in several packs of source is only copied once.
+
+        :return: List of (pack index, offset) tuples in the order in which 
+            they should be written, with pack index None and offset the hex 
+            sha for loose objects
+        """
+        packs = source.packs
+        def locate(sha):
+            for i, pack in enumerate(packs):
+                offset = pack.idx.object_index(sha)
+                if offset is not None:
+                    return (i, offset)
+            if not os.path.exists(source._get_shafile_path(sha)):
+                raise KeyError(sha)
+            return (None, sha)
+        def get_name(key):
+            (i, offset) = key
+            if i is None:
+                return hex_to_sha(offset)
+            return packs[i].get_name_at(offset)
+        # Binary SHA1s of the planned objects
+        planned = set()
+        order = []
+        for sha in shas:
+            chain = []
+            key = locate(sha)
+            name = get_name(key)
+            while name not in planned:
+                chain.append(key)
+                planned.add(name)
+                (i, offset) = key
+                if i is None:
+                    break
+                (type, size, base, header_len) = \
+                        packs[i].data.get_stored_header_at(offset)
+                if type == 6: # offset delta
+                    key = (i, base)
+                    name = get_name(key)
+                elif type == 7: # ref delta
+                    base_offset = packs[i].idx.object_index(base)
+                    if base_offset is not None:
+                        key = (i, base_offset)
+                    else:
+                        key = locate(sha_to_hex(base))
+                    name = base
+                else:
+                    break
+            chain.reverse()
+            order.extend(chain)
+        return order
+
+    def add_pack_from_store(self, source, shas, progress=None):
+        """Copy objects from another object store into a new pack.
+
+        Objects from the packs of source are copied in their stored, 
+        compressed form, deltas included, so nothing has to be inflated or 
+        deflated. Only loose objects are compressed again.
+
+        :param source: ObjectStore to copy from
+        :param shas: Hex shas of the objects to copy
+        :param progress: Optional progress function
+        :return: The new pack, or None if there were no objects to copy
+        """
+        if progress is None:
+            progress = lambda message: None
+        order = self._plan_copy(source, shas)
+        if not order:
+            return None
+        fd, path = tempfile.mkstemp(dir=self.pack_dir(), suffix=".pack")
+        f = SHA1Writer(os.fdopen(fd, 'wb'))
+        try:
+            f.write("PACK")                   # Pack header
+            f.write(struct.pack(">L", 2))     # Pack version
+            f.write(struct.pack(">L", len(order))) # Number of objects
+            # Binary SHA1 -> offset in the new pack
+            new_offsets = {}
+            entries = []
+            offset = 12
+            for n, key in enumerate(order):
+                (i, source_offset) = key
+                if i is None:
+                    (type, raw) = source.get_raw(source_offset)
+                    name = hex_to_sha(source_offset)
+                    data = (pack_object_header(type, len(raw)) + 
+                            zlib.compress(raw))
+                else:
+                    (name, type, size, base, data) = \
+                            source.packs[i].get_stored_entry_at(source_offset)
+                    if type == 6: # offset delta
+                        # The base may have been copied from another pack
+                        base = offset - new_offsets[
+                            source.packs[i].get_name_at(base)]
+                    data = pack_object_header(type, size, base) + data
+                new_offsets[name] = offset
+                entries.append((name, offset, zlib.crc32(data)))
+                f.write(data)
+                offset += len(data)
+                if n % 1000 == 0:
+                    progress("copying objects: %d/%d\r" % (n, len(order)))
+            progress("copying objects: %d, done.\n" % len(order))
+            pack_checksum = f.close()
+        except:
+            f.f.close()
+            os.remove(path)
+            raise
+        return self._move_in_indexed_pack(path, entries, pack_checksum)
+
+    def add_object(self, obj):
+        """Add a single object to this object store as a loose object.
+
+        The object is hashed and deflated in a single pass and moved into 
+        place atomically once it has been written completely.
+
+        :param obj: Object to add.
+        :return: Hex SHA1 of the object.
+        """
+        header = "%s %lu\0" % (obj._type, obj.raw_length())
+        fd, path = tempfile.mkstemp(dir=self.path, prefix="tmp_obj_")
+        f = os.fdopen(fd, 'wb')
+        try:
+            try:
+                sha1 = sha.new(header)
+                compressor = zlib.compressobj()
+                f.write(compressor.compress(header))
+                for chunk in obj.as_raw_chunks():
+                    sha1.update(chunk)
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+            finally:
+                f.close()
+        except:
+            os.remove(path)
+            raise
+        hexsha = sha1.hexdigest()
+        target = self._get_shafile_path(hexsha)
+        if os.path.exists(target):
+            os.remove(path)
+            return hexsha
+        try:
+            os.mkdir(os.path.dirname(target))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        os.chmod(path, 0444)
+        os.rename(path, target)
+        return hexsha
+
     def add_objects(self, objects):
+        """Add a set of objects to this object store.
+
+        Small sets of objects are written as loose objects, larger ones as 
+        a new pack, so that adding a few objects at a time does not lead 
+        to lots of tiny packs.
+
+        :param objects: List of objects to add.
+        """
         if len(objects) == 0:
             return
+        if (len(objects) <= self.max_loose_objects and 
+            sum([o.raw_length() for o in objects]) <= self.max_loose_size):
+            for o in objects:
+                self.add_object(o)
+            return
         f, commit = self.add_pack()
         write_pack_data(f, objects, len(objects))
+        f.close()
         commit()
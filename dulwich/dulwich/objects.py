@@ -41,12 +41,98 @@ OBJECT_ID = "object"
 TYPE_ID = "type"
 TAGGER_ID = "tagger"
 
+CHUNK_SIZE = 64 * 1024
+
 def _decompress(string):
     dcomp = zlib.decompressobj()
     dcomped = dcomp.decompress(string)
     dcomped += dcomp.flush()
     return dcomped
 
+def iter_inflate(read, dcomp=None, chunk_size=CHUNK_SIZE):
+  """Incrementally inflate a zlib stream.
+
+  :param read: Function to read compressed data, called with a size.
+  :param dcomp: Decompression object to use, a new one is created if None.
+  :param chunk_size: Maximum size of the inflated chunks to yield.
+  :return: Iterator over chunks of inflated data.
+  """
+  if dcomp is None:
+    dcomp = zlib.decompressobj()
+  while dcomp.unused_data == "":
+    pending = read(chunk_size)
+    if not pending:
+      break
+    while pending:
+      chunk = dcomp.decompress(pending, chunk_size)
+      pending = dcomp.unconsumed_tail
+      if chunk:
+        yield chunk
+  chunk = dcomp.flush()
+  if chunk:
+    yield chunk
+
+
+def read_loose_object_chunks(filename, chunk_size=CHUNK_SIZE):
+  """Open a loose object on disk for incremental reading.
+
+  Only the object header is inflated up front; the contents are inflated
+  as the returned iterator is consumed.
+
+  :param filename: Path to the loose object.
+  :param chunk_size: Maximum size of the chunks to yield.
+  :return: Tuple with the numeric object type, the size of the object
+      contents and an iterator over chunks of the contents.
+  """
+  f = open(filename, 'rb')
+  try:
+    start = f.read(2)
+    word = (ord(start[0]) << 8) + ord(start[1])
+    if ord(start[0]) == 0x78 and (word % 31) == 0:
+      # Legacy object, the header is part of the deflated stream
+      pending = [start]
+      def read(size):
+        if pending:
+          return pending.pop()
+        return f.read(size)
+      inflated = iter_inflate(read, chunk_size=chunk_size)
+      header = ""
+      while not "\0" in header:
+        header += inflated.next()
+      header, text = header.split("\0", 1)
+      type_name, size = header.split(" ", 1)
+      num_type = type_map[type_name]._num_type
+      size = int(size)
+    else:
+      byte = ord(start[0])
+      num_type = (byte >> 4) & 7
+      size = byte & 0x0f
+      shift = 4
+      pending = [start[1]]
+      while (byte & 0x80) != 0:
+        byte = ord(pending and pending.pop() or f.read(1))
+        size += (byte & 0x7f) << shift
+        shift += 7
+      def read(size):
+        if pending:
+          return pending.pop()
+        return f.read(size)
+      inflated = iter_inflate(read, chunk_size=chunk_size)
+      text = ""
+  except:
+    f.close()
+    raise
+  def iter_chunks():
+    try:
+      if text:
+        yield text
+      for chunk in inflated:
+        yield chunk
+    finally:
+      f.close()
+  return num_type, size, iter_chunks()
+
+
 def sha_to_hex(sha):
   """Takes a string and returns the hex of the sha within"""
   hexsha = ''
@@ -97,6 +183,14 @@ class ShaFile(object):
   def as_raw_string(self):
     return self._num_type, self._text
 
+  def as_raw_chunks(self):
+    """Return an iterator over chunks of the contents of this object."""
+    return iter([self._text])
+
+  def raw_length(self):
+    """Return the length of the contents of this object."""
+    return len(self._text)
+
   @classmethod
   def _parse_object(cls, map):
     """Parse a new style object , creating it and setting object._text"""
@@ -191,11 +285,57 @@ class Blob(ShaFile):
   _type = BLOB_ID
   _num_type = 3
 
+  def __init__(self):
+    self._text = None
+    self._get_chunks = None
+
   @property
   def data(self):
     """The text contained within the blob object."""
+    if self._text is None:
+      self._text = "".join(self._get_chunks())
     return self._text
 
+  @property
+  def size(self):
+    """The size of the text contained within the blob object."""
+    if self._text is None:
+      return self._size
+    return len(self._text)
+
+  def iter_chunks(self, chunk_size=CHUNK_SIZE):
+    """Iterate over the text contained within the blob object.
+
+    For blobs created with from_chunk_source() this does not require the 
+    full text to be in memory.
+    """
+    if self._text is None:
+      return self._get_chunks()
+    return (self._text[i:i+chunk_size] 
+            for i in xrange(0, len(self._text), chunk_size))
+
+  def sha(self):
+    """The SHA1 object that is the name of this object."""
+    if self._text is not None:
+      return ShaFile.sha(self)
+    ressha = sha.new()
+    ressha.update("%s %lu\0" % (self._type, self._size))
+    for chunk in self._get_chunks():
+      ressha.update(chunk)
+    return ressha
+
+  def crc32(self):
+    return zlib.crc32(self.data)
+
+  def as_raw_string(self):
+    return self._num_type, self.data
+
+  def as_raw_chunks(self):
+    return self.iter_chunks()
+
+  def raw_length(self):
+    return self.size
+
   @classmethod
   def from_file(cls, filename):
     blob = ShaFile.from_file(filename)
@@ -210,11 +350,25 @@ class Blob(ShaFile):
     shafile._text = string
     return shafile
 
+  @classmethod
+  def from_chunk_source(cls, size, get_chunks):
+    """Create a blob whose text is only read when it is accessed.
+
+    :param size: Size of the text of the blob.
+    :param get_chunks: Function that returns a new iterator over the 
+        text of the blob each time it is called.
+    """
+    shafile = cls()
+    shafile._size = size
+    shafile._get_chunks = get_chunks
+    return shafile
+
 
 class Tag(ShaFile):
   """A Git Tag object."""
 
   _type = TAG_ID
+  _num_type = 4
 
   @classmethod
   def from_file(cls, filename):
@@ -33,20 +33,29 @@ match for the object name. You then use the pointer got from this as
 a pointer in to the corresponding packfile.
 """
 
-from collections import defaultdict
+import array
+import bisect
+from collections import defaultdict, deque
+from cStringIO import StringIO
 import hashlib
 from itertools import imap, izip
 import mmap
 import os
+from Queue import Empty, Full, Queue
 import sha
 import struct
 import sys
+import tempfile
+import threading
 import zlib
 import difflib
 
 from objects import (
+        CHUNK_SIZE,
         ShaFile,
         hex_to_sha,
+        iter_inflate,
+        num_type_map,
         sha_to_hex,
         )
 from errors import ApplyDeltaError
@@ -86,6 +95,27 @@ def iter_sha1(iter):
 
 MAX_MMAP_SIZE = 256 * 1024 * 1024
 
+
+class ArraySkipper(object):
+    """Present a view of a buffer that starts at a particular offset."""
+
+    def __init__(self, array, offset):
+        self.array = array
+        self.offset = offset
+
+    def __getslice__(self, i, j):
+        return self.array[i+self.offset:j+self.offset]
+
+    def __getitem__(self, i):
+        return self.array[i+self.offset]
+
+    def __len__(self):
+        return len(self.array) - self.offset
+
+    def __str__(self):
+        return str(self.array[self.offset:])
+
+
 def simple_mmap(f, offset, size, access=mmap.ACCESS_READ):
     """Simple wrapper for mmap() which always supports the offset parameter.
 
@@ -99,30 +129,50 @@ def simple_mmap(f, offset, size, access=mmap.ACCESS_READ):
         raise AssertionError("%s is larger than 256 meg, and this version "
             "of Python does not support the offset argument to mmap().")
     if supports_mmap_offset:
-        return mmap.mmap(f.fileno(), size, access=access, offset=offset)
+        # mmap() only accepts offsets that are a multiple of the 
+        # allocation granularity
+        skip = offset % mmap.ALLOCATIONGRANULARITY
+        mem = mmap.mmap(f.fileno(), size+skip, access=access, 
+                        offset=offset-skip)
     else:
-        class ArraySkipper(object):
+        skip = offset
+        mem = mmap.mmap(f.fileno(), size+offset, access=access)
+    if skip == 0:
+        return mem
+    return ArraySkipper(mem, skip)
 
-            def __init__(self, array, offset):
-                self.array = array
-                self.offset = offset
 
-            def __getslice__(self, i, j):
-                return self.array[i+self.offset:j+self.offset]
+DELTA_BASE_CACHE_SIZE = 16 * 1024 * 1024
 
-            def __getitem__(self, i):
-                return self.array[i+self.offset]
+class DeltaBaseCache(object):
+    """Cache of recently resolved pack objects, by offset.
 
-            def __len__(self):
-                return len(self.array) - self.offset
+    Objects are evicted in the order they were added once the total size 
+    of the cached texts exceeds max_size. This works well when reading 
+    objects in pack order, as delta bases usually precede their deltas.
+    """
 
-            def __str__(self):
-                return str(self.array[self.offset:])
+    def __init__(self, max_size=DELTA_BASE_CACHE_SIZE):
+        self.max_size = max_size
+        self._size = 0
+        self._objects = {}
+        self._order = deque()
 
-        mem = mmap.mmap(f.fileno(), size+offset, access=access)
-        if offset == 0:
-            return mem
-        return ArraySkipper(mem, offset)
+    def __getitem__(self, offset):
+        return self._objects[offset]
+
+    def __contains__(self, offset):
+        return offset in self._objects
+
+    def add(self, offset, type, text):
+        if offset in self._objects or len(text) > self.max_size:
+            return
+        self._objects[offset] = (type, text)
+        self._order.append(offset)
+        self._size += len(text)
+        while self._size > self.max_size:
+            (_, old_text) = self._objects.pop(self._order.popleft())
+            self._size -= len(old_text)
 
 
 def resolve_object(offset, type, obj, get_ref, get_offset):
@@ -325,13 +375,44 @@ def read_pack_tail(f):
     return (f.read(20),)
 
 
-def unpack_object(map):
+def unpack_object_header(map):
+    """Parse the header of an object in a pack.
+
+    :param map: Buffer starting at the object.
+    :return: Tuple with the object type, the uncompressed size and the 
+        length of the header.
+    """
     bytes = take_msb_bytes(map, 0)
     type = (bytes[0] >> 4) & 0x07
     size = bytes[0] & 0x0f
     for i, byte in enumerate(bytes[1:]):
       size += (byte & 0x7f) << ((i * 7) + 4)
-    raw_base = len(bytes)
+    return type, size, len(bytes)
+
+
+def iter_zlib(data, offset, dec_size, chunk_size=CHUNK_SIZE):
+    """Incrementally inflate a zlib stream stored in a buffer.
+
+    :param data: Buffer (string or mmap) containing the compressed data.
+    :param offset: Offset of the zlib stream in data.
+    :param dec_size: Expected size of the inflated data.
+    :param chunk_size: Maximum size of the chunks to yield.
+    :return: Iterator over chunks of inflated data.
+    """
+    fed = [offset]
+    def read(size):
+        ret = data[fed[0]:fed[0]+size]
+        fed[0] += len(ret)
+        return ret
+    total = 0
+    for chunk in iter_inflate(read, chunk_size=chunk_size):
+        total += len(chunk)
+        yield chunk
+    assert total == dec_size, "%d vs %d" % (total, dec_size)
+
+
+def unpack_object(map):
+    type, size, raw_base = unpack_object_header(map)
     if type == 6: # offset delta
         bytes = take_msb_bytes(map, raw_base)
         assert not (bytes[-1] & 0x80)
@@ -397,6 +478,21 @@ class PackData(object):
     self._header_size = 12
     assert self._size >= self._header_size, "%s is too small for a packfile" % filename
     self._read_header()
+    self._map = None
+
+  def _get_map(self):
+    if self._map is None:
+      f = open(self._filename, 'rb')
+      try:
+        self._map = simple_mmap(f, 0, self._size)
+      finally:
+        f.close()
+    return self._map
+
+  def close(self):
+    if self._map is not None:
+      self._map.close()
+      self._map = None
 
   def _read_header(self):
     f = open(self._filename, 'rb')
@@ -422,13 +518,11 @@ class PackData(object):
 
   def iterobjects(self):
     offset = self._header_size
-    f = open(self._filename, 'rb')
+    map = self._get_map()
     for i in range(len(self)):
-        map = simple_mmap(f, offset, self._size-offset)
-        (type, obj, total_size) = unpack_object(map)
+        (type, obj, total_size) = unpack_object(ArraySkipper(map, offset))
         yield offset, type, obj
         offset += total_size
-    f.close()
 
   def iterentries(self, ext_resolve_ref=None):
     found = {}
@@ -463,7 +557,7 @@ class PackData(object):
         sha = shafile.sha().digest()
         found[sha] = (type, obj)
         yield sha, offset, shafile.crc32()
-        todo += postponed.get(sha, [])
+        todo += postponed.pop(sha, [])
     if postponed:
         raise KeyError([sha_to_hex(h) for h in postponed.keys()])
 
@@ -499,12 +593,96 @@ class PackData(object):
     size = os.path.getsize(self._filename)
     assert size == self._size, "Pack data %s has changed size, I don't " \
          "like that" % self._filename
-    f = open(self._filename, 'rb')
-    try:
-      map = simple_mmap(f, offset, size-offset)
-      return unpack_object(map)[:2]
-    finally:
-      f.close()
+    return unpack_object(ArraySkipper(self._get_map(), offset))[:2]
+
+  def get_object_chunks_at(self, offset, chunk_size=CHUNK_SIZE):
+    """Incrementally read the object at a particular offset.
+
+    Only objects that are stored in full can be read incrementally; deltas 
+    have to be resolved against their base in memory.
+
+    :return: Tuple with the object type, the uncompressed size and an 
+        iterator over chunks of the object contents, or None if the 
+        object at offset is a delta.
+    """
+    assert offset >= self._header_size
+    map = ArraySkipper(self._get_map(), offset)
+    type, size, header_len = unpack_object_header(map)
+    if type in (6, 7):
+      return None
+    return type, size, iter_zlib(map, header_len, size, chunk_size)
+
+
+  def get_stored_header_at(self, offset):
+    """Parse the header of the object at a particular offset.
+
+    :return: Tuple with the object type, the uncompressed size, the 
+        delta base and the length of the header. The delta base is the 
+        offset of the base for offset deltas, the binary SHA1 of the base 
+        for ref deltas and None for other objects.
+    """
+    assert offset >= self._header_size
+    map = ArraySkipper(self._get_map(), offset)
+    type, size, header_len = unpack_object_header(map)
+    base = None
+    if type == 6: # offset delta
+      bytes = take_msb_bytes(map, header_len)
+      delta_base_offset = bytes[0] & 0x7f
+      for byte in bytes[1:]:
+        delta_base_offset += 1
+        delta_base_offset <<= 7
+        delta_base_offset += (byte & 0x7f)
+      base = offset - delta_base_offset
+      header_len += len(bytes)
+    elif type == 7: # ref delta
+      base = map[header_len:header_len+20]
+      header_len += 20
+    return type, size, base, header_len
+
+  def get_stored_entry_at(self, offset, end):
+    """Return the object at a particular offset as it is stored.
+
+    Nothing is inflated, the compressed data is returned as is.
+
+    :param end: Offset of the end of the object, which is where the next 
+        object starts.
+    :return: Tuple with the object type, the uncompressed size, the 
+        delta base and the compressed data. See get_stored_header_at.
+    """
+    assert end <= self._size - 20
+    type, size, base, header_len = self.get_stored_header_at(offset)
+    return type, size, base, self._get_map()[offset+header_len:end]
+
+  def get_object_size_at(self, offset):
+    """Find the size of the object at a particular offset.
+
+    The size of objects that are stored in full is in their header. Of 
+    deltas, only the start is inflated, which holds the size of the 
+    object the delta results in.
+
+    :return: The size of the object contents
+    """
+    assert offset >= self._header_size
+    map = ArraySkipper(self._get_map(), offset)
+    type, size, header_len = unpack_object_header(map)
+    if type == 6: # offset delta
+      header_len += len(take_msb_bytes(map, header_len))
+    elif type == 7: # ref delta
+      header_len += 20
+    else:
+      return size
+    # The delta starts with the sizes of its base and its result
+    header = ""
+    for chunk in iter_zlib(map, header_len, size, chunk_size=20):
+      header += chunk
+      if len(header) >= 20:
+        break
+    bytes = take_msb_bytes(header, 0)
+    bytes = take_msb_bytes(header, len(bytes))
+    size = 0
+    for i, byte in enumerate(bytes):
+      size |= (byte & 0x7f) << (i * 7)
+    return size
 
 
 class SHA1Writer(object):
@@ -532,38 +710,51 @@ class SHA1Writer(object):
         return self.f.tell()
 
 
-def write_pack_object(f, type, object):
-    """Write pack object to a file.
+def pack_object_header(type, size, delta_base=None):
+    """Create the header of an object in a pack.
 
-    :param f: File to write to
-    :param o: Object to write
+    :param type: Object type
+    :param size: Uncompressed size of the object or delta
+    :param delta_base: For offset deltas, the distance back to the base; 
+        for ref deltas, the binary SHA1 of the base.
+    :return: The header, as a string
     """
-    ret = f.tell()
-    if type == 6: # ref delta
-        (delta_base_offset, object) = object
-    elif type == 7: # offset delta
-        (basename, object) = object
-    size = len(object)
+    header = []
     c = (type << 4) | (size & 15)
     size >>= 4
     while size:
-        f.write(chr(c | 0x80))
+        header.append(chr(c | 0x80))
         c = size & 0x7f
         size >>= 7
-    f.write(chr(c))
+    header.append(chr(c))
     if type == 6: # offset delta
-        ret = [delta_base_offset & 0x7f]
-        delta_base_offset >>= 7
-        while delta_base_offset:
-            delta_base_offset -= 1
-            ret.insert(0, 0x80 | (delta_base_offset & 0x7f))
-            delta_base_offset >>= 7
-        f.write("".join([chr(x) for x in ret]))
+        ret = [delta_base & 0x7f]
+        delta_base >>= 7
+        while delta_base:
+            delta_base -= 1
+            ret.insert(0, 0x80 | (delta_base & 0x7f))
+            delta_base >>= 7
+        header.append("".join([chr(x) for x in ret]))
     elif type == 7: # ref delta
-        assert len(basename) == 20
-        f.write(basename)
+        assert len(delta_base) == 20
+        header.append(delta_base)
+    return "".join(header)
+
+
+def write_pack_object(f, type, object):
+    """Write pack object to a file.
+
+    :param f: File to write to
+    :param o: Object to write
+    :return: Offset of the object in the file
+    """
+    offset = f.tell()
+    delta_base = None
+    if type in (6, 7): # offset or ref delta
+        (delta_base, object) = object
+    f.write(pack_object_header(type, len(object), delta_base))
     f.write(zlib.compress(object))
-    return f.tell()
+    return offset
 
 
 def write_pack(filename, objects, num_objects):
@@ -576,6 +767,300 @@ def write_pack(filename, objects, num_objects):
     write_pack_index_v2(filename + ".idx", entries, data_sum)
 
 
+def complete_thin_pack(filename, resolve_ext_ref):
+    """Turn a thin pack into a complete pack, in place.
+
+    The entries of the pack are kept as they are. The delta bases that 
+    are not in the pack are appended to it as full objects, after which 
+    the object count in the header and the checksum are updated. The 
+    pack is indexed in a single pass, the way a PackReceiver indexes a 
+    pack that comes in, so it is never inflated in memory as a whole.
+
+    :param filename: Path of the pack file
+    :param resolve_ext_ref: Function that returns the (type, contents) 
+        of an object that is not in the pack, by binary SHA1
+    :return: List with (name, offset, crc32 checksum) entries, pack checksum
+    """
+    f = open(filename, 'r+b')
+    try:
+        receiver = PackReceiver(f, resolve_ext_ref, fix_thin=True)
+        data = f.read(CHUNK_SIZE)
+        while data:
+            receiver._feed(data)
+            data = f.read(CHUNK_SIZE)
+        return receiver.finish()
+    finally:
+        f.close()
+
+
+def append_pack_objects(f, num_objects, objects):
+    """Append objects to a pack, in place.
+
+    The objects are stored in full. The object count in the header and 
+    the checksum at the end are updated afterwards, for which the pack 
+    is read once more.
+
+    :param f: File with the pack, open for both reading and writing
+    :param num_objects: Number of objects in the pack
+    :param objects: List of (name, type, contents) tuples
+    :return: List with (name, offset, crc32 checksum) entries for the 
+        appended objects, new pack checksum
+    """
+    entries = []
+    f.seek(-20, 2)
+    f.truncate()
+    offset = f.tell()
+    for (sha, type, text) in objects:
+        data = pack_object_header(type, len(text)) + zlib.compress(text)
+        f.write(data)
+        entries.append((sha, offset, zlib.crc32(data)))
+        offset += len(data)
+    f.seek(8)
+    f.write(struct.pack(">L", num_objects + len(objects)))
+    f.seek(0)
+    sha1 = hashlib.sha1()
+    data = f.read(CHUNK_SIZE)
+    while data:
+        sha1.update(data)
+        data = f.read(CHUNK_SIZE)
+    pack_checksum = sha1.digest()
+    f.seek(0, 2)
+    f.write(pack_checksum)
+    return entries, pack_checksum
+
+
+class PackReceiver(object):
+    """Write a pack to disk as it is received, indexing it on the way.
+
+    The pack is passed to write() in chunks of any size, as it arrives. 
+    Each object is inflated while its data comes in, and named once it is 
+    complete. Deltas are resolved as soon as their base has been named, 
+    against a cache of recent objects or the part of the pack that is 
+    already on disk. Once the last chunk has arrived only the deltas 
+    against bases that are not in the pack are left, so unlike with 
+    PackData.create_index_v2 the pack is not read again, and it is never 
+    held in memory as a whole.
+    """
+
+    def __init__(self, f, resolve_ext_ref=None, fix_thin=False):
+        """Create a receiver.
+
+        :param f: File to write the pack to, open for both writing and 
+            reading
+        :param resolve_ext_ref: Function that returns the (type, contents) 
+            of an object that is not in the pack, by binary SHA1
+        :param fix_thin: Whether to append the delta bases found with 
+            resolve_ext_ref to the pack, turning a thin pack into a 
+            complete one
+        """
+        self.f = f
+        self.resolve_ext_ref = resolve_ext_ref
+        self.fix_thin = fix_thin
+        # Set by finish()
+        self.entries = None
+        self.pack_checksum = None
+        self._received = 0
+        self._buf = ""
+        # Offset in the pack of the start of _buf
+        self._offset = 0
+        self._sha1 = hashlib.sha1()
+        self._num_objects = None
+        self._num_parsed = 0
+        # Object that is being inflated, as a list of its offset, type, 
+        # delta base, data offset, decompressor, chunks and crc32
+        self._inflating = None
+        # Offset -> (type, delta base, data offset, end, crc32)
+        self._stored = {}
+        # Binary SHA1 -> offset, of the objects that have been named
+        self._offsets = {}
+        self._named = set()
+        # Offset or binary SHA1 of a base -> offsets of its deltas
+        self._pending = defaultdict(list)
+        self._external = {}
+        self._cache = DeltaBaseCache()
+        self._entries = []
+
+    def write(self, data):
+        """Write the next chunk of the pack."""
+        self.f.write(data)
+        self._feed(data)
+
+    def _feed(self, data):
+        """Index the next chunk of a pack that is already in the file."""
+        self._received += len(data)
+        self._buf += data
+        while self._buf and self._parse():
+            pass
+
+    def tell(self):
+        """Return the number of bytes written so far."""
+        return self._received
+
+    def _consume(self, size):
+        data = self._buf[:size]
+        self._buf = self._buf[size:]
+        self._sha1.update(data)
+        self._offset += size
+        return data
+
+    def _parse(self):
+        """Parse as much of the buffered data as possible.
+
+        :return: False if more data is needed to go on
+        """
+        if self._num_objects is None:
+            if len(self._buf) < 12:
+                return False
+            (version, self._num_objects) = read_pack_header(
+                StringIO(self._consume(12)))
+            return True
+        if self._inflating is not None:
+            return self._inflate()
+        if self._num_parsed == self._num_objects:
+            # Only the checksum is left
+            return False
+        offset = self._offset
+        buf = self._buf
+        try:
+            type, size, header_len = unpack_object_header(buf)
+            base = None
+            if type == 6: # offset delta
+                bytes = take_msb_bytes(buf, header_len)
+                delta_base_offset = bytes[0] & 0x7f
+                for byte in bytes[1:]:
+                    delta_base_offset += 1
+                    delta_base_offset <<= 7
+                    delta_base_offset += (byte & 0x7f)
+                base = offset - delta_base_offset
+                header_len += len(bytes)
+            elif type == 7: # ref delta
+                base = buf[header_len:header_len+20]
+                header_len += 20
+                if len(base) < 20:
+                    return False
+        except IndexError:
+            # The header is incomplete
+            return False
+        header = self._consume(header_len)
+        self._inflating = [offset, type, base, offset + header_len, 
+                           zlib.decompressobj(), [], zlib.crc32(header)]
+        return True
+
+    def _inflate(self):
+        (offset, type, base, start, decomp, chunks, crc) = self._inflating
+        data = self._buf
+        chunks.append(decomp.decompress(data))
+        # The end of the zlib stream is only noticed once data beyond it 
+        # has been fed, but there is always more: the next object or the 
+        # checksum
+        data = self._consume(len(data) - len(decomp.unused_data))
+        crc = zlib.crc32(data, crc)
+        if not decomp.unused_data:
+            self._inflating[6] = crc
+            return False
+        self._inflating = None
+        self._num_parsed += 1
+        text = "".join(chunks)
+        self._stored[offset] = (type, base, start, self._offset, crc)
+        if type in (6, 7):
+            if not self._has_base(type, base):
+                self._pending[base].append(offset)
+                return True
+            base_type, base_text = self._get_base(type, base)
+            type, text = base_type, apply_delta(base_text, text)
+        self._add_entry(offset, type, text)
+        return True
+
+    def _has_base(self, type, base):
+        if type == 6:
+            return base in self._named
+        return base in self._offsets or base in self._external
+
+    def _get_base(self, type, base):
+        if type == 6:
+            return self._get_object_at(base)
+        if base in self._offsets:
+            return self._get_object_at(self._offsets[base])
+        return self._external[base]
+
+    def _get_object_at(self, offset):
+        """Return the (type, contents) of an object that has been named."""
+        if offset in self._cache:
+            return self._cache[offset]
+        (type, base, start, end, crc) = self._stored[offset]
+        pos = self.f.tell()
+        self.f.seek(start)
+        text = zlib.decompress(self.f.read(end - start))
+        self.f.seek(pos)
+        if type in (6, 7):
+            base_type, base_text = self._get_base(type, base)
+            type, text = base_type, apply_delta(base_text, text)
+        self._cache.add(offset, type, text)
+        return type, text
+
+    def _add_entry(self, offset, type, text):
+        sha1 = hashlib.sha1("%s %d\0" % (num_type_map[type]._type, 
+                                         len(text)))
+        sha1.update(text)
+        name = sha1.digest()
+        self._entries.append((name, offset, self._stored[offset][4]))
+        self._offsets[name] = offset
+        self._named.add(offset)
+        self._cache.add(offset, type, text)
+        self._resolve_pending(offset)
+        self._resolve_pending(name)
+
+    def _resolve_pending(self, base):
+        for offset in self._pending.pop(base, []):
+            type, text = self._get_object_at(offset)
+            self._add_entry(offset, type, text)
+
+    def finish(self):
+        """Finish receiving the pack.
+
+        The deltas against objects that are not in the pack are resolved 
+        and, if fix_thin is set, their bases appended to the pack.
+
+        :return: List with (name, offset, crc32 checksum) entries and the 
+            pack checksum, or None if no data was received at all
+        :raise KeyError: If the bases of some deltas could not be found
+        """
+        if self._received == 0:
+            return None
+        assert (self._num_parsed == self._num_objects and 
+                self._inflating is None and len(self._buf) == 20), \
+                "Pack is truncated"
+        pack_checksum = self._sha1.digest()
+        assert self._buf == pack_checksum, "Pack checksum mismatch"
+        if self.resolve_ext_ref is not None:
+            missing = [key for key in self._pending if isinstance(key, str)]
+            for key in missing:
+                if key in self._pending:
+                    self._external[key] = self.resolve_ext_ref(key)
+                    self._resolve_pending(key)
+        missing = [sha_to_hex(key) for key in self._pending 
+                   if isinstance(key, str)]
+        if missing:
+            raise KeyError(missing)
+        assert not self._pending, "Delta bases at invalid offsets"
+        entries = self._entries
+        if self.fix_thin and self._external:
+            new_entries, pack_checksum = append_pack_objects(self.f, 
+                len(entries), [(sha,) + self._external[sha] 
+                               for sha in self._external])
+            entries = entries + new_entries
+        self.entries = entries
+        self.pack_checksum = pack_checksum
+        return entries, pack_checksum
+
+    def close(self):
+        """Finish receiving the pack and close the file."""
+        try:
+            return self.finish()
+        finally:
+            self.f.close()
+
+
 def write_pack_data(f, objects, num_objects, window=10):
     """Write a new pack file.
 
@@ -623,6 +1108,225 @@ def write_pack_data(f, objects, num_objects, window=10):
     return entries, f.write_sha()
 
 
+# Maximum number of objects waiting to be picked up by the next stage in 
+# write_pack_pipelined
+PIPELINE_QUEUE_SIZE = 64
+
+# Number of objects between progress reports in write_pack_pipelined
+PIPELINE_PROGRESS_INTERVAL = 1000
+
+# Maximum amount of compressed data write_pack_pipelined keeps while the 
+# objects are still being counted. Reading and compressing further ahead 
+# would only slow down counting, and thus delay the start of the pack.
+PIPELINE_SPOOL_SIZE = 256 * 1024
+
+# Number of seconds between checks for progress messages and errors while 
+# waiting for another stage in write_pack_pipelined
+PIPELINE_POLL_INTERVAL = 0.02
+
+_PIPELINE_DONE = object()
+
+
+class _PipelineError(Exception):
+    """Raised when an earlier stage of a pipeline has failed."""
+
+    def __init__(self, exc_info):
+        Exception.__init__(self)
+        self.exc_info = exc_info
+
+
+class ProgressQueue(object):
+    """Progress function that can be called from several threads.
+
+    Messages from the thread that created the ProgressQueue are reported 
+    straight away, messages from other threads are kept until flush() is 
+    called from the creating thread.
+    """
+
+    def __init__(self, progress):
+        self._progress = progress
+        self._messages = Queue()
+        self._thread = threading.currentThread()
+
+    def __call__(self, message):
+        if threading.currentThread() is self._thread:
+            self.flush()
+            self._progress(message)
+        else:
+            self._messages.put(message)
+
+    def flush(self):
+        """Report the messages from other threads."""
+        while True:
+            try:
+                message = self._messages.get_nowait()
+            except Empty:
+                return
+            self._progress(message)
+
+
+def _pipeline_put(queue, item, abort):
+    while not abort.isSet():
+        try:
+            queue.put(item, True, PIPELINE_POLL_INTERVAL)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _pipeline_iter(queue, abort, idle=None):
+    """Iterate over the items a pipeline stage passes on."""
+    while not abort.isSet():
+        try:
+            item = queue.get(True, PIPELINE_POLL_INTERVAL)
+        except Empty:
+            if idle is not None:
+                idle()
+            continue
+        if item is _PIPELINE_DONE:
+            return
+        if isinstance(item, _PipelineError):
+            raise item
+        yield item
+
+
+def _pipeline_stage(items, queue, abort):
+    """Pass all items on to the next stage of a pipeline."""
+    try:
+        for item in items:
+            if not _pipeline_put(queue, item, abort):
+                return
+        item = _PIPELINE_DONE
+    except _PipelineError, e:
+        item = e
+    except:
+        item = _PipelineError(sys.exc_info())
+    _pipeline_put(queue, item, abort)
+
+
+def write_pack_pipelined(f, shas, get_raw, progress=None, 
+                         queue_size=PIPELINE_QUEUE_SIZE):
+    """Write a new pack file while the objects to put in it are enumerated.
+
+    Enumerating, reading and compressing the objects all happen in separate 
+    threads, connected by queues, and overlap with writing the pack. As the 
+    pack header contains the number of objects, compressed objects are kept 
+    in a temporary file until shas is exhausted; once PIPELINE_SPOOL_SIZE 
+    bytes are waiting there, reading and compressing pause until counting 
+    is done.
+
+    :param f: File to write to; only its write method is used, and only 
+        from the calling thread.
+    :param shas: Iterable over the hex shas of the objects to write. This 
+        can be a generator that is still walking the history.
+    :param get_raw: Function that returns the (type, raw text) for a sha. 
+        It is called from a separate thread.
+    :param progress: Progress function. Messages, including those posted 
+        to a ProgressQueue from other threads, are reported from the 
+        calling thread.
+    :return: List with (name, offset, crc32 checksum) entries, pack checksum
+    """
+    if progress is None:
+        progress = lambda message: None
+    if not isinstance(progress, ProgressQueue):
+        progress = ProgressQueue(progress)
+    abort = threading.Event()
+    counted = threading.Event()
+    # Set when counting has finished, or failed
+    enumerated = threading.Event()
+    count = [0]
+
+    def enumerate_objects():
+        try:
+            for sha in shas:
+                count[0] += 1
+                if count[0] % PIPELINE_PROGRESS_INTERVAL == 1:
+                    progress("counting objects: %d\r" % count[0])
+                yield sha
+            progress("counting objects: %d, done.\n" % count[0])
+            counted.set()
+        finally:
+            enumerated.set()
+
+    def read_objects(queue):
+        for sha in _pipeline_iter(queue, abort):
+            type, raw = get_raw(sha)
+            yield sha, type, raw
+
+    def compress_objects(queue):
+        for sha, type, raw in _pipeline_iter(queue, abort):
+            buf = StringIO()
+            write_pack_object(buf, type, raw)
+            yield hex_to_sha(sha), zlib.crc32(raw), buf.getvalue()
+
+    # Counting must never have to wait for the later stages, as those are 
+    # held up until the number of objects is known. Shas are small anyway.
+    sha_queue = Queue()
+    raw_queue = Queue(queue_size)
+    packed_queue = Queue(queue_size)
+    threads = [
+        threading.Thread(target=_pipeline_stage, 
+            args=(enumerate_objects(), sha_queue, abort)),
+        threading.Thread(target=_pipeline_stage, 
+            args=(read_objects(sha_queue), raw_queue, abort)),
+        threading.Thread(target=_pipeline_stage, 
+            args=(compress_objects(raw_queue), packed_queue, abort)),
+        ]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+
+    f = SHA1Writer(f)
+    spool = tempfile.TemporaryFile()
+    def write_header():
+        f.write("PACK")               # Pack header
+        f.write(struct.pack(">L", 2)) # Pack version
+        f.write(struct.pack(">L", count[0])) # Number of objects in pack
+        spool.seek(0)
+        data = spool.read(CHUNK_SIZE)
+        while data:
+            f.write(data)
+            data = spool.read(CHUNK_SIZE)
+        spool.close()
+
+    entries = []
+    offset = 12
+    try:
+        try:
+            for sha1, crc32, data in _pipeline_iter(packed_queue, abort, 
+                                                    progress.flush):
+                entries.append((sha1, offset, crc32))
+                offset += len(data)
+                if spool.closed:
+                    f.write(data)
+                else:
+                    spool.write(data)
+                    while (offset - 12 >= PIPELINE_SPOOL_SIZE and
+                           not enumerated.isSet()):
+                        enumerated.wait(PIPELINE_POLL_INTERVAL)
+                        progress.flush()
+                    if counted.isSet():
+                        write_header()
+                if len(entries) % PIPELINE_PROGRESS_INTERVAL == 0:
+                    progress.flush()
+                    if counted.isSet():
+                        progress("writing objects: %d/%d\r" % 
+                                 (len(entries), count[0]))
+            if not spool.closed:
+                write_header()
+        except _PipelineError, e:
+            raise e.exc_info[0], e.exc_info[1], e.exc_info[2]
+    finally:
+        abort.set()
+        for t in threads:
+            t.join()
+        if not spool.closed:
+            spool.close()
+    progress("writing objects: %d, done.\n" % len(entries))
+    return entries, f.write_sha()
+
+
 def write_pack_index_v1(filename, entries, pack_checksum):
     """Write a new pack index file.
 
@@ -800,6 +1504,7 @@ class Pack(object):
         self._idx_path = self._basename + ".idx"
         self._data = None
         self._idx = None
+        self._offsets = None
 
     def name(self):
         return self.idx.objects_sha1()
@@ -851,27 +1556,153 @@ class Pack(object):
         offset = self.idx.object_index(sha1)
         if offset is None:
             raise KeyError(sha1)
+        # Ref deltas can have their base in this pack, as in completed 
+        # thin packs
+        return self.resolve_object_at(offset, resolve_ref)
+
+    def get_object_size(self, sha1):
+        """Find the size of the object with the specified SHA1.
+
+        Unlike get_raw, this doesn't inflate the object.
+        """
+        offset = self.idx.object_index(sha1)
+        if offset is None:
+            raise KeyError(sha1)
+        return self.data.get_object_size_at(offset)
 
-        type, obj = self.data.get_object_at(offset)
-        assert isinstance(offset, int)
-        return resolve_object(offset, type, obj, resolve_ref,
-            self.data.get_object_at)
+    def get_raw_chunks(self, sha1, resolve_ref=None):
+        """Incrementally read the object with the specified SHA1.
+
+        :return: Tuple with the object type, the size of the object 
+            contents and an iterator over chunks of the contents.
+        """
+        offset = self.idx.object_index(sha1)
+        if offset is None:
+            raise KeyError(sha1)
+        ret = self.data.get_object_chunks_at(offset)
+        if ret is not None:
+            return ret
+        # Deltas have to be resolved in memory
+        type, text = self.get_raw(sha1, resolve_ref)
+        return type, len(text), iter([text])
 
     def __getitem__(self, sha1):
         """Retrieve the specified SHA1."""
         type, uncomp = self.get_raw(sha1)
         return ShaFile.from_raw_string(type, uncomp)
 
+    def _get_offsets(self):
+        """Return the offsets of the objects in the pack, in order.
+
+        :return: Tuple with an array of offsets and a list with the binary 
+            SHA1s of the objects at those offsets
+        """
+        if self._offsets is None:
+            entries = [(offset, name) for (name, offset, crc32) 
+                       in self.idx.iterentries()]
+            entries.sort()
+            self._offsets = (array.array('L', [e[0] for e in entries]), 
+                             [e[1] for e in entries])
+        return self._offsets
+
+    def get_name_at(self, offset):
+        """Return the binary SHA1 of the object at a particular offset."""
+        (offsets, names) = self._get_offsets()
+        i = bisect.bisect_left(offsets, offset)
+        assert i < len(offsets) and offsets[i] == offset, \
+                "No object at offset %d" % offset
+        return names[i]
+
+    def get_stored_entry_at(self, offset):
+        """Return the object at a particular offset as it is stored.
+
+        The end of the object is found from the offset of the next object 
+        in the index, so nothing has to be inflated.
+
+        :return: Tuple with the binary SHA1 of the object, its type, its 
+            uncompressed size, its delta base and its compressed data. See 
+            PackData.get_stored_entry_at.
+        """
+        (offsets, names) = self._get_offsets()
+        i = bisect.bisect_left(offsets, offset)
+        assert i < len(offsets) and offsets[i] == offset, \
+                "No object at offset %d" % offset
+        if i + 1 < len(offsets):
+            end = offsets[i+1]
+        else:
+            end = self.data._size - 20
+        return (names[i], ) + self.data.get_stored_entry_at(offset, end)
+
+    def resolve_object_at(self, offset, resolve_ref=None, cache=None, 
+                          raw=None):
+        """Retrieve the fully resolved object at a particular offset.
+
+        :param offset: Offset of the object in the pack.
+        :param resolve_ref: Function to retrieve delta bases that are not 
+            in this pack, by binary SHA1.
+        :param cache: Optional DeltaBaseCache, used for looking up delta 
+            bases and updated with the resolved object.
+        :param raw: Unresolved (type, object) tuple at offset, if already 
+            known.
+        :return: Tuple with object type and object contents.
+        """
+        if cache is not None and offset in cache:
+            return cache[offset]
+        if raw is None:
+            raw = self.data.get_object_at(offset)
+        type, obj = raw
+        if type == 6: # offset delta
+            (delta_offset, delta) = obj
+            type, base_text = self.resolve_object_at(offset-delta_offset, 
+                resolve_ref, cache)
+            text = apply_delta(base_text, delta)
+        elif type == 7: # ref delta
+            (basename, delta) = obj
+            base_offset = self.idx.object_index(basename)
+            if base_offset is not None:
+                type, base_text = self.resolve_object_at(base_offset, 
+                    resolve_ref, cache)
+            elif resolve_ref is not None:
+                type, base_text = resolve_ref(basename)
+            else:
+                raise KeyError(basename)
+            text = apply_delta(base_text, delta)
+        else:
+            text = obj
+        if cache is not None:
+            cache.add(offset, type, text)
+        return type, text
+
+    def get_raw_many(self, shas, resolve_ref=None, cache=None):
+        """Retrieve several objects, reading them in pack order.
+
+        :param shas: Iterable over SHA1s of objects in this pack.
+        :param resolve_ref: Function to retrieve delta bases that are not 
+            in this pack, by binary SHA1.
+        :param cache: DeltaBaseCache to use; a new one is used if None.
+        :return: Iterator over (sha, type, contents) tuples, in the 
+            order the objects appear in the pack.
+        """
+        if cache is None:
+            cache = DeltaBaseCache()
+        entries = []
+        for sha in shas:
+            offset = self.idx.object_index(sha)
+            if offset is None:
+                raise KeyError(sha)
+            entries.append((offset, sha))
+        entries.sort()
+        for offset, sha in entries:
+            type, text = self.resolve_object_at(offset, resolve_ref, cache)
+            yield sha, type, text
+
     def iterobjects(self, get_raw=None):
-        if get_raw is None:
-            def get_raw(x):
-                raise KeyError(x)
+        cache = DeltaBaseCache()
         for offset, type, obj in self.data.iterobjects():
             assert isinstance(offset, int)
             yield ShaFile.from_raw_string(
-                    *resolve_object(offset, type, obj, 
-                        get_raw, 
-                    self.data.get_object_at))
+                    *self.resolve_object_at(offset, get_raw, cache, 
+                        (type, obj)))
 
 
 def load_packs(path):
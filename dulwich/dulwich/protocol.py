@@ -38,11 +38,82 @@ class ProtocolFile(object):
         pass
 
 
+# Maximum amount of data to read from the peer at once
+RECV_SIZE = 64 * 1024
+
+# Amount of outgoing data to buffer before it is written out
+WRITE_BUFFER_SIZE = 64 * 1024
+
+# a pktline can be a max of 65520. a sideband line can therefore be
+# 65520-5 = 65515
+MAX_SIDEBAND_SIZE = 65515
+
+
 class Protocol(object):
+    """Reading and writing of git pkt-lines.
 
-    def __init__(self, read, write):
-        self.read = read
-        self.write = write
+    Outgoing data is buffered until flush() is called, the buffer grows 
+    beyond WRITE_BUFFER_SIZE or data is read from the peer; the latter makes 
+    sure we never wait for the peer while it is waiting for us.
+
+    If a recv function is specified (which, like socket.recv, may return less 
+    data than asked for as soon as any data is available), incoming data is 
+    read in large blocks into a receive buffer rather than with separate 
+    reads for the length and the contents of each pkt-line.
+    """
+
+    def __init__(self, read, write, recv=None):
+        self._read = read
+        self._write = write
+        self._recv = recv
+        self._rbuf = ""
+        self._rpos = 0
+        self._wbuf = []
+        self._wbuf_len = 0
+
+    def _buffered(self):
+        return len(self._rbuf) - self._rpos
+
+    def _fill(self, size):
+        """Make sure at least size bytes are in the receive buffer.
+
+        :return: False if the peer hung up before that many bytes arrived.
+        """
+        while self._buffered() < size:
+            data = self._recv(max(RECV_SIZE, size - self._buffered()))
+            if not data:
+                return False
+            if self._rpos == len(self._rbuf):
+                self._rbuf = data
+            else:
+                self._rbuf = self._rbuf[self._rpos:] + data
+            self._rpos = 0
+        return True
+
+    def read(self, size=-1):
+        """Read raw data from the peer.
+
+        :param size: Number of bytes to read, or -1 to read until the peer 
+            hangs up.
+        """
+        self.flush()
+        if self._recv is None:
+            if size < 0:
+                return self._read()
+            return self._read(size)
+        if size < 0:
+            ret = [self._rbuf[self._rpos:]]
+            self._rbuf = ""
+            self._rpos = 0
+            data = self._recv(RECV_SIZE)
+            while data:
+                ret.append(data)
+                data = self._recv(RECV_SIZE)
+            return "".join(ret)
+        self._fill(size)
+        ret = self._rbuf[self._rpos:self._rpos+size]
+        self._rpos += len(ret)
+        return ret
 
     def read_pkt_line(self):
         """
@@ -64,6 +135,28 @@ class Protocol(object):
             yield pkt
             pkt = self.read_pkt_line()
 
+    def write(self, data):
+        """Write raw data to the peer.
+
+        The data is buffered; call flush() to make sure it is sent.
+        """
+        self._wbuf.append(data)
+        self._wbuf_len += len(data)
+        if self._wbuf_len >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Send all buffered outgoing data to the peer."""
+        if not self._wbuf:
+            return
+        if len(self._wbuf) == 1:
+            data = self._wbuf[0]
+        else:
+            data = "".join(self._wbuf)
+        self._wbuf = []
+        self._wbuf_len = 0
+        self._write(data)
+
     def write_pkt_line(self, line):
         """
         Sends a 'pkt line' to the remote git process
@@ -82,12 +175,13 @@ class Protocol(object):
         :param channel: int specifying which channel to write to
         :param blob: a blob of data (as a string) to send on this channel
         """
-        # a pktline can be a max of 65520. a sideband line can therefore be
-        # 65520-5 = 65515
         # WTF: Why have the len in ASCII, but the channel in binary.
-        while blob:
-            self.write_pkt_line("%s%s" % (chr(channel), blob[:65515]))
-            blob = blob[65515:]
+        # Walk over blob by offset rather than repeatedly slicing off the 
+        # head, which would copy the rest of blob for every pkt-line.
+        for offset in xrange(0, len(blob), MAX_SIDEBAND_SIZE):
+            chunk = blob[offset:offset+MAX_SIDEBAND_SIZE]
+            self.write("%04x%s" % (len(chunk)+5, chr(channel)))
+            self.write(chunk)
 
     def send_cmd(self, cmd, *args):
         """
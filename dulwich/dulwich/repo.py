@@ -18,9 +18,14 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA  02110-1301, USA.
 
+from collections import defaultdict
+import heapq
 import os
+import stat
 
+from client import SkippingFetchGraphWalker
 from commit import Commit
+from commit_graph import GENERATION_NUMBER_INFINITY
 from errors import (
         MissingCommitError, 
         NotBlobError, 
@@ -37,8 +42,18 @@ from objects import (
         )
 
 OBJECTDIR = 'objects'
+S_IFGITLINK = 0160000
 SYMREF = 'ref: '
 
+# Flags used while walking history to find common ancestors
+_PARENT1 = 1
+_PARENT2 = 2
+_STALE = 4
+
+
+def S_ISGITLINK(m):
+  return (stat.S_IFMT(m) == S_IFGITLINK)
+
 
 class Tags(object):
 
@@ -95,9 +110,34 @@ class Repo(object):
         that a revision is present.
     :param progress: Simple progress function that will be called with 
         updated progress strings.
+    :return: List of shas of the missing objects
+    """
+    shas = []
+    for sha in self.iter_missing_objects(determine_wants, graph_walker, 
+                                         progress):
+        shas.append(sha)
+        if len(shas) % 1000 == 0:
+            progress("counting objects: %d\r" % len(shas))
+    return shas
+
+  def iter_missing_objects(self, determine_wants, graph_walker, progress):
+    """Find the missing objects required for a set of revisions, lazily.
+
+    The negotiation with the graph walker is done by the time this returns, 
+    but the history is only walked as the returned iterator is consumed.
+
+    :param determine_wants: Function that takes a dictionary with heads 
+        and returns the list of heads to fetch.
+    :param graph_walker: Object that can iterate over the list of revisions 
+        to fetch and has an "ack" method that will be called to acknowledge 
+        that a revision is present.
+    :param progress: Simple progress function that will be called with 
+        updated progress strings.
+    :return: Iterator over the shas of the missing objects
     """
     wants = determine_wants(self.get_refs())
-    commits_to_send = set(wants)
+    if not wants:
+        return iter([])
     sha_done = set()
     ref = graph_walker.next()
     while ref:
@@ -105,35 +145,40 @@ class Repo(object):
         if ref in self.object_store:
             graph_walker.ack(ref)
         ref = graph_walker.next()
+    return self._iter_missing_objects(wants, sha_done)
+
+  def _iter_missing_objects(self, wants, sha_done):
+    commits_to_send = set(wants)
     while commits_to_send:
         sha = commits_to_send.pop()
         if sha in sha_done:
             continue
 
-        c = self.commit(sha)
-        assert isinstance(c, Commit)
+        entry = self._get_commit_graph_entry(sha)
+        if entry is not None:
+            (treesha, parents) = entry[:2]
+        else:
+            c = self.commit(sha)
+            assert isinstance(c, Commit)
+            (treesha, parents) = (c.tree, c.parents)
         sha_done.add(sha)
+        yield sha
 
-        commits_to_send.update([p for p in c.parents if not p in sha_done])
-
-        def parse_tree(tree, sha_done):
-            for mode, name, x in tree.entries():
-                if not x in sha_done:
-                    try:
-                        t = self.tree(x)
-                        sha_done.add(x)
-                        parse_tree(t, sha_done)
-                    except:
-                        sha_done.add(x)
+        commits_to_send.update([p for p in parents if not p in sha_done])
 
-        treesha = c.tree
-        if treesha not in sha_done:
-            t = self.tree(treesha)
-            sha_done.add(treesha)
-            parse_tree(t, sha_done)
-
-        progress("counting objects: %d\r" % len(sha_done))
-    return sha_done
+        if treesha in sha_done:
+            continue
+        sha_done.add(treesha)
+        yield treesha
+        trees = [treesha]
+        while trees:
+            for mode, name, x in self.tree(trees.pop()).entries():
+                if x in sha_done or S_ISGITLINK(mode):
+                    continue
+                sha_done.add(x)
+                yield x
+                if stat.S_ISDIR(mode):
+                    trees.append(x)
 
   def fetch_objects(self, determine_wants, graph_walker, progress):
     """Fetch the missing objects required for a set of revisions.
@@ -148,8 +193,42 @@ class Repo(object):
     :return: tuple with number of objects, iterator over objects
     """
     shas = self.find_missing_objects(determine_wants, graph_walker, progress)
-    object_gen = (self.get_object(sha) for sha in shas)
-    return (len(shas), object_gen)
+    return (len(shas), self.object_store.iter_objects(shas))
+
+  def fetch(self, target, determine_wants=None, progress=None):
+    """Fetch the missing objects for a set of revisions into a local repo.
+
+    The missing objects are found as they would be for a fetch over the 
+    git protocol, and then copied from the packs of this repository into 
+    a new pack in target, without being inflated or deflated.
+
+    :param target: Repo to fetch into
+    :param determine_wants: Function that takes a dictionary with heads 
+        and returns the list of heads to fetch. Defaults to all heads 
+        that target doesn't have.
+    :param progress: Simple progress function that will be called with 
+        updated progress strings.
+    :return: The refs of this repository
+    """
+    if determine_wants is None:
+      determine_wants = lambda refs: [sha for sha in refs.values() 
+                                      if not sha in target.object_store]
+    if progress is None:
+      progress = lambda message: None
+    refs = self.get_refs()
+    wants = []
+    def record_wants(heads):
+      wants.extend(determine_wants(heads))
+      return wants
+    graph_walker = SkippingFetchGraphWalker(target.heads().values(), 
+        target.get_parents, target.get_commit_time)
+    shas = [sha for sha in self.iter_missing_objects(record_wants, 
+                                                     graph_walker, progress)
+            if not sha in target.object_store]
+    target.object_store.add_pack_from_store(self.object_store, shas, 
+                                            progress)
+    target.object_store.add_to_commit_graph(wants)
+    return refs
 
   def object_dir(self):
     return os.path.join(self.controldir(), OBJECTDIR)
@@ -241,9 +320,219 @@ class Repo(object):
   def get_object(self, sha):
     return self.object_store[sha]
 
+  def _get_commit_graph_entry(self, sha):
+    """Look up a commit in the commit-graph.
+
+    :return: Tuple with the tree, parents, generation number and commit 
+        time of the commit, or None if it isn't in the commit-graph.
+    """
+    graph = self.object_store.commit_graph
+    if graph is None:
+      return None
+    try:
+      return graph.get_entry(sha)
+    except KeyError:
+      return None
+
   def get_parents(self, sha):
+    entry = self._get_commit_graph_entry(sha)
+    if entry is not None:
+      return entry[1]
     return self.commit(sha).parents
 
+  def get_parent_map(self, shas):
+    """Look up the parents of several commits at once.
+
+    Commits in the commit-graph are looked up there, the others are read 
+    with a single bulk retrieval, in pack offset order.
+
+    :param shas: Iterable over hex shas of commits
+    :return: Dictionary mapping the shas of the commits that were found to 
+        their parents. Shas of missing objects and of objects that aren't 
+        commits are left out.
+    """
+    ret = {}
+    todo = []
+    graph = self.object_store.commit_graph
+    for sha in shas:
+      if graph is not None and sha in graph:
+        ret[sha] = graph.get_parents(sha)
+      elif sha in self.object_store:
+        todo.append(sha)
+    for sha, type, text in self.object_store.get_raw_many(todo):
+      if type == Commit._num_type:
+        ret[sha] = ShaFile.from_raw_string(type, text).parents
+    return ret
+
+  def get_commit_time(self, sha):
+    entry = self._get_commit_graph_entry(sha)
+    if entry is not None:
+      return entry[3]
+    return self.commit(sha).commit_time
+
+  def update_commit_graph(self):
+    """Add the commits reachable from the refs to the commit-graph."""
+    self.object_store.add_to_commit_graph(self.get_refs().values())
+
+  def _get_commit_info(self, sha):
+    """Look up what is needed to walk history through a commit.
+
+    :return: Tuple with the generation number, commit time and parents of 
+        the commit. Commits that aren't in the commit-graph get 
+        GENERATION_NUMBER_INFINITY as generation number.
+    """
+    entry = self._get_commit_graph_entry(sha)
+    if entry is not None:
+      return (entry[2], entry[3], entry[1])
+    c = self.commit(sha)
+    return (GENERATION_NUMBER_INFINITY, c.commit_time, c.parents)
+
+  def _paint_down(self, flags, common):
+    """Propagate flags from commits to their ancestors, newest first.
+
+    Commits are visited in order of decreasing generation number, then 
+    decreasing commit time, so all descendants of a commit in the 
+    commit-graph that are reached are visited before it. Commits that 
+    aren't in the commit-graph are ordered by commit time alone, which 
+    can visit a commit too early if clocks were skewed. The walk stops 
+    once every queued commit has all the flags in common.
+
+    :param flags: Dictionary mapping the commits to start from to their 
+        flags. It is updated with the flags of every commit reached.
+    :param common: Flags that make a commit uninteresting. Commits 
+        reached through a commit with all of them get _STALE as well.
+    :return: flags
+    """
+    info = {}
+    queue = []
+    # Number of queue entries per commit, and of entries for commits 
+    # that don't have all the flags in common yet. Flags are only ever 
+    # added, so a commit that has them all keeps them.
+    queued = defaultdict(int)
+    nonstale = [0]
+    def push(sha):
+      if sha not in info:
+        info[sha] = self._get_commit_info(sha)
+      heapq.heappush(queue, (-info[sha][0], -info[sha][1], sha))
+      queued[sha] += 1
+      if flags[sha] & common != common:
+        nonstale[0] += 1
+    for sha in flags:
+      push(sha)
+    while queue and nonstale[0] > 0:
+      sha = heapq.heappop(queue)[2]
+      queued[sha] -= 1
+      f = flags[sha]
+      if f & common == common:
+        f |= _STALE
+      else:
+        nonstale[0] -= 1
+      for parent in info[sha][2]:
+        old = flags.get(parent, 0)
+        if old | f == old:
+          continue
+        flags[parent] = old | f
+        if old & common != common and flags[parent] & common == common:
+          # The entries already queued for parent are stale now
+          nonstale[0] -= queued[parent]
+        push(parent)
+    return flags
+
+  def is_ancestor(self, ancestor, descendant):
+    """Check whether a commit is an ancestor of another commit.
+
+    Commits are considered to be ancestors of themselves. With a 
+    commit-graph, commits with a smaller generation number than ancestor 
+    can't reach it and aren't walked any further.
+
+    :param ancestor: Hex sha of the possible ancestor
+    :param descendant: Hex sha of the possible descendant
+    :return: True if ancestor is an ancestor of descendant
+    """
+    if ancestor == descendant:
+      return True
+    min_generation = self._get_commit_info(ancestor)[0]
+    seen = set([descendant])
+    todo = [descendant]
+    while todo:
+      (generation, commit_time, parents) = self._get_commit_info(todo.pop())
+      if generation < min_generation:
+        continue
+      for parent in parents:
+        if parent == ancestor:
+          return True
+        if parent not in seen:
+          seen.add(parent)
+          todo.append(parent)
+    return False
+
+  def independent(self, shas):
+    """Find the commits that aren't ancestors of any of the others.
+
+    :param shas: Hex shas of commits
+    :return: List with the commits of shas that aren't reachable from any 
+        other commit in shas, in their original order
+    """
+    ret = []
+    for sha in shas:
+      if sha in ret:
+        continue
+      if not [other for other in shas 
+              if other != sha and self.is_ancestor(sha, other)]:
+        ret.append(sha)
+    return ret
+
+  def merge_base(self, one, two):
+    """Find the best common ancestors of two commits.
+
+    :param one: Hex sha of a commit
+    :param two: Hex sha of a commit
+    :return: List of common ancestors of one and two that aren't ancestors 
+        of other common ancestors, empty if the commits are unrelated
+    """
+    if one == two:
+      return [one]
+    flags = self._paint_down({one: _PARENT1, two: _PARENT2}, 
+                             _PARENT1 | _PARENT2)
+    candidates = [sha for (sha, f) in flags.iteritems() 
+                  if f & (_PARENT1 | _PARENT2 | _STALE) == 
+                     _PARENT1 | _PARENT2]
+    return self.independent(candidates)
+
+  def find_common_ancestors(self, shas):
+    """Find the best common ancestors of a set of commits.
+
+    :param shas: Hex shas of commits
+    :return: List of commits that are ancestors of all of shas and aren't 
+        ancestors of other such commits
+    """
+    shas = list(shas)
+    if not shas:
+      return []
+    bases = shas[:1]
+    for sha in shas[1:]:
+      found = []
+      for base in bases:
+        found.extend([b for b in self.merge_base(base, sha) 
+                      if b not in found])
+      bases = self.independent(found)
+    return bases
+
+  def find_unique_ancestors(self, unique, common):
+    """Find the commits that are only reachable from one of several commits.
+
+    :param unique: Hex sha of a commit
+    :param common: Hex shas of commits
+    :return: Set of the ancestors of unique, including unique itself, that 
+        aren't ancestors of any of common
+    """
+    flags = {unique: _PARENT1}
+    for sha in common:
+      flags[sha] = _PARENT2
+    flags = self._paint_down(flags, _PARENT2)
+    return set([sha for (sha, f) in flags.iteritems() 
+                if f & (_PARENT1 | _PARENT2) == _PARENT1])
+
   def commit(self, sha):
     return self._get_object(sha, Commit)
 
@@ -253,6 +542,55 @@ class Repo(object):
   def get_blob(self, sha):
     return self._get_object(sha, Blob)
 
+  def get_lazy_blob(self, sha):
+    """Retrieve a blob whose contents are only inflated when accessed.
+
+    The contents of the returned blob can be read incrementally using 
+    Blob.iter_chunks().
+    """
+    type, size, chunks = self.object_store.get_raw_chunks(sha)
+    if type != Blob._num_type:
+      raise NotBlobError(sha)
+    first = [chunks]
+    def get_chunks():
+      if first:
+        return first.pop()
+      return self.object_store.get_raw_chunks(sha)[2]
+    return Blob.from_chunk_source(size, get_chunks)
+
+  def iter_revision_history(self, head):
+    """Iterate over the commits reachable from head, newest first.
+
+    History is walked from a heap of the commits found so far, keyed on 
+    commit time, so commits are yielded as soon as they are reached and 
+    every commit is read only once. Commits with the same commit time are 
+    yielded in the reverse of the order they were found in.
+
+    Raises MissingCommitError when a commit that is reached can't be 
+    found, and NotCommitError if head isn't the sha of a commit.
+    """
+    seen = set([head])
+    queue = []
+    counter = 0
+    todo = [head]
+    while True:
+      for sha in todo:
+        try:
+          commit = self.commit(sha)
+        except KeyError:
+          raise MissingCommitError(sha)
+        counter += 1
+        heapq.heappush(queue, (-commit.commit_time, -counter, commit))
+      if not queue:
+        break
+      commit = heapq.heappop(queue)[2]
+      yield commit
+      todo = []
+      for parent in commit.parents:
+        if parent not in seen:
+          seen.add(parent)
+          todo.append(parent)
+
   def revision_history(self, head):
     """Returns a list of the commits reachable from head.
 
@@ -264,28 +602,7 @@ class Repo(object):
 
     XXX: work out how to handle merges.
     """
-    # We build the list backwards, as parents are more likely to be older
-    # than children
-    pending_commits = [head]
-    history = []
-    while pending_commits != []:
-      head = pending_commits.pop(0)
-      try:
-          commit = self.commit(head)
-      except KeyError:
-        raise MissingCommitError(head)
-      if commit in history:
-        continue
-      i = 0
-      for known_commit in history:
-        if known_commit.commit_time > commit.commit_time:
-          break
-        i += 1
-      history.insert(i, commit)
-      parents = commit.parents
-      pending_commits += parents
-    history.reverse()
-    return history
+    return list(self.iter_revision_history(head))
 
   def __repr__(self):
       return "<Repo at %r>" % self.path
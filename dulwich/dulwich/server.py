@@ -16,12 +16,30 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA  02110-1301, USA.
 
+import os
+import socket
 import SocketServer
+import threading
+from dulwich.errors import (
+    GitProtocolError,
+    HangupException,
+    WrongObjectException,
+    )
+from dulwich.objects import CHUNK_SIZE
 from dulwich.protocol import Protocol, ProtocolFile, TCP_GIT_PORT, extract_capabilities
 from dulwich.repo import Repo
-from dulwich.pack import write_pack_data
+from dulwich.pack import ProgressQueue, write_pack_data, write_pack_pipelined
 import tempfile
 
+# Default maximum number of sessions served concurrently
+DEFAULT_MAX_CONNECTIONS = 16
+
+# How the server acknowledges the client's haves, depending on the 
+# capabilities the client asked for
+SINGLE_ACK = 0
+MULTI_ACK = 1
+MULTI_ACK_DETAILED = 2
+
 class Backend(object):
 
     def get_refs(self):
@@ -36,7 +54,9 @@ class Backend(object):
         """ Import a set of changes into a repository and update the refs
 
         :param refs: list of tuple(name, sha)
-        :param read: callback to read from the incoming pack
+        :param read: callback to read from the incoming pack, called with 
+            the maximum number of bytes to read; returns an empty string at 
+            the end of the pack
         """
         raise NotImplementedError
 
@@ -48,6 +68,47 @@ class Backend(object):
         """
         raise NotImplementedError
 
+    def fetch_object_ids(self, determine_wants, graph_walker, progress):
+        """
+        Yield the shas of the objects required for a list of commits.
+
+        Unlike fetch_objects, this doesn't have to find all objects up 
+        front: the negotiation with the client is finished when this 
+        returns, but the returned iterator may still be walking the history 
+        while the first objects are sent. Backends that implement this 
+        should also implement get_raw.
+
+        :param progress: is a callback to send progress messages to the 
+            client; it may be called from another thread.
+        :return: iterator over the hex shas of the objects
+        """
+        raise NotImplementedError(self.fetch_object_ids)
+
+    def get_raw(self, sha):
+        """
+        Retrieve an object to send to the client.
+
+        :return: tuple with the object type and its raw text
+        """
+        raise NotImplementedError(self.get_raw)
+
+    def get_parents(self, sha):
+        """
+        Retrieve the parents of a commit.
+
+        This is optional; it lets the server tell the client when it has 
+        found enough common history to stop sending haves.
+
+        :return: list of the hex shas of the parents
+        """
+        raise NotImplementedError(self.get_parents)
+
+
+def implements(backend, name):
+    """Check whether a backend implements an optional method of Backend."""
+    method = getattr(backend, name)
+    return getattr(method, "im_func", None) is not getattr(Backend, name).im_func
+
 
 class GitBackend(Backend):
 
@@ -60,12 +121,20 @@ class GitBackend(Backend):
 
         self.repo = Repo(self.gitdir)
         self.fetch_objects = self.repo.fetch_objects
+        self.fetch_object_ids = self.repo.iter_missing_objects
+        self.get_raw = self.repo.object_store.get_raw
+        self.get_parents = self.repo.get_parents
         self.get_refs = self.repo.get_refs
 
     def apply_pack(self, refs, read):
-        fd, commit = self.repo.object_store.add_thin_pack()
-        fd.write(read())
-        fd.close()
+        f, commit = self.repo.object_store.add_thin_pack()
+        # The pack is indexed as it comes in, rather than after it has 
+        # been received in full
+        data = read(CHUNK_SIZE)
+        while data:
+            f.write(data)
+            data = read(CHUNK_SIZE)
+        f.close()
         commit()
 
         for oldsha, sha, ref in refs:
@@ -73,85 +142,286 @@ class GitBackend(Backend):
                 self.repo.remove_ref(ref)
             else:
                 self.repo.set_ref(ref, sha)
+        self.repo.object_store.add_to_commit_graph(
+            [sha for (oldsha, sha, ref) in refs if sha != "0" * 40])
 
         print "pack applied"
 
 
 class Handler(object):
 
-    def __init__(self, backend, read, write):
+    def __init__(self, backend, proto):
         self.backend = backend
-        self.proto = Protocol(read, write)
+        self.proto = proto
+        self.client_capabilities = []
 
     def capabilities(self):
         return " ".join(self.default_capabilities())
 
 
-class UploadPackHandler(Handler):
+class ProtocolGraphWalker(object):
+    """Graph walker that reads the haves the client sends over the protocol.
 
-    def default_capabilities(self):
-        return ("multi_ack", "side-band-64k", "thin-pack", "ofs-delta")
+    The client sends its haves in batches, each ending with a flush-pkt, 
+    and doesn't wait for the response to a batch before sending the next 
+    one. The server answers each batch as described for the multi_ack and 
+    multi_ack_detailed capabilities in git's pack-protocol.txt: commits 
+    that are found are acknowledged as "common", and once every wanted 
+    commit reaches one of them the client is told it is "ready" so it can 
+    stop sending haves. With no-done, the server doesn't wait for the 
+    client's "done" after that but starts sending the pack straight away.
+    """
 
-    def handle(self):
-        def determine_wants(heads):
-            keys = heads.keys()
-            if keys:
-                self.proto.write_pkt_line("%s %s\x00%s\n" % ( heads[keys[0]], keys[0], self.capabilities()))
-                for k in keys[1:]:
-                    self.proto.write_pkt_line("%s %s\n" % (heads[k], k))
+    def __init__(self, proto, get_parents=None):
+        """Create a new graph walker.
 
-            # i'm done..
-            self.proto.write("0000")
+        :param proto: Protocol to read the haves from
+        :param get_parents: Callable returning the parents of a commit, 
+            used to check whether the client may stop sending haves.
+        """
+        self.proto = proto
+        self.get_parents = get_parents
+        self.wants = []
+        self.multi_ack = SINGLE_ACK
+        self.no_done = False
+        self.common = []
+        self._common = set()
+        # The have returned by next() that hasn't been acknowledged yet
+        self._pending = None
+        self._got_common = False
+        self._got_other = False
+        self._sent_ready = False
+        self._stopped_early = False
+        # Per unsatisfied want, the commits seen while walking back from 
+        # it and those whose parents haven't been looked at yet
+        self._walks = None
+
+    def set_wants(self, wants, capabilities):
+        """Set what the client asked for, before it starts sending haves.
+
+        :param wants: List of revisions the client wants
+        :param capabilities: List of capabilities the client asked for
+        """
+        self.wants = wants
+        if "multi_ack_detailed" in capabilities:
+            self.multi_ack = MULTI_ACK_DETAILED
+        elif "multi_ack" in capabilities:
+            self.multi_ack = MULTI_ACK
+        else:
+            self.multi_ack = SINGLE_ACK
+        self.no_done = "no-done" in capabilities
 
-            # Now client will either send "0000", meaning that it doesnt want to pull.
-            # or it will start sending want want want commands
-            want = self.proto.read_pkt_line()
-            if want == None:
-                return []
+    def ack(self, have_ref):
+        self._pending = None
+        if have_ref in self._common:
+            return
+        self.common.append(have_ref)
+        self._common.add(have_ref)
+        self._got_common = True
+        if self.multi_ack == MULTI_ACK_DETAILED:
+            self.proto.write_pkt_line("ACK %s common\n" % have_ref)
+        elif self.multi_ack == MULTI_ACK:
+            self.proto.write_pkt_line("ACK %s continue\n" % have_ref)
+        elif len(self.common) == 1:
+            self.proto.write_pkt_line("ACK %s\n" % have_ref)
+
+    def next(self):
+        if self._pending is not None:
+            self._got_other_have(self._pending)
+        while True:
+            line = self.proto.read_pkt_line()
+            if line is None:
+                if self._end_of_batch():
+                    return None
+            elif line[:5] == "have ":
+                self._pending = line[5:45]
+                return self._pending
+            elif line.rstrip("\n") == "done":
+                self._done()
+                return None
+            else:
+                raise GitProtocolError("Unexpected line from client: %r" % line)
 
-            want, self.client_capabilities = extract_capabilities(want)
+    def finish(self):
+        """Consume what the client sent after negotiation was cut short.
 
-            want_revs = []
-            while want and want[:4] == 'want':
-                want_revs.append(want[5:45])
-                want = self.proto.read_pkt_line()
-            return want_revs
+        If the server stopped reading because of no-done, the client may 
+        still have had batches of haves in flight. These have to be read 
+        before the connection is closed, or the reset that closing a socket 
+        with unread data causes can cut off the end of the pack.
+        """
+        if not self._stopped_early:
+            return
+        try:
+            line = self.proto.read_pkt_line()
+            while line is None or line.rstrip("\n") != "done":
+                line = self.proto.read_pkt_line()
+        except HangupException:
+            pass
+
+    def _got_other_have(self, have_ref):
+        self._pending = None
+        self._got_other = True
+        if self.multi_ack and self._ok_to_give_up():
+            if self.multi_ack == MULTI_ACK_DETAILED:
+                self._sent_ready = True
+                self.proto.write_pkt_line("ACK %s ready\n" % have_ref)
+            else:
+                self.proto.write_pkt_line("ACK %s continue\n" % have_ref)
 
-        progress = lambda x: self.proto.write_sideband(2, x)
-        write = lambda x: self.proto.write_sideband(1, x)
+    def _end_of_batch(self):
+        """Respond to the flush-pkt at the end of a batch of haves.
 
-        class ProtocolGraphWalker(object):
+        :return: True if the negotiation is over
+        """
+        if (self.multi_ack == MULTI_ACK_DETAILED and self._got_common and 
+            not self._got_other and self._ok_to_give_up()):
+            self._sent_ready = True
+            self.proto.write_pkt_line("ACK %s ready\n" % self.common[-1])
+        if not self.common or self.multi_ack:
+            self.proto.write_pkt_line("NAK\n")
+        self._got_common = False
+        self._got_other = False
+        if self.no_done and self._sent_ready:
+            self.proto.write_pkt_line("ACK %s\n" % self.common[-1])
+            self._stopped_early = True
+        self.proto.flush()
+        return self._stopped_early
+
+    def _done(self):
+        if not self.common:
+            self.proto.write_pkt_line("NAK\n")
+        elif self.multi_ack:
+            self.proto.write_pkt_line("ACK %s\n" % self.common[-1])
+        self.proto.flush()
+
+    def _ok_to_give_up(self):
+        """Check whether all wanted commits reach a commit the client has."""
+        if self.get_parents is None or not self.common:
+            return False
+        if self._walks is None:
+            self._walks = dict((want, (set([want]), [want])) 
+                               for want in self.wants)
+        for want, (seen, todo) in self._walks.items():
+            if not self._walk_to_common(seen, todo):
+                return False
+            del self._walks[want]
+        return True
+
+    def _walk_to_common(self, seen, todo):
+        if not seen.isdisjoint(self._common):
+            return True
+        while todo:
+            try:
+                parents = self.get_parents(todo.pop())
+            except (KeyError, WrongObjectException):
+                # Not a commit, so it can't reach any of the common ones
+                continue
+            for parent in parents:
+                if parent in seen:
+                    continue
+                seen.add(parent)
+                todo.append(parent)
+                if parent in self._common:
+                    return True
+        return False
 
-            def __init__(self, proto):
-                self.proto = proto
-                self._last_sha = None
 
-            def ack(self, have_ref):
-                self.proto.write_pkt_line("ACK %s continue\n" % have_ref)
+class UploadPackHandler(Handler):
+
+    def default_capabilities(self):
+        return ("multi_ack_detailed", "multi_ack", "side-band-64k", 
+                "thin-pack", "ofs-delta", "no-done")
+
+    def advertise_refs(self, heads):
+        keys = heads.keys()
+        if keys:
+            self.proto.write_pkt_line("%s %s\x00%s\n" % ( heads[keys[0]], keys[0], self.capabilities()))
+            for k in keys[1:]:
+                self.proto.write_pkt_line("%s %s\n" % (heads[k], k))
+
+        # i'm done..
+        self.proto.write("0000")
+
+    def read_wants(self):
+        """Read the list of revisions the client wants to fetch.
 
-            def next(self):
-                have = self.proto.read_pkt_line()
-                if have[:4] == 'have':
-                    return have[5:45]
+        :return: List of shas, empty if the client doesn't want to pull
+        """
+        # Now client will either send "0000", meaning that it doesnt want to pull.
+        # or it will start sending want want want commands
+        self.client_capabilities = []
+        want = self.proto.read_pkt_line()
+        if want == None:
+            return []
+
+        want, caps = extract_capabilities(want)
+        if not caps:
+            # Git sends its capabilities after the first sha, separated 
+            # by a space rather than a NUL
+            caps = [want[45:]]
+            want = want[:45]
+        self.client_capabilities = " ".join(caps).split()
+
+        want_revs = []
+        while want and want[:4] == 'want':
+            want_revs.append(want[5:45])
+            want = self.proto.read_pkt_line()
+        return want_revs
 
-                #if have[:4] == 'done':
-                #    return None
+    def handle(self):
+        def determine_wants(heads):
+            self.advertise_refs(heads)
+            self.wants = self.read_wants()
+            return self.wants
+        self.send_objects(determine_wants)
 
-                if self._last_sha:
-                    # Oddness: Git seems to resend the last ACK, without the "continue" statement
-                    self.proto.write_pkt_line("ACK %s\n" % self._last_sha)
+    def send_objects(self, determine_wants):
+        """Negotiate the common revisions with the client and send a pack.
 
-                # The exchange finishes with a NAK
-                self.proto.write_pkt_line("NAK\n")
+        :param determine_wants: Passed on to the backend; should set 
+            self.wants to the list of revisions the client asked for.
+        """
+        self.wants = []
+        def progress(message):
+            self.proto.write_sideband(2, message)
+            # Let the client know how we're doing straight away
+            self.proto.flush()
+        write = lambda x: self.proto.write_sideband(1, x)
 
-        graph_walker = ProtocolGraphWalker(self.proto)
-        (num_objects, objects_iter) = self.backend.fetch_objects(determine_wants, graph_walker, progress)
+        if implements(self.backend, "get_parents"):
+            get_parents = self.backend.get_parents
+        else:
+            get_parents = None
+        graph_walker = ProtocolGraphWalker(self.proto, get_parents)
+        def negotiate(heads):
+            wants = determine_wants(heads)
+            graph_walker.set_wants(wants, self.client_capabilities)
+            return wants
+        progress = ProgressQueue(progress)
+        if implements(self.backend, "fetch_object_ids"):
+            # Prefer to find, read, compress and send the objects 
+            # concurrently, so the client doesn't have to wait for all of 
+            # them to be found before the pack starts coming in.
+            shas = self.backend.fetch_object_ids(negotiate, graph_walker, progress)
+        else:
+            (num_objects, objects_iter) = self.backend.fetch_objects(negotiate, graph_walker, progress)
+            shas = None
+        if not self.wants:
+            # The client doesn't want anything, so there is no pack to send
+            return
         progress("dul-daemon says what\n")
-        progress("counting objects: %d, done.\n" % len(objects))
-        write_pack_data(ProtocolFile(None, write), objects_iter, num_objects)
+        if shas is not None:
+            write_pack_pipelined(ProtocolFile(None, write), shas, 
+                                 self.backend.get_raw, progress)
+        else:
+            progress("counting objects: %d, done.\n" % num_objects)
+            write_pack_data(ProtocolFile(None, write), objects_iter, num_objects)
         progress("how was that, then?\n")
         # we are done
         self.proto.write("0000")
+        self.proto.flush()
+        graph_walker.finish()
 
 
 class ReceivePackHandler(Handler):
@@ -159,8 +429,8 @@ class ReceivePackHandler(Handler):
     def default_capabilities(self):
         return ("report-status", "delete-refs")
 
-    def handle(self):
-        refs = self.backend.get_refs().items()
+    def advertise_refs(self, refs):
+        refs = refs.items()
 
         if refs:
             self.proto.write_pkt_line("%s %s\x00%s\n" % (refs[0][1], refs[0][0], self.capabilities()))
@@ -172,12 +442,18 @@ class ReceivePackHandler(Handler):
 
         self.proto.write("0000")
 
+    def read_ref_updates(self):
+        """Read the refs the client wants to update.
+
+        :return: List of (oldsha, newsha, ref), empty if the client doesn't 
+            want to send us anything.
+        """
         client_refs = []
         ref = self.proto.read_pkt_line()
 
         # if ref is none then client doesnt want to send us anything..
         if ref is None:
-            return
+            return client_refs
 
         ref, client_capabilities = extract_capabilities(ref)
 
@@ -185,7 +461,15 @@ class ReceivePackHandler(Handler):
         while ref:
             client_refs.append(ref.split())
             ref = self.proto.read_pkt_line()
+        return client_refs
 
+    def handle(self):
+        self.advertise_refs(self.backend.get_refs())
+        client_refs = self.read_ref_updates()
+        if client_refs:
+            self.receive_pack(client_refs)
+
+    def receive_pack(self, client_refs):
         # backend can now deal with this refs and read a pack using self.read
         self.backend.apply_pack(client_refs, self.proto.read)
 
@@ -195,9 +479,17 @@ class ReceivePackHandler(Handler):
 
 class TCPGitRequestHandler(SocketServer.StreamRequestHandler):
 
+    def setup(self):
+        # StreamRequestHandler applies this to the connection
+        self.timeout = self.server.connection_timeout
+        SocketServer.StreamRequestHandler.setup(self)
+
     def handle(self):
-        proto = Protocol(self.rfile.read, self.wfile.write)
-        command, args = proto.read_cmd()
+        proto = Protocol(None, self.wfile.write, self.connection.recv)
+        try:
+            command, args = proto.read_cmd()
+        except (HangupException, socket.timeout):
+            return
 
         # switch case to handle the specific git command
         if command == 'git-upload-pack':
@@ -207,17 +499,175 @@ class TCPGitRequestHandler(SocketServer.StreamRequestHandler):
         else:
             return
 
-        h = cls(self.server.backend, self.rfile.read, self.wfile.write)
-        h.handle()
+        h = cls(self.server.backend, proto)
+        try:
+            try:
+                h.handle()
+            finally:
+                proto.flush()
+        except (HangupException, socket.timeout, socket.error):
+            # The client went away or stopped responding; there is nobody 
+            # left to report this to.
+            pass
 
 
 class TCPGitServer(SocketServer.TCPServer):
+    """Git server that serves one connection at a time.
+
+    :ivar connection_timeout: Number of seconds a session may block on the 
+        client before it is dropped, or None to wait forever.
+    """
 
     allow_reuse_address = True
     serve = SocketServer.TCPServer.serve_forever
 
-    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT):
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, 
+                 connection_timeout=None):
         self.backend = backend
+        self.connection_timeout = connection_timeout
         SocketServer.TCPServer.__init__(self, (listen_addr, port), TCPGitRequestHandler)
 
 
+class ThreadedTCPGitServer(SocketServer.ThreadingMixIn, TCPGitServer):
+    """Git server that serves each connection from a separate thread.
+
+    No more than max_connections sessions are served at the same time. 
+    Further connections are not accepted until a session finishes, so they 
+    queue up in the listen backlog of the socket rather than in the server.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, 
+                 connection_timeout=None, 
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        TCPGitServer.__init__(self, backend, listen_addr, port, 
+                              connection_timeout)
+        self.max_connections = max_connections
+        self._sessions = set()
+        self._closing = False
+        self._lock = threading.Condition()
+
+    def get_request(self):
+        self._lock.acquire()
+        try:
+            while (len(self._sessions) >= self.max_connections and 
+                   not self._closing):
+                # Use a timeout so shutdown() can interrupt the wait
+                self._lock.wait(0.5)
+            if self._closing:
+                raise socket.error("server is shutting down")
+        finally:
+            self._lock.release()
+        return TCPGitServer.get_request(self)
+
+    def process_request(self, request, client_address):
+        t = threading.Thread(target=self.process_request_thread,
+                             args=(request, client_address))
+        t.setDaemon(self.daemon_threads)
+        self._lock.acquire()
+        try:
+            self._sessions.add(t)
+        finally:
+            self._lock.release()
+        t.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request,
+                client_address)
+        finally:
+            self._lock.acquire()
+            try:
+                self._sessions.discard(threading.currentThread())
+                self._lock.notifyAll()
+            finally:
+                self._lock.release()
+
+    def active_sessions(self):
+        """Return the number of sessions currently being served."""
+        return len(self._sessions)
+
+    def shutdown(self):
+        """Stop accepting connections and wait for serve_forever to return.
+
+        Sessions that are in progress are left to finish; server_close 
+        waits for them.
+        """
+        self._lock.acquire()
+        try:
+            self._closing = True
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+        TCPGitServer.shutdown(self)
+
+    def server_close(self, timeout=None):
+        """Close the listening socket and wait for sessions to finish.
+
+        :param timeout: Maximum number of seconds to wait for each session, 
+            or None to wait until they are done.
+        """
+        TCPGitServer.server_close(self)
+        self._lock.acquire()
+        try:
+            sessions = list(self._sessions)
+        finally:
+            self._lock.release()
+        for t in sessions:
+            t.join(timeout)
+
+
+class ForkingTCPGitServer(SocketServer.ForkingMixIn, TCPGitServer):
+    """Git server that serves each connection from a separate process.
+
+    Once max_connections sessions are active the server waits for one of 
+    them to exit before it accepts the next connection.
+    """
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, 
+                 connection_timeout=None, 
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        TCPGitServer.__init__(self, backend, listen_addr, port, 
+                              connection_timeout)
+        self.max_children = max_connections
+
+    def server_close(self):
+        """Close the listening socket and wait for sessions to finish."""
+        TCPGitServer.server_close(self)
+        for pid in list(self.active_children or []):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.active_children = None
+
+
+server_modes = ["single", "thread", "fork", "async"]
+
+
+def make_server(backend, listen_addr, port=TCP_GIT_PORT, mode="thread",
+                connection_timeout=None, 
+                max_connections=DEFAULT_MAX_CONNECTIONS):
+    """Create a git server.
+
+    :param mode: One of server_modes
+    :param connection_timeout: Seconds after which an idle session is dropped
+    :param max_connections: Maximum number of sessions served at once; 
+        ignored in "single" mode. In "async" mode this is the number of 
+        sessions that can run backend operations at once, idle sessions 
+        are not limited.
+    """
+    if mode == "single":
+        return TCPGitServer(backend, listen_addr, port, connection_timeout)
+    elif mode == "thread":
+        cls = ThreadedTCPGitServer
+    elif mode == "fork":
+        cls = ForkingTCPGitServer
+    elif mode == "async":
+        from dulwich.async_server import AsyncTCPGitServer
+        cls = AsyncTCPGitServer
+    else:
+        raise ValueError("Unknown server mode %r" % mode)
+    return cls(backend, listen_addr, port, connection_timeout, 
+               max_connections)
@@ -19,11 +19,17 @@
 
 import unittest
 import test_objects
+import test_object_store
+import test_protocol
+import test_client
+import test_server
+import test_async_server
 import test_repository
 import test_pack
 
 def test_suite():
-  test_modules = [test_objects, test_repository, test_pack]
+  test_modules = [test_objects, test_object_store, test_protocol, test_client,
+                  test_server, test_async_server, test_repository, test_pack]
   loader = unittest.TestLoader()
   suite = unittest.TestSuite()
   for mod in test_modules:
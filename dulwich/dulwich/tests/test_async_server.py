@@ -0,0 +1,96 @@
+# test_async_server.py -- Tests for the event loop based git server
+# 
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import socket
+import threading
+import time
+
+from dulwich.async_server import AsyncTCPGitServer, WorkerPool
+from dulwich.tests.test_server import CountingBackend, ServerTestCase
+from unittest import TestCase
+
+
+class WorkerPoolTests(TestCase):
+
+    def test_submit(self):
+        results = []
+        pool = WorkerPool(2, lambda fn, *args: fn(*args))
+        try:
+            pool.submit(lambda x: x * 2, (21,), 
+                        lambda result, exc_info: results.append(result))
+            pool.submit(lambda: 1 / 0, (), 
+                        lambda result, exc_info: results.append(exc_info[0]))
+        finally:
+            pool.stop()
+        self.assertEquals(sorted([42, ZeroDivisionError]), sorted(results))
+
+
+class AsyncTCPGitServerTests(ServerTestCase):
+
+    def idle_connection(self):
+        s = socket.create_connection(("localhost", self.port))
+        s.settimeout(5)
+        return s
+
+    def test_fetch_pack(self):
+        self.start_server(AsyncTCPGitServer(
+            CountingBackend(refs={"refs/heads/master": "a" * 40}), 
+            "localhost", 0))
+        self.check_fetch_pack()
+
+    def test_simultaneous_clients(self):
+        backend = CountingBackend(wait_for=4)
+        self.start_server(AsyncTCPGitServer(backend, "localhost", 0, 
+                          max_workers=4))
+        self.run_clients(12)
+        self.assertEquals(12, backend.fetches)
+        self.assertEquals(4, backend.peak)
+
+    def test_idle_connections_use_no_workers(self):
+        backend = CountingBackend()
+        self.start_server(AsyncTCPGitServer(backend, "localhost", 0, 
+                          max_workers=1))
+        idle = [self.idle_connection() for i in range(50)]
+        try:
+            self.run_clients(3)
+        finally:
+            for s in idle:
+                s.close()
+        self.assertEquals(3, backend.fetches)
+
+    def test_connection_timeout(self):
+        self.start_server(AsyncTCPGitServer(CountingBackend(), "localhost", 0,
+                          connection_timeout=0.2, max_workers=1))
+        s = self.idle_connection()
+        try:
+            self.assertEquals("", s.recv(1))
+        finally:
+            s.close()
+        self.run_clients(1)
+
+    def test_shutdown_closes_idle_connections(self):
+        self.start_server(AsyncTCPGitServer(CountingBackend(), "localhost", 0))
+        s = self.idle_connection()
+        try:
+            # Make sure the server has accepted the connection
+            while not self.server.connections():
+                time.sleep(0.01)
+            self.server.shutdown()
+            self.assertEquals("", s.recv(1))
+        finally:
+            s.close()
+        self.assertEquals([], self.server.connections())
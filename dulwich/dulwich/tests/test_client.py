@@ -0,0 +1,108 @@
+# test_client.py -- Tests for the git client
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+from unittest import TestCase
+
+from dulwich.client import SkippingFetchGraphWalker
+
+
+def linear_history(num_commits, prefix="c", parents=None, start_time=0):
+    """Create a linear history of fake commits.
+
+    :return: tuple with the parents and commit times of the commits and
+        the last commit
+    """
+    if parents is None:
+        parents = {}
+    times = {}
+    parent = []
+    for i in range(num_commits):
+        sha = "%s%d" % (prefix, i)
+        parents[sha] = parent
+        times[sha] = start_time + i
+        parent = [sha]
+    return parents, times, parent[0]
+
+
+class SkippingFetchGraphWalkerTests(TestCase):
+
+    def walk(self, heads, parents, times, remote):
+        """Run the negotiation against a server that has `remote`.
+
+        :return: list of the haves sent
+        """
+        walker = SkippingFetchGraphWalker(heads, parents.__getitem__,
+                                          times.__getitem__)
+        haves = []
+        have = walker.next()
+        while have:
+            haves.append(have)
+            if have in remote:
+                walker.ack(have)
+            have = walker.next()
+        return haves
+
+    def test_empty(self):
+        self.assertEquals([], self.walk([], {}, {}, set()))
+
+    def test_ack_head(self):
+        parents, times, head = linear_history(100)
+        self.assertEquals([head], self.walk([head], parents, times,
+                                            set(parents)))
+
+    def test_skips_exponentially(self):
+        # 1, 2, 4, 7, 11, 17 and 26 commits are skipped, then the root is
+        # sent as it has no parents
+        parents, times, head = linear_history(100)
+        self.assertEquals(["c99", "c97", "c94", "c89", "c81", "c69", "c51",
+                           "c24", "c0"],
+                          self.walk([head], parents, times, set()))
+
+    def test_stops_at_common_history(self):
+        parents, times, head = linear_history(10000)
+        remote = set(["c%d" % i for i in range(5000)])
+        haves = self.walk([head], parents, times, remote)
+        self.assertTrue(len(haves) < 30)
+        # Nothing is sent after the first common commit
+        self.assertEquals([haves[-1]], [h for h in haves if h in remote])
+
+    def test_newest_first(self):
+        parents, times, a = linear_history(10, "a")
+        times.update(linear_history(10, "b", parents, 100)[1])
+        self.assertEquals(["b9", "a9"],
+                          self.walk(["a9", "b9"], parents, times,
+                                    set(parents))[:2])
+
+    def test_common_ancestors_not_sent(self):
+        # Two branches from a common base; acknowledging the base for one
+        # means it isn't sent again for the other
+        parents, times, base = linear_history(5, "base")
+        for prefix in ("x", "y"):
+            branch = linear_history(3, prefix, start_time=10)
+            parents.update(branch[0])
+            times.update(branch[1])
+            parents[prefix + "0"] = [base]
+        haves = self.walk(["x2", "y2"], parents, times,
+                          set(linear_history(5, "base")[0]))
+        self.assertEquals(1, len([h for h in haves if h.startswith("base")]))
+
+    def test_missing_parent(self):
+        # Parents we don't have, as in a shallow clone, are left out
+        parents = {"c1": ["c0"]}
+        times = {"c1": 1}
+        self.assertEquals(["c1"],
+                          self.walk(["c1"], parents, times, set()))
@@ -0,0 +1,228 @@
+# test_commit_graph.py -- Tests for reading and writing commit-graph files
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from dulwich.commit_graph import (
+        CommitGraph,
+        compute_generations,
+        write_commit_graph,
+        )
+from dulwich.object_store import ObjectStore
+from dulwich.objects import Commit
+
+tree_sha = 'b2a2766a2879c209ab1176e7e778b81ae422eeaa'
+
+
+def make_commit(parents, commit_time):
+  c = Commit()
+  c._tree = tree_sha
+  c._parents = list(parents)
+  c._author = c._committer = "Joe Example <joe@example.com>"
+  c._commit_time = commit_time
+  c._message = "Commit at %d\n" % commit_time
+  c.serialize()
+  return c
+
+
+class ComputeGenerationsTests(TestCase):
+
+  def test_empty(self):
+    self.assertEquals({}, compute_generations({}))
+
+  def test_merge(self):
+    parents = {"a": [], "b": ["a"], "c": ["a"], "d": ["b", "c"],
+               "e": ["d", "a"]}
+    self.assertEquals({"a": 1, "b": 2, "c": 2, "d": 3, "e": 4},
+                      compute_generations(parents))
+
+
+class CommitGraphTests(TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, "commit-graph")
+    self.shas = ["%02x" % i * 20 for i in range(5)]
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def write(self, entries):
+    write_commit_graph(self.path, entries)
+    graph = CommitGraph(self.path)
+    self.addCleanup(graph.close)
+    return graph
+
+  def test_empty(self):
+    graph = self.write({})
+    self.assertEquals(0, len(graph))
+    self.assertFalse(self.shas[0] in graph)
+    self.assertTrue(graph.check())
+
+  def test_linear(self):
+    (a, b, c) = self.shas[:3]
+    graph = self.write({a: (tree_sha, [], 1000), b: (tree_sha, [a], 2000),
+                        c: (tree_sha, [b], 3000)})
+    self.assertEquals(3, len(graph))
+    self.assertEquals([a, b, c], list(graph))
+    self.assertEquals((tree_sha, [b], 3, 3000), graph.get_entry(c))
+    self.assertEquals([], graph.get_parents(a))
+    self.assertEquals(2, graph.get_generation(b))
+    self.assertEquals(1000, graph.get_commit_time(a))
+    self.assertTrue(graph.check())
+
+  def test_missing(self):
+    graph = self.write({self.shas[0]: (tree_sha, [], 1000)})
+    self.assertFalse(self.shas[1] in graph)
+    self.assertRaises(KeyError, graph.get_entry, self.shas[1])
+
+  def test_octopus(self):
+    (a, b, c, d, e) = self.shas
+    graph = self.write({a: (tree_sha, [], 1), b: (tree_sha, [], 2),
+                        c: (tree_sha, [], 3), d: (tree_sha, [c, a, b], 4),
+                        e: (tree_sha, [b, d], 5)})
+    self.assertEquals([c, a, b], graph.get_parents(d))
+    self.assertEquals([b, d], graph.get_parents(e))
+    self.assertEquals(3, graph.get_generation(e))
+
+  def test_large_commit_time(self):
+    graph = self.write({self.shas[0]: (tree_sha, [], 2**33 + 5)})
+    self.assertEquals(2**33 + 5, graph.get_commit_time(self.shas[0]))
+
+  def test_iterentries(self):
+    (a, b) = self.shas[:2]
+    graph = self.write({a: (tree_sha, [], 1000), b: (tree_sha, [a], 2000)})
+    self.assertEquals([(a, tree_sha, [], 1, 1000),
+                       (b, tree_sha, [a], 2, 2000)],
+                      list(graph.iterentries()))
+
+  def test_layer(self):
+    (a, b, c, d, e) = self.shas
+    base = self.write({d: (tree_sha, [], 1000), e: (tree_sha, [d], 2000)})
+    path = os.path.join(self.tempdir, "layer")
+    write_commit_graph(path, {a: (tree_sha, [e], 3000),
+                              b: (tree_sha, [a, d], 4000)}, base)
+    graph = CommitGraph(path, base)
+    self.addCleanup(graph.close_layer)
+    self.assertEquals([base, graph], graph.layers())
+    self.assertEquals(4, len(graph))
+    self.assertEquals(2, graph.layer_size())
+    self.assertEquals([d, e, a, b], list(graph))
+    self.assertTrue(d in graph)
+    self.assertEquals((tree_sha, [a, d], 4, 4000), graph.get_entry(b))
+    self.assertEquals([d], graph.get_parents(e))
+    self.assertEquals([(a, tree_sha, [e], 3, 3000),
+                       (b, tree_sha, [a, d], 4, 4000)],
+                      list(graph.iterentries(include_base=False)))
+    self.assertTrue(graph.check())
+
+
+class ObjectStoreCommitGraphTests(TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.path, "pack"))
+    self.store = ObjectStore(self.path)
+
+  def tearDown(self):
+    if self.store.commit_graph is not None:
+      self.store.commit_graph.close()
+    shutil.rmtree(self.path)
+
+  def add_commit(self, parents, commit_time):
+    return self.store.add_object(make_commit(parents, commit_time))
+
+  def test_no_commit_graph(self):
+    self.assertEquals(None, self.store.commit_graph)
+
+  def test_add(self):
+    a = self.add_commit([], 1234561000)
+    b = self.add_commit([a], 1234562000)
+    self.store.add_to_commit_graph([b])
+    graph = self.store.commit_graph
+    self.assertEquals(sorted([a, b]), list(graph))
+    self.assertEquals((tree_sha, [a], 2, 1234562000), graph.get_entry(b))
+
+  def test_add_incremental(self):
+    a = self.add_commit([], 1234561000)
+    self.store.add_to_commit_graph([a])
+    b = self.add_commit([a], 1234562000)
+    c = self.add_commit([a, b], 1234563000)
+    self.store.add_to_commit_graph([c, a])
+    graph = self.store.commit_graph
+    self.assertEquals(3, len(graph))
+    self.assertEquals(3, graph.get_generation(c))
+    self.assertEquals(1234561000, graph.get_commit_time(a))
+    reopened = ObjectStore(self.path).commit_graph
+    self.addCleanup(reopened.close)
+    self.assertEquals(list(graph.iterentries()), list(reopened.iterentries()))
+
+  def test_add_missing_parent(self):
+    a = self.add_commit([], 1234561000)
+    b = self.add_commit(["ff" * 20], 1234562000)
+    c = self.add_commit([b], 1234563000)
+    self.store.add_to_commit_graph([a, c])
+    self.assertEquals([a], list(self.store.commit_graph))
+
+  def test_add_layer(self):
+    a = self.add_commit([], 1234561000)
+    b = self.add_commit([a], 1234562000)
+    c = self.add_commit([b], 1234563000)
+    self.store.add_to_commit_graph([c])
+    d = self.add_commit([c], 1234564000)
+    self.store.add_to_commit_graph([d])
+    graph = self.store.commit_graph
+    self.assertEquals([3, 1], [layer.layer_size() for layer in graph.layers()])
+    self.assertEquals((tree_sha, [c], 4, 1234564000), graph.get_entry(d))
+    self.assertEquals([a], graph.get_parents(b))
+    reopened = ObjectStore(self.path).commit_graph
+    self.addCleanup(reopened.close)
+    self.assertEquals(list(graph.iterentries()), list(reopened.iterentries()))
+
+  def test_merge_layers(self):
+    a = self.add_commit([], 1234561000)
+    b = self.add_commit([a], 1234562000)
+    c = self.add_commit([b], 1234563000)
+    self.store.add_to_commit_graph([c])
+    d = self.add_commit([c], 1234564000)
+    self.store.add_to_commit_graph([d])
+    e = self.add_commit([d], 1234565000)
+    self.store.add_to_commit_graph([e])
+    graph = self.store.commit_graph
+    self.assertEquals(1, len(graph.layers()))
+    self.assertEquals(5, graph.get_generation(e))
+    self.assertEquals(2, len(os.listdir(os.path.join(self.path, "info", 
+                                                     "commit-graphs"))))
+
+  def test_add_to_unsplit(self):
+    a = self.add_commit([], 1234561000)
+    b = self.add_commit([a], 1234562000)
+    c = self.add_commit([b], 1234563000)
+    os.mkdir(os.path.join(self.path, "info"))
+    write_commit_graph(self.store.commit_graph_path(), 
+        {a: (tree_sha, [], 1234561000), b: (tree_sha, [a], 1234562000),
+         c: (tree_sha, [b], 1234563000)})
+    d = self.add_commit([c], 1234564000)
+    self.store.add_to_commit_graph([d])
+    graph = self.store.commit_graph
+    self.assertEquals(2, len(graph.layers()))
+    self.assertEquals(4, graph.get_generation(d))
+    self.assertFalse(os.path.exists(self.store.commit_graph_path()))
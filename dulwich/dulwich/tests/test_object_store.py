@@ -16,7 +16,23 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA  02110-1301, USA.
 
+import os
+import shutil
+import tempfile
+
 from dulwich.object_store import ObjectStore
+from dulwich.objects import Blob
+from dulwich.pack import (
+        SHA1Writer,
+        create_delta,
+        hex_to_sha,
+        write_pack,
+        write_pack_object,
+        PackData,
+        )
+from dulwich.tests.test_pack import write_delta_pack
+import struct
+import zlib
 from unittest import TestCase
 
 class ObjectStoreTests(TestCase):
@@ -38,3 +54,241 @@ class ObjectStoreTests(TestCase):
         # TODO: Argh, no way to construct Git commit objects without 
         # access to a serialized form.
         o.add_objects([])
+
+
+class ObjectStoreWriteTests(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, "pack"))
+        self.store = ObjectStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_add_object(self):
+        b = Blob.from_string("test 2\n")
+        sha = self.store.add_object(b)
+        self.assertEquals('2969be3e8ee1c0222396a5611407e4769f14e54b', sha)
+        self.assertTrue(os.path.exists(os.path.join(self.path, sha[:2], sha[2:])))
+        self.assertEquals("test 2\n", self.store[sha].data)
+        self.assertEquals([], os.listdir(os.path.join(self.path, "pack")))
+
+    def test_get_object_size(self):
+        sha = self.store.add_object(Blob.from_string("test 2\n"))
+        self.assertEquals(7, self.store.get_object_size(sha))
+        self.assertRaises(KeyError, self.store.get_object_size, "ff" * 20)
+
+    def test_add_object_twice(self):
+        b = Blob.from_string("test 2\n")
+        sha = self.store.add_object(b)
+        self.assertEquals(sha, self.store.add_object(b))
+        self.assertEquals([sha[2:]], os.listdir(os.path.join(self.path, sha[:2])))
+
+    def test_add_object_chunk_source(self):
+        b = Blob.from_chunk_source(7, lambda: iter(["test", " 2\n"]))
+        sha = self.store.add_object(b)
+        self.assertEquals('2969be3e8ee1c0222396a5611407e4769f14e54b', sha)
+
+    def test_add_object_failure(self):
+        def iter_chunks():
+            yield "test"
+            raise IOError("read failed")
+        b = Blob.from_chunk_source(7, iter_chunks)
+        self.assertRaises(IOError, self.store.add_object, b)
+        self.assertEquals(["pack"], os.listdir(self.path))
+
+    def test_add_objects_loose(self):
+        b = Blob.from_string("test 2\n")
+        self.store.add_objects([b])
+        self.assertEquals([], self.store.packs)
+        self.assertTrue(b.id in self.store)
+
+    def test_add_objects_pack(self):
+        self.store.max_loose_objects = 1
+        b1 = Blob.from_string("test 1\n")
+        b2 = Blob.from_string("test 2\n")
+        self.store.add_objects([b1, b2])
+        self.assertEquals(1, len(self.store.packs))
+        self.assertFalse(os.path.exists(os.path.join(self.path, b1.id[:2])))
+        self.assertEquals("test 1\n", self.store[b1.id].data)
+        self.assertEquals("test 2\n", self.store[b2.id].data)
+
+    def test_get_raw_many(self):
+        self.store.max_loose_objects = 1
+        b1 = Blob.from_string("test 1\n")
+        b2 = Blob.from_string("test 2\n")
+        b3 = Blob.from_string("test 3\n")
+        self.store.add_objects([b1, b2])
+        self.store.add_object(b3)
+        shas = [b3.id, b2.id, b1.id, b2.id]
+        self.assertEquals([(b3.id, 3, "test 3\n"), (b2.id, 3, "test 2\n"),
+                           (b1.id, 3, "test 1\n")],
+                          list(self.store.get_raw_many(shas, ordered=True)))
+        self.assertEquals(set([b1.id, b2.id, b3.id]), 
+                          set([o.id for o in self.store.iter_objects(shas)]))
+
+
+class AddPackFromStoreTests(TestCase):
+
+    def setUp(self):
+        self.source_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.source_path, "pack"))
+        self.source = ObjectStore(self.source_path)
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, "pack"))
+        self.store = ObjectStore(self.path)
+        self.base = Blob.from_string("base text\n" * 10)
+        self.target = Blob.from_string("base text\n" * 10 + "target\n")
+
+    def tearDown(self):
+        for pack in self.source.packs + self.store.packs:
+            pack.close()
+        shutil.rmtree(self.source_path)
+        shutil.rmtree(self.path)
+
+    def write_ref_delta_pack(self):
+        basename = os.path.join(self.source_path, "pack", "pack-ref")
+        f = SHA1Writer(open(basename + ".pack", 'wb'))
+        f.write("PACK")
+        f.write(struct.pack(">L", 2))
+        f.write(struct.pack(">L", 2))
+        write_pack_object(f, 3, self.base.data)
+        write_pack_object(f, 7, (hex_to_sha(self.base.id), 
+            create_delta(self.base.data, self.target.data)))
+        f.close()
+        PackData(basename + ".pack").create_index_v2(basename + ".idx")
+
+    def get_stored_type(self, pack, sha):
+        return pack.data.get_stored_header_at(pack.idx.object_index(sha))[0]
+
+    def test_empty(self):
+        self.assertEquals(None, self.store.add_pack_from_store(self.source, 
+                                                               []))
+        self.assertEquals([], self.store.packs)
+
+    def test_offset_delta(self):
+        write_delta_pack(os.path.join(self.source_path, "pack", "pack-ofs"),
+                         self.base.data, self.target.data)
+        pack = self.store.add_pack_from_store(self.source, [self.target.id])
+        # The base of the delta is copied as well, before it
+        self.assertEquals(2, len(pack))
+        self.assertEquals([pack], self.store.packs)
+        self.assertEquals(6, self.get_stored_type(pack, self.target.id))
+        self.assertEquals(self.target.data, self.store[self.target.id].data)
+        self.assertEquals(self.base.data, self.store[self.base.id].data)
+        self.assertTrue(pack.check())
+
+    def test_ref_delta(self):
+        self.write_ref_delta_pack()
+        pack = self.store.add_pack_from_store(self.source, 
+            [self.target.id, self.base.id])
+        self.assertEquals(2, len(pack))
+        self.assertEquals(7, self.get_stored_type(pack, self.target.id))
+        self.assertEquals(self.target.data, self.store[self.target.id].data)
+        self.assertTrue(pack.check())
+
+    def test_in_several_packs(self):
+        write_pack(os.path.join(self.source_path, "pack", "pack-base"), 
+                   [self.base], 1)
+        write_delta_pack(os.path.join(self.source_path, "pack", "pack-ofs"),
+                         self.base.data, self.target.data)
+        # Find the base in the pack that only has the base, and the delta 
+        # in the other one
+        self.source.packs.sort(key=len)
+        pack = self.store.add_pack_from_store(self.source, 
+            [self.base.id, self.target.id])
+        self.assertEquals(2, len(pack))
+        self.assertEquals(sorted([self.base.id, self.target.id]), 
+                          sorted(pack))
+        self.assertEquals(self.target.data, self.store[self.target.id].data)
+        self.assertTrue(pack.check())
+
+    def test_loose(self):
+        loose = Blob.from_string("loose\n")
+        self.source.add_object(loose)
+        pack = self.store.add_pack_from_store(self.source, [loose.id])
+        self.assertEquals([loose.id], list(pack))
+        self.assertEquals("loose\n", self.store[loose.id].data)
+
+    def test_missing(self):
+        self.assertRaises(KeyError, self.store.add_pack_from_store, 
+                          self.source, ["ff" * 20])
+
+
+class ThinPackTests(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, "pack"))
+        self.store = ObjectStore(self.path)
+        self.base = Blob.from_string("base text\n" * 10)
+        self.target = Blob.from_string("base text\n" * 10 + "target\n")
+        self.store.add_object(self.base)
+
+    def tearDown(self):
+        for pack in self.store.packs:
+            pack.close()
+        shutil.rmtree(self.path)
+
+    def write_thin_pack(self, f, objects):
+        f = SHA1Writer(f)
+        f.write("PACK")
+        f.write(struct.pack(">L", 2))
+        f.write(struct.pack(">L", len(objects)))
+        for type, obj in objects:
+            write_pack_object(f, type, obj)
+        f.close()
+
+    def add_thin_pack(self, objects):
+        f, commit = self.store.add_thin_pack()
+        self.write_thin_pack(f, objects)
+        commit()
+
+    def test_add_thin_pack(self):
+        delta = create_delta(self.base.data, self.target.data)
+        self.add_thin_pack([(7, (hex_to_sha(self.base.id), delta))])
+        self.assertEquals(1, len(self.store.packs))
+        pack = self.store.packs[0]
+        self.assertEquals(sorted([self.base.id, self.target.id]), 
+                          sorted(pack))
+        self.assertTrue(pack.check())
+        # The delta is kept, and its base appended after it
+        target_offset = pack.idx.object_index(self.target.id)
+        self.assertEquals(7, pack.data.get_stored_header_at(target_offset)[0])
+        self.assertTrue(target_offset < pack.idx.object_index(self.base.id))
+        self.assertEquals(self.target.data, pack[self.target.id].data)
+        # The thin pack itself was moved into place
+        self.assertEquals(["pack-%s.idx" % pack.name(), 
+                           "pack-%s.pack" % pack.name()],
+                          sorted(os.listdir(os.path.join(self.path, "pack"))))
+
+    def test_base_in_pack(self):
+        delta = create_delta(self.base.data, self.target.data)
+        self.add_thin_pack([(7, (hex_to_sha(self.base.id), delta)), 
+                            (3, self.base.data)])
+        pack = self.store.packs[0]
+        self.assertEquals(2, len(pack))
+        self.assertTrue(pack.check())
+        self.assertEquals(self.target.data, pack[self.target.id].data)
+
+    def test_move_in_thin_pack(self):
+        delta = create_delta(self.base.data, self.target.data)
+        path = os.path.join(self.path, "pack", "thin.pack")
+        self.write_thin_pack(open(path, 'wb'), 
+                             [(7, (hex_to_sha(self.base.id), delta))])
+        self.store.move_in_thin_pack(path)
+        pack = self.store.packs[0]
+        self.assertEquals(2, len(pack))
+        self.assertTrue(pack.check())
+        self.assertEquals(self.target.data, pack[self.target.id].data)
+        # The checksums cover the entries as they are stored
+        data = open(pack.data._filename, 'rb').read()
+        (target_offset, base_offset) = sorted(
+            [pack.idx.object_index(sha) for sha in (self.target.id, 
+                                                    self.base.id)])
+        self.assertEquals(
+            [zlib.crc32(data[target_offset:base_offset]) & 0xffffffff, 
+             zlib.crc32(data[base_offset:-20]) & 0xffffffff],
+            [crc32 for (name, offset, crc32) in sorted(
+                pack.idx.iterentries(), key=lambda entry: entry[1])])
@@ -23,7 +23,8 @@ import unittest
 from dulwich.objects import (Blob,
                          Tree,
                          Commit,
-                         Tag
+                         Tag,
+                         read_loose_object_chunks,
                          )
 
 a_sha = '6f670c0fb53f9463760b7295fbb814e965fb20c8'
@@ -75,6 +76,31 @@ class BlobReadTests(unittest.TestCase):
     self.assertEqual(b.data, string)
     self.assertEqual(b.sha().hexdigest(), c_sha)
 
+  def test_read_chunks(self):
+    path = os.path.join(os.path.dirname(__file__), 'data', 'blobs', a_sha)
+    type, size, chunks = read_loose_object_chunks(path, chunk_size=2)
+    self.assertEqual(Blob._num_type, type)
+    self.assertEqual(7, size)
+    self.assertEqual('test 1\n', "".join(chunks))
+
+  def test_read_chunks_legacy(self):
+    path = os.path.join(os.path.dirname(__file__), 'data', 'blobs', c_sha)
+    type, size, chunks = read_loose_object_chunks(path, chunk_size=2)
+    self.assertEqual(Blob._num_type, type)
+    self.assertEqual(7, size)
+    self.assertEqual('test 3\n', "".join(chunks))
+
+  def test_iter_chunks(self):
+    b = Blob.from_string('test 2\n')
+    self.assertEqual(['tes', 't 2', '\n'], list(b.iter_chunks(3)))
+
+  def test_from_chunk_source(self):
+    b = Blob.from_chunk_source(7, lambda: iter(['test', ' 2\n']))
+    self.assertEqual(7, b.size)
+    self.assertEqual(['test', ' 2\n'], list(b.iter_chunks()))
+    self.assertEqual(b_sha, b.sha().hexdigest())
+    self.assertEqual('test 2\n', b.data)
+
   def test_eq(self):
     blob1 = self.get_blob(a_sha)
     blob2 = self.get_blob(a_sha)
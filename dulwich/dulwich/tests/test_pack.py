@@ -17,21 +17,33 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA  02110-1301, USA.
 
+import hashlib
 import os
+import shutil
+import struct
+import tempfile
 import unittest
+import zlib
 
+from dulwich import pack
 from dulwich.objects import (
+        Blob,
         Tree,
         )
 from dulwich.pack import (
+        DeltaBaseCache,
         Pack,
         PackIndex,
         PackData,
+        PackReceiver,
+        SHA1Writer,
         hex_to_sha,
         sha_to_hex,
         write_pack_index_v1,
         write_pack_index_v2,
         write_pack,
+        write_pack_object,
+        write_pack_pipelined,
         apply_delta,
         create_delta,
         )
@@ -42,6 +54,21 @@ a_sha = '6f670c0fb53f9463760b7295fbb814e965fb20c8'
 tree_sha = 'b2a2766a2879c209ab1176e7e778b81ae422eeaa'
 commit_sha = 'f18faa16531ac570a3fdc8c7ca16682548dafd12'
 
+def write_delta_pack(basename, base_text, target_text):
+  """Write a pack with a blob and an offset delta against it."""
+  f = SHA1Writer(open(basename + ".pack", 'wb'))
+  f.write("PACK")
+  f.write(struct.pack(">L", 2))
+  f.write(struct.pack(">L", 2))
+  base_offset = write_pack_object(f, 3, base_text)
+  delta_offset = f.tell()
+  write_pack_object(f, 6, (delta_offset - base_offset, 
+                           create_delta(base_text, target_text)))
+  f.close()
+  PackData(basename + ".pack").create_index_v2(basename + ".idx")
+  return base_offset, delta_offset
+
+
 class PackTests(unittest.TestCase):
   """Base class for testing packs"""
 
@@ -141,6 +168,15 @@ class TestPackData(PackTests):
     p = self.get_pack_data(pack1_sha)
     self.assertEquals(set([('og\x0c\x0f\xb5?\x94cv\x0br\x95\xfb\xb8\x14\xe9e\xfb \xc8', 178, -1718046665), ('\xb2\xa2vj(y\xc2\t\xab\x11v\xe7\xe7x\xb8\x1a\xe4"\xee\xaa', 138, -901046474), ('\xf1\x8f\xaa\x16S\x1a\xc5p\xa3\xfd\xc8\xc7\xca\x16h%H\xda\xfd\x12', 12, 1185722901)]), set(p.iterentries()))
 
+  def test_get_object_chunks_at(self):
+    p = self.get_pack_data(pack1_sha)
+    type, size, chunks = p.get_object_chunks_at(178, chunk_size=2)
+    self.assertEquals(3, type)
+    self.assertEquals(7, size)
+    chunks = list(chunks)
+    self.assertEquals('test 1\n', "".join(chunks))
+    self.assertEquals(2, max([len(c) for c in chunks]))
+
   def test_create_index_v1(self):
     p = self.get_pack_data(pack1_sha)
     p.create_index_v1("v1test.idx")
@@ -188,6 +224,18 @@ class TestPack(PackTests):
         self.assertEqual(obj._type, 'commit')
         self.assertEqual(obj.sha().hexdigest(), commit_sha)
 
+    def test_get_raw_chunks(self):
+        p = self.get_pack(pack1_sha)
+        type, size, chunks = p.get_raw_chunks(a_sha)
+        self.assertEquals(3, type)
+        self.assertEquals(7, size)
+        self.assertEquals('test 1\n', "".join(chunks))
+
+    def test_get_object_size(self):
+        p = self.get_pack(pack1_sha)
+        self.assertEquals(7, p.get_object_size(a_sha))
+        self.assertRaises(KeyError, p.get_object_size, "ff" * 20)
+
     def test_copy(self):
         p = self.get_pack(pack1_sha)
         write_pack("Elch", p.iterobjects(), len(p))
@@ -204,6 +252,266 @@ class TestPack(PackTests):
         self.assertEquals(pack1_sha, p.name())
 
 
+class TestDeltaPack(unittest.TestCase):
+
+    base_text = "a" * 100 + "base\n"
+    target_text = "a" * 100 + "target\n"
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.basename = os.path.join(self.tempdir, "pack-delta")
+        self.offsets = write_delta_pack(self.basename, self.base_text, 
+                                        self.target_text)
+        self.base_sha = Blob.from_string(self.base_text).id
+        self.target_sha = Blob.from_string(self.target_text).id
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_get(self):
+        p = Pack(self.basename)
+        self.assertEquals(self.target_text, p[self.target_sha].data)
+        self.assertEquals(self.base_text, p[self.base_sha].data)
+
+    def test_resolve_object_at_cache(self):
+        p = Pack(self.basename)
+        cache = DeltaBaseCache()
+        self.assertEquals((3, self.target_text), 
+                          p.resolve_object_at(self.offsets[1], cache=cache))
+        self.assertTrue(self.offsets[0] in cache)
+        self.assertTrue(self.offsets[1] in cache)
+
+    def test_get_raw_many(self):
+        p = Pack(self.basename)
+        self.assertEquals([(self.base_sha, 3, self.base_text), 
+                           (self.target_sha, 3, self.target_text)],
+            list(p.get_raw_many([self.target_sha, self.base_sha])))
+
+    def test_get_object_size(self):
+        p = Pack(self.basename)
+        self.assertEquals(len(self.target_text), 
+                          p.get_object_size(self.target_sha))
+        self.assertEquals(len(self.base_text), 
+                          p.get_object_size(self.base_sha))
+
+    def test_iterobjects(self):
+        p = Pack(self.basename)
+        self.assertEquals([self.base_text, self.target_text], 
+                          [o.data for o in p.iterobjects()])
+
+
+class TestDeltaBaseCache(unittest.TestCase):
+
+    def test_add(self):
+        cache = DeltaBaseCache()
+        cache.add(12, 3, "foo")
+        self.assertTrue(12 in cache)
+        self.assertEquals((3, "foo"), cache[12])
+
+    def test_evict(self):
+        cache = DeltaBaseCache(max_size=5)
+        cache.add(12, 3, "foo")
+        cache.add(20, 3, "bar")
+        self.assertFalse(12 in cache)
+        self.assertTrue(20 in cache)
+
+    def test_too_large(self):
+        cache = DeltaBaseCache(max_size=2)
+        cache.add(12, 3, "foo")
+        self.assertFalse(12 in cache)
+
+
+class TestWritePackPipelined(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.basename = os.path.join(self.tempdir, "pack-pipelined")
+        self.blobs = dict((b.id, b) for b in 
+                          [Blob.from_string("blob %d\n" % i) for i in range(50)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def get_raw(self, sha):
+        return self.blobs[sha].as_raw_string()
+
+    def test_write(self):
+        messages = []
+        f = open(self.basename + ".pack", 'wb')
+        try:
+            entries, checksum = write_pack_pipelined(f, iter(self.blobs), 
+                self.get_raw, messages.append, queue_size=2)
+        finally:
+            f.close()
+        self.assertEquals(50, len(entries))
+        entries.sort()
+        write_pack_index_v2(self.basename + ".idx", entries, checksum)
+        p = Pack(self.basename)
+        p.check()
+        self.assertEquals(sorted(self.blobs), sorted(p))
+        for sha, blob in self.blobs.iteritems():
+            self.assertEquals(blob.data, p[sha].data)
+        self.assertTrue("counting objects: 50, done.\n" in messages)
+        self.assertEquals("writing objects: 50, done.\n", messages[-1])
+
+    def test_small_spool(self):
+        # Compressing has to wait for counting to finish
+        old_spool_size = pack.PIPELINE_SPOOL_SIZE
+        pack.PIPELINE_SPOOL_SIZE = 10
+        try:
+            self.test_write()
+        finally:
+            pack.PIPELINE_SPOOL_SIZE = old_spool_size
+
+    def test_empty(self):
+        f = open(self.basename + ".pack", 'wb')
+        try:
+            entries, checksum = write_pack_pipelined(f, iter([]), self.get_raw)
+        finally:
+            f.close()
+        self.assertEquals([], entries)
+        self.assertEquals(0, len(PackData(self.basename + ".pack")))
+
+    def test_read_error(self):
+        def get_raw(sha):
+            raise KeyError(sha)
+        f = open(self.basename + ".pack", 'wb')
+        try:
+            self.assertRaises(KeyError, write_pack_pipelined, f, 
+                              iter(self.blobs), get_raw)
+        finally:
+            f.close()
+
+
+class TestPackReceiver(unittest.TestCase):
+
+    base_text = "a" * 100 + "base\n"
+    target_text = "a" * 100 + "target\n"
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.base = Blob.from_string(self.base_text)
+        self.target = Blob.from_string(self.target_text)
+        self.delta = create_delta(self.base_text, self.target_text)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_pack(self, objects):
+        f = SHA1Writer(open(os.path.join(self.tempdir, "in.pack"), 'wb'))
+        f.write("PACK")
+        f.write(struct.pack(">L", 2))
+        f.write(struct.pack(">L", len(objects)))
+        offsets = []
+        for type, obj in objects:
+            if type == 6: # offset delta, against the object at an index
+                obj = (f.tell() - offsets[obj[0]], obj[1])
+            offsets.append(write_pack_object(f, type, obj))
+        f.close()
+        return open(os.path.join(self.tempdir, "in.pack"), 'rb').read()
+
+    def receive(self, data, chunk_size, resolve_ext_ref=None, 
+                fix_thin=False):
+        path = os.path.join(self.tempdir, "out.pack")
+        receiver = PackReceiver(open(path, 'w+b'), resolve_ext_ref, 
+                                fix_thin)
+        for i in range(0, len(data), chunk_size):
+            receiver.write(data[i:i+chunk_size])
+        return receiver, path
+
+    def names(self, entries):
+        return sorted([(sha_to_hex(name), offset) 
+                       for (name, offset, crc32) in entries])
+
+    def test_empty(self):
+        receiver, path = self.receive("", 1)
+        self.assertEquals(None, receiver.close())
+        self.assertEquals(None, receiver.entries)
+
+    def test_chunk_sizes(self):
+        data = self.make_pack([(3, self.base_text), (6, (0, self.delta)), 
+                               (3, "")])
+        for chunk_size in (1, 7, len(data)):
+            receiver, path = self.receive(data, chunk_size)
+            entries, pack_checksum = receiver.close()
+            self.assertEquals(data, open(path, 'rb').read())
+            self.assertEquals(data[-20:], pack_checksum)
+            self.assertEquals(self.names(PackData(path).iterentries()), 
+                              self.names(entries))
+
+    def test_crc32(self):
+        data = self.make_pack([(3, self.base_text), (3, self.target_text)])
+        receiver, path = self.receive(data, 10)
+        entries, pack_checksum = receiver.close()
+        entries.sort(key=lambda entry: entry[1])
+        self.assertEquals(zlib.crc32(data[12:entries[1][1]]), entries[0][2])
+        self.assertEquals(zlib.crc32(data[entries[1][1]:-20]), entries[1][2])
+
+    def test_ref_delta_before_base(self):
+        data = self.make_pack([(7, (hex_to_sha(self.base.id), self.delta)), 
+                               (3, self.base_text)])
+        receiver, path = self.receive(data, 5)
+        entries, pack_checksum = receiver.close()
+        self.assertEquals(sorted([self.base.id, self.target.id]), 
+                          [sha_to_hex(entry[0]) for entry in sorted(entries)])
+
+    def test_base_not_in_cache(self):
+        data = self.make_pack([(3, self.base_text), (6, (0, self.delta))])
+        receiver, path = self.receive(data, 5)
+        receiver._cache = pack.DeltaBaseCache(max_size=0)
+        receiver.write("")
+        entries, pack_checksum = receiver.close()
+        self.assertEquals(sorted([self.base.id, self.target.id]), 
+                          [sha_to_hex(entry[0]) for entry in sorted(entries)])
+
+    def test_thin(self):
+        data = self.make_pack([(7, (hex_to_sha(self.base.id), self.delta))])
+        resolve = {hex_to_sha(self.base.id): (3, self.base_text)}.__getitem__
+        receiver, path = self.receive(data, 3, resolve)
+        entries, pack_checksum = receiver.close()
+        self.assertEquals([(self.target.id, 12)], self.names(entries))
+        self.assertEquals(data, open(path, 'rb').read())
+
+    def test_fix_thin(self):
+        data = self.make_pack([(7, (hex_to_sha(self.base.id), self.delta))])
+        resolve = {hex_to_sha(self.base.id): (3, self.base_text)}.__getitem__
+        receiver, path = self.receive(data, 3, resolve, fix_thin=True)
+        entries, pack_checksum = receiver.close()
+        self.assertEquals(self.names(PackData(path).iterentries()), 
+                          self.names(entries))
+        self.assertEquals(pack_checksum, open(path, 'rb').read()[-20:])
+        self.assertTrue(PackData(path).check())
+
+    def test_missing_base(self):
+        data = self.make_pack([(7, (hex_to_sha(self.base.id), self.delta))])
+        receiver, path = self.receive(data, 3)
+        self.assertRaises(KeyError, receiver.close)
+
+    def test_invalid_base_offset(self):
+        data = self.make_pack([(3, self.base_text), (3, self.target_text)])
+        delta_offset = max([entry[1] for entry in PackData(
+            os.path.join(self.tempdir, "in.pack")).iterentries()])
+        # Replace the second object by a delta against the middle of the 
+        # first one
+        data = (data[:delta_offset] + 
+                pack.pack_object_header(6, len(self.delta), 
+                                        delta_offset - 13) + 
+                zlib.compress(self.delta))
+        data += hashlib.sha1(data).digest()
+        receiver, path = self.receive(data, 3)
+        self.assertRaises(AssertionError, receiver.close)
+
+    def test_truncated(self):
+        data = self.make_pack([(3, self.base_text)])
+        receiver, path = self.receive(data[:-21], 3)
+        self.assertRaises(AssertionError, receiver.close)
+
+    def test_bad_checksum(self):
+        data = self.make_pack([(3, self.base_text)])
+        receiver, path = self.receive(data[:-1] + "\0", 3)
+        self.assertRaises(AssertionError, receiver.close)
+
+
 class TestHexToSha(unittest.TestCase):
 
     def test_simple(self):
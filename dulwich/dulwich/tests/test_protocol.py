@@ -0,0 +1,145 @@
+# test_protocol.py -- Tests for the git protocol
+# 
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+from cStringIO import StringIO
+from unittest import TestCase
+
+from dulwich.errors import HangupException
+from dulwich.protocol import (
+        MAX_SIDEBAND_SIZE,
+        Protocol,
+        extract_capabilities,
+        )
+
+
+class FakeSocket(object):
+    """recv() implementation that returns at most a few bytes at a time."""
+
+    def __init__(self, data, max_recv=None):
+        self.data = data
+        self.max_recv = max_recv
+        self.calls = 0
+
+    def recv(self, size):
+        self.calls += 1
+        if self.max_recv is not None:
+            size = min(size, self.max_recv)
+        ret = self.data[:size]
+        self.data = self.data[size:]
+        return ret
+
+
+class ProtocolTests(TestCase):
+
+    def setUp(self):
+        self.rin = StringIO()
+        self.rout = StringIO()
+        self.proto = Protocol(self.rin.read, self.rout.write)
+
+    def test_write_pkt_line_none(self):
+        self.proto.write_pkt_line(None)
+        self.proto.flush()
+        self.assertEquals("0000", self.rout.getvalue())
+
+    def test_write_pkt_line(self):
+        self.proto.write_pkt_line("bla")
+        self.proto.flush()
+        self.assertEquals("0007bla", self.rout.getvalue())
+
+    def test_write_buffered(self):
+        self.proto.write_pkt_line("bla")
+        self.proto.write_pkt_line(None)
+        self.assertEquals("", self.rout.getvalue())
+        self.proto.flush()
+        self.assertEquals("0007bla0000", self.rout.getvalue())
+
+    def test_read_flushes(self):
+        self.rin.write("0008cmd ")
+        self.rin.seek(0)
+        self.proto.write_pkt_line("bla")
+        self.assertEquals("cmd ", self.proto.read_pkt_line())
+        self.assertEquals("0007bla", self.rout.getvalue())
+
+    def test_read_pkt_line(self):
+        self.rin.write("0008cmd ")
+        self.rin.seek(0)
+        self.assertEquals("cmd ", self.proto.read_pkt_line())
+
+    def test_read_pkt_line_none(self):
+        self.rin.write("0000")
+        self.rin.seek(0)
+        self.assertEquals(None, self.proto.read_pkt_line())
+
+    def test_read_pkt_line_hangup(self):
+        self.assertRaises(HangupException, self.proto.read_pkt_line)
+
+    def test_read_pkt_seq(self):
+        self.rin.write("0008cmd 0007bla0000")
+        self.rin.seek(0)
+        self.assertEquals(["cmd ", "bla"], list(self.proto.read_pkt_seq()))
+
+    def test_send_cmd(self):
+        self.proto.send_cmd("fetch", "a", "b")
+        self.proto.flush()
+        self.assertEquals("000efetch a\x00b\x00", self.rout.getvalue())
+
+    def test_read_cmd(self):
+        self.rin.write("0012cmd arg1\x00arg2\x00")
+        self.rin.seek(0)
+        self.assertEquals(("cmd", ["arg1", "arg2", ""]), self.proto.read_cmd())
+
+    def test_write_sideband(self):
+        blob = "x" * (MAX_SIDEBAND_SIZE + 1)
+        self.proto.write_sideband(1, blob)
+        self.proto.flush()
+        self.assertEquals("fff0\x01" + "x" * MAX_SIDEBAND_SIZE + "0006\x01x",
+                          self.rout.getvalue())
+
+
+class BufferedProtocolTests(TestCase):
+
+    def test_read_pkt_lines_buffered(self):
+        sock = FakeSocket("0008cmd 0007bla0000")
+        proto = Protocol(None, None, sock.recv)
+        self.assertEquals(["cmd ", "bla"], list(proto.read_pkt_seq()))
+        self.assertEquals(1, sock.calls)
+
+    def test_read_pkt_line_split(self):
+        sock = FakeSocket("0008cmd 0007bla", max_recv=3)
+        proto = Protocol(None, None, sock.recv)
+        self.assertEquals("cmd ", proto.read_pkt_line())
+        self.assertEquals("bla", proto.read_pkt_line())
+
+    def test_read_after_pkt_lines(self):
+        sock = FakeSocket("0008cmd PACKdata")
+        proto = Protocol(None, None, sock.recv)
+        self.assertEquals("cmd ", proto.read_pkt_line())
+        self.assertEquals("PACK", proto.read(4))
+        self.assertEquals("data", proto.read())
+
+    def test_read_pkt_line_hangup(self):
+        proto = Protocol(None, None, FakeSocket("").recv)
+        self.assertRaises(HangupException, proto.read_pkt_line)
+
+
+class CapabilitiesTestCase(TestCase):
+
+    def test_plain(self):
+        self.assertEquals(("bla", None), extract_capabilities("bla"))
+
+    def test_caps(self):
+        self.assertEquals(("bla", ["la", "la"]), extract_capabilities("bla\0la\0la"))
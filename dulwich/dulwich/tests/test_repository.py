@@ -18,9 +18,12 @@
 # MA  02110-1301, USA.
 
 import os
+import shutil
+import tempfile
 import unittest
 
 from dulwich import errors
+from dulwich.objects import Commit, Tree
 from dulwich.repo import Repo
 
 missing_sha = 'b91fa4d900g17e99b433218e988c4eb4a3e9a097'
@@ -131,3 +134,141 @@ class RepositoryTests(unittest.TestCase):
   def test_get_tags_empty(self):
    r = self.open_repo('ooo_merge')
    self.assertEquals({}, r.get_tags())
+
+
+class AncestryTests(unittest.TestCase):
+  """Tests for the ancestry queries, on this history:
+
+        f
+       / \
+  a - b - c - d
+   \     /
+    - e -    g
+  """
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    Repo.init_bare(self.path)
+    self.repo = Repo(self.path)
+    a = self.add_commit([], 1)
+    b = self.add_commit([a], 2)
+    e = self.add_commit([a], 3)
+    c = self.add_commit([b, e], 4)
+    f = self.add_commit([b], 5)
+    d = self.add_commit([c, f], 6)
+    g = self.add_commit([], 7)
+    self.shas = dict(a=a, b=b, c=c, d=d, e=e, f=f, g=g)
+
+  def tearDown(self):
+    if self.repo.object_store.commit_graph is not None:
+      self.repo.object_store.commit_graph.close()
+    shutil.rmtree(self.path)
+
+  def add_commit(self, parents, age):
+    c = Commit()
+    c._tree = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+    c._parents = parents
+    c._author = c._committer = "Joe Example <joe@example.com>"
+    c._commit_time = 1234560000 + age
+    c._message = "Commit %d\n" % age
+    c.serialize()
+    return self.repo.object_store.add_object(c)
+
+  def names(self, shas):
+    names = dict((sha, name) for (name, sha) in self.shas.iteritems())
+    return sorted([names[sha] for sha in shas])
+
+  def check(self):
+    s = self.shas
+    self.assertTrue(self.repo.is_ancestor(s['a'], s['d']))
+    self.assertTrue(self.repo.is_ancestor(s['e'], s['d']))
+    self.assertTrue(self.repo.is_ancestor(s['d'], s['d']))
+    self.assertFalse(self.repo.is_ancestor(s['d'], s['a']))
+    self.assertFalse(self.repo.is_ancestor(s['e'], s['f']))
+    self.assertFalse(self.repo.is_ancestor(s['g'], s['d']))
+    self.assertEquals(['b'], self.names(self.repo.merge_base(s['c'], s['f'])))
+    self.assertEquals(['a'], self.names(self.repo.merge_base(s['e'], s['f'])))
+    self.assertEquals(['c'], self.names(self.repo.merge_base(s['c'], s['d'])))
+    self.assertEquals([], self.repo.merge_base(s['d'], s['g']))
+    self.assertEquals(['a'], self.names(
+        self.repo.find_common_ancestors([s['d'], s['e'], s['f']])))
+    self.assertEquals(['b'], self.names(
+        self.repo.find_common_ancestors([s['d'], s['f'], s['c']])))
+    self.assertEquals(['d', 'g'], self.names(
+        self.repo.independent([s['a'], s['d'], s['e'], s['g']])))
+    self.assertEquals(['c', 'd', 'e'], self.names(
+        self.repo.find_unique_ancestors(s['d'], [s['f']])))
+    self.assertEquals(set(), 
+        self.repo.find_unique_ancestors(s['b'], [s['f'], s['e']]))
+
+  def test_merge_base_long_branches(self):
+    # Many commits are queued at once while the walk goes down the two 
+    # branches, and it has to stop at the fork, not at the root
+    tips = []
+    for branch in range(2):
+      tip = self.shas['d']
+      for i in range(200):
+        tip = self.add_commit([tip], 10 + 2 * i + branch)
+      tips.append(tip)
+    self.assertEquals([self.shas['d']], self.repo.merge_base(*tips))
+
+  def test_revision_history(self):
+    history = self.repo.revision_history(self.shas['d'])
+    self.assertEquals([self.shas[n] for n in "dfceba"], 
+                      [c.id for c in history])
+
+  def test_iter_revision_history_missing_parent(self):
+    h = self.add_commit([missing_sha], 8)
+    history = self.repo.iter_revision_history(h)
+    self.assertEquals(h, history.next().id)
+    self.assertRaises(errors.MissingCommitError, history.next)
+
+  def test_get_parent_map(self):
+    s = self.shas
+    tree = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+    self.assertEquals({s['a']: [], s['c']: [s['b'], s['e']]},
+        self.repo.get_parent_map([s['a'], s['c'], 'f' * 40, tree]))
+
+  def test_get_parent_map_commit_graph(self):
+    s = self.shas
+    self.repo.object_store.add_to_commit_graph([s['c']])
+    self.assertEquals({s['c']: [s['b'], s['e']], s['f']: [s['b']]},
+        self.repo.get_parent_map([s['c'], s['f']]))
+
+  def test_without_commit_graph(self):
+    self.check()
+
+  def test_with_commit_graph(self):
+    self.repo.object_store.add_to_commit_graph(self.shas.values())
+    self.check()
+
+  def test_with_partial_commit_graph(self):
+    self.repo.object_store.add_to_commit_graph([self.shas['c']])
+    self.check()
+
+  def test_fetch(self):
+    s = self.shas
+    tree = Tree()
+    tree.serialize()
+    self.repo.object_store.add_object(tree)
+    self.repo.set_ref("refs/heads/master", s['d'])
+    target_path = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, target_path)
+    Repo.init_bare(target_path)
+    target = Repo(target_path)
+    refs = self.repo.fetch(target)
+    self.assertEquals(s['d'], refs["refs/heads/master"])
+    for name in "abcdef":
+      self.assertTrue(s[name] in target.object_store)
+    self.assertFalse(s['g'] in target.object_store)
+    self.assertEquals(1, len(target.object_store.packs))
+    self.assertEquals(7, len(target.object_store.packs[0]))
+    self.assertEquals(4, target.object_store.commit_graph.get_generation(s['d']))
+    target.set_ref("refs/heads/master", s['d'])
+    h = self.add_commit([s['d']], 8)
+    self.repo.set_ref("refs/heads/master", h)
+    self.repo.fetch(target)
+    # Only the new commit is copied
+    self.assertEquals([1, 7], 
+                      sorted([len(p) for p in target.object_store.packs]))
+    target.object_store.commit_graph.close()
@@ -0,0 +1,517 @@
+# test_server.py -- Tests for the git server
+# 
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+from cStringIO import StringIO
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from dulwich.async_server import AsyncTCPGitServer
+from dulwich.client import (
+        HAVES_PER_FLUSH,
+        SimpleFetchGraphWalker,
+        TCPGitClient,
+        )
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.pack import Pack, PackData, write_pack_data
+from dulwich.protocol import Protocol
+from dulwich.repo import Repo
+from dulwich.server import (
+        Backend,
+        ForkingTCPGitServer,
+        GitBackend,
+        ProtocolGraphWalker,
+        ReceivePackHandler,
+        TCPGitServer,
+        ThreadedTCPGitServer,
+        UploadPackHandler,
+        implements,
+        make_server,
+        )
+
+
+def make_test_repo(path, num_commits):
+    """Create a bare repository with a linear history.
+
+    :return: Set with the shas of all objects in the repository
+    """
+    os.mkdir(path)
+    Repo.init_bare(path)
+    repo = Repo(path)
+    objects = []
+    parents = []
+    for i in range(num_commits):
+        blob = Blob.from_string("contents %d\n" % i)
+        subtree = Tree()
+        subtree.add(0100644, "file", blob.id)
+        subtree.serialize()
+        tree = Tree()
+        tree.add(stat.S_IFDIR, "dir", subtree.id)
+        tree.serialize()
+        commit = Commit()
+        commit._tree = tree.id
+        commit._parents = parents
+        commit._author = commit._committer = "Joe Foo <joe@foo.com>"
+        commit._commit_time = 1234567890 + i
+        commit._message = "commit %d\n" % i
+        commit.serialize()
+        objects.extend([blob, subtree, tree, commit])
+        parents = [commit.id]
+    repo.object_store.add_objects(objects)
+    repo.set_ref("refs/heads/master", parents[0])
+    return set([o.id for o in objects])
+
+
+class CountingBackend(Backend):
+    """Backend that keeps track of concurrent sessions.
+
+    Every session waits in get_refs until `wait_for` sessions are there at 
+    the same time (or `timeout` seconds have passed), so overlapping 
+    sessions are guaranteed to be noticed. Fetches send an empty pack.
+    """
+
+    def __init__(self, wait_for=1, timeout=5, refs=None):
+        self.wait_for = wait_for
+        self.timeout = timeout
+        self.refs = refs or {}
+        self.active = 0
+        self.peak = 0
+        self.fetches = 0
+        self._cond = threading.Condition()
+
+    def get_refs(self):
+        self._cond.acquire()
+        try:
+            self.active += 1
+            self.fetches += 1
+            self.peak = max(self.peak, self.active)
+            self._cond.notifyAll()
+            deadline = time.time() + self.timeout
+            while self.peak < self.wait_for and time.time() < deadline:
+                self._cond.wait(0.1)
+            self.active -= 1
+        finally:
+            self._cond.release()
+        return dict(self.refs)
+
+    def fetch_objects(self, determine_wants, graph_walker, progress):
+        if determine_wants(self.get_refs()):
+            while graph_walker.next():
+                pass
+        return (0, iter([]))
+
+
+class MultiAckClient(TCPGitClient):
+
+    def fetch_capabilities(self, server_capabilities):
+        return ["multi_ack", "side-band-64k"]
+
+
+class SingleAckClient(TCPGitClient):
+
+    def fetch_capabilities(self, server_capabilities):
+        return ["side-band-64k"]
+
+
+class ProtocolGraphWalkerTests(TestCase):
+
+    # A history of four commits, "1" being the oldest
+    parents = {"4" * 40: ["3" * 40], "3" * 40: ["2" * 40], 
+               "2" * 40: ["1" * 40], "1" * 40: []}
+
+    def negotiate(self, lines, capabilities, common=()):
+        """Run the negotiation for a client that wants "4" * 40.
+
+        :param lines: pkt-lines sent by the client, None for a flush-pkt
+        :param capabilities: Capabilities the client asked for
+        :param common: Commits the server has
+        :return: tuple with the haves seen and the lines sent in response
+        """
+        input = StringIO()
+        client = Protocol(None, input.write)
+        for line in lines:
+            client.write_pkt_line(line)
+        client.flush()
+        input.seek(0)
+        output = StringIO()
+        proto = Protocol(input.read, output.write)
+        walker = ProtocolGraphWalker(proto, self.parents.__getitem__)
+        walker.set_wants(["4" * 40], capabilities)
+        haves = []
+        have = walker.next()
+        while have:
+            haves.append(have)
+            if have in common:
+                walker.ack(have)
+            have = walker.next()
+        # Terminate the responses, so they can be read as a sequence
+        output.write("0000")
+        output.seek(0)
+        return haves, list(Protocol(output.read, None).read_pkt_seq())
+
+    def test_single_ack(self):
+        self.assertEquals((["3" * 40, "2" * 40], ["ACK %s\n" % ("3" * 40)]),
+            self.negotiate(["have %s\n" % ("3" * 40), 
+                            "have %s\n" % ("2" * 40), "done\n"], 
+                           [], common=["3" * 40, "2" * 40]))
+
+    def test_single_ack_nothing_in_common(self):
+        self.assertEquals((["9" * 40], ["NAK\n"]),
+            self.negotiate(["have %s\n" % ("9" * 40), "done\n"], 
+                           []))
+
+    def test_multi_ack(self):
+        # Once the client can stop, haves we don't know are acknowledged too
+        self.assertEquals(["ACK %s continue\n" % ("3" * 40), 
+                           "ACK %s continue\n" % ("9" * 40), "NAK\n", 
+                           "ACK %s\n" % ("3" * 40)],
+            self.negotiate(["have %s\n" % ("3" * 40), 
+                            "have %s\n" % ("9" * 40), None, "done\n"], 
+                           ["multi_ack"], common=["3" * 40])[1])
+
+    def test_multi_ack_detailed_ready(self):
+        self.assertEquals(["ACK %s common\n" % ("3" * 40), 
+                           "ACK %s ready\n" % ("3" * 40), "NAK\n", 
+                           "ACK %s\n" % ("3" * 40)],
+            self.negotiate(["have %s\n" % ("3" * 40), None, "done\n"], 
+                           ["multi_ack_detailed"], common=["3" * 40])[1])
+
+    def test_multi_ack_detailed_not_ready(self):
+        # The client has something we don't, so it may have more in common
+        self.assertEquals(["ACK %s common\n" % ("3" * 40), "NAK\n"],
+            self.negotiate(["have %s\n" % ("9" * 40), 
+                            "have %s\n" % ("3" * 40), None, "done\n"], 
+                           ["multi_ack_detailed"], common=["3" * 40])[1][:2])
+
+    def test_no_done(self):
+        # The negotiation ends at the flush-pkt, without waiting for the 
+        # haves and the done that follow it
+        self.assertEquals((["3" * 40], 
+                           ["ACK %s common\n" % ("3" * 40), 
+                            "ACK %s ready\n" % ("3" * 40), "NAK\n", 
+                            "ACK %s\n" % ("3" * 40)]),
+            self.negotiate(["have %s\n" % ("3" * 40), None, 
+                            "have %s\n" % ("2" * 40), None, "done\n"], 
+                           ["multi_ack_detailed", "no-done"], 
+                           common=["3" * 40, "2" * 40]))
+
+
+class HandlerTests(TestCase):
+    """Run the handlers over a Protocol, the way bzr-upload-pack does."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "repo")
+        self.shas = make_test_repo(self.path, 3)
+        self.head = Repo(self.path).ref("refs/heads/master")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def run_handler(self, cls, backend, lines, data=""):
+        """Run a handler on the input of a client.
+
+        :param lines: pkt-lines sent by the client, None for a flush-pkt
+        :param data: Raw data sent by the client after the pkt-lines
+        :return: Protocol to read the output of the handler from
+        """
+        input = StringIO()
+        client = Protocol(None, input.write)
+        for line in lines:
+            client.write_pkt_line(line)
+        client.flush()
+        input.write(data)
+        input.seek(0)
+        output = StringIO()
+        proto = Protocol(input.read, output.write)
+        try:
+            cls(backend, proto).handle()
+        finally:
+            proto.flush()
+        output.seek(0)
+        return Protocol(output.read, None)
+
+    def test_implements(self):
+        backend = GitBackend(self.path)
+        self.assertTrue(implements(backend, "fetch_object_ids"))
+        self.assertTrue(implements(backend, "get_parents"))
+        backend = CountingBackend()
+        self.assertFalse(implements(backend, "fetch_object_ids"))
+        self.assertFalse(implements(backend, "get_parents"))
+
+    def test_upload_pack_fetch_objects(self):
+        # The refs are only advertised once by a backend without 
+        # fetch_object_ids
+        backend = CountingBackend(refs={"refs/heads/master": self.head})
+        output = self.run_handler(UploadPackHandler, backend, 
+            ["want %s side-band-64k\n" % self.head, None, "done\n"])
+        self.assertEquals(1, backend.fetches)
+        self.assertEquals(["%s refs/heads/master" % self.head], 
+            [line.split("\0")[0].rstrip("\n") 
+             for line in output.read_pkt_seq()])
+        self.assertEquals("NAK\n", output.read_pkt_line())
+
+    def test_upload_pack(self):
+        output = self.run_handler(UploadPackHandler, GitBackend(self.path), 
+            ["want %s side-band-64k\n" % self.head, None, "done\n"])
+        self.assertEquals(["%s HEAD" % self.head, 
+                           "%s refs/heads/master" % self.head], 
+            sorted([line.split("\0")[0].rstrip("\n") 
+                    for line in output.read_pkt_seq()]))
+        self.assertEquals("NAK\n", output.read_pkt_line())
+        basename = os.path.join(self.tempdir, "pack-upload")
+        f = open(basename + ".pack", 'wb')
+        try:
+            for line in output.read_pkt_seq():
+                if line[0] == "\x01":
+                    f.write(line[1:])
+        finally:
+            f.close()
+        PackData(basename + ".pack").create_index_v2(basename + ".idx")
+        self.assertEquals(self.shas, set(Pack(basename)))
+
+    def test_receive_pack(self):
+        target = os.path.join(self.tempdir, "target")
+        os.mkdir(target)
+        Repo.init_bare(target)
+        source = Repo(self.path)
+        data = StringIO()
+        write_pack_data(data, [source.get_object(sha) for sha in self.shas], 
+                        len(self.shas))
+        output = self.run_handler(ReceivePackHandler, GitBackend(target), 
+            ["%s %s refs/heads/master\0report-status\n" % ("0" * 40, 
+                                                            self.head), 
+             None], data.getvalue())
+        self.assertEquals(["%s capabilities^{} report-status delete-refs" % 
+                           ("0" * 40)], list(output.read_pkt_seq()))
+        repo = Repo(target)
+        self.assertEquals(self.head, repo.ref("refs/heads/master"))
+        self.assertEquals(self.shas, set(repo.object_store.packs[0]))
+
+
+class ServerTestCase(TestCase):
+
+    def start_server(self, server):
+        self.server = server
+        self.port = server.server_address[1]
+        self.thread = threading.Thread(target=server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def fetch(self, determine_wants=lambda refs: [], pack_data=None, 
+              graph_walker=None, client_class=TCPGitClient):
+        if graph_walker is None:
+            graph_walker = SimpleFetchGraphWalker([], None)
+        client = client_class("localhost", self.port)
+        try:
+            client.fetch_pack("/", determine_wants, graph_walker, pack_data, 
+                              lambda x: None)
+        finally:
+            client._socket.close()
+
+    def check_fetch_pack(self):
+        advertised = {}
+        data = []
+        def determine_wants(refs):
+            advertised.update(refs)
+            return refs.values()
+        self.fetch(determine_wants, data.append)
+        self.assertEquals({"refs/heads/master": "a" * 40}, advertised)
+        self.assertEquals("PACK", "".join(data)[:4])
+
+    def check_fetch_common_history(self, expected_haves, 
+                                   client_class=TCPGitClient):
+        """Fetch into a repository that has most of the history already.
+
+        :param expected_haves: Number of haves the client should send
+        """
+        tempdir = tempfile.mkdtemp()
+        try:
+            shas = make_test_repo(os.path.join(tempdir, "repo"), 300)
+            have = make_test_repo(os.path.join(tempdir, "local"), 200)
+            local = Repo(os.path.join(tempdir, "local"))
+            self.start_server(ThreadedTCPGitServer(
+                GitBackend(os.path.join(tempdir, "repo")), "localhost", 0))
+            basename = os.path.join(tempdir, "pack-fetch")
+            graph_walker = SimpleFetchGraphWalker(local.heads().values(), 
+                                                  local.get_parents)
+            haves = []
+            def next():
+                ret = SimpleFetchGraphWalker.next(graph_walker)
+                haves.append(ret)
+                return ret
+            graph_walker.next = next
+            f = open(basename + ".pack", 'wb')
+            try:
+                self.fetch(lambda refs: refs.values(), f.write, graph_walker,
+                           client_class)
+            finally:
+                f.close()
+            PackData(basename + ".pack").create_index_v2(basename + ".idx")
+            self.assertEquals(shas - have, set(Pack(basename)))
+            self.assertEquals(expected_haves, len(filter(None, haves)))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def run_clients(self, count):
+        errors = []
+        def run():
+            try:
+                self.fetch()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        self.assertEquals([], errors)
+        self.assertEquals([], [t for t in threads if t.isAlive()])
+
+
+class TCPGitServerTests(ServerTestCase):
+
+    def test_sequential(self):
+        backend = CountingBackend()
+        self.start_server(TCPGitServer(backend, "localhost", 0))
+        self.run_clients(3)
+        self.assertEquals(3, backend.fetches)
+        self.assertEquals(1, backend.peak)
+
+    def test_fetch_pack(self):
+        self.start_server(TCPGitServer(
+            CountingBackend(refs={"refs/heads/master": "a" * 40}), 
+            "localhost", 0))
+        self.check_fetch_pack()
+
+
+class ThreadedTCPGitServerTests(ServerTestCase):
+
+    def test_simultaneous_clients(self):
+        backend = CountingBackend(wait_for=8)
+        self.start_server(ThreadedTCPGitServer(backend, "localhost", 0))
+        self.run_clients(8)
+        self.assertEquals(8, backend.fetches)
+        self.assertEquals(8, backend.peak)
+
+    def test_fetch_pack(self):
+        self.start_server(ThreadedTCPGitServer(
+            CountingBackend(refs={"refs/heads/master": "a" * 40}), 
+            "localhost", 0))
+        self.check_fetch_pack()
+
+    def test_clone(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            shas = make_test_repo(os.path.join(tempdir, "repo"), 50)
+            self.start_server(ThreadedTCPGitServer(
+                GitBackend(os.path.join(tempdir, "repo")), "localhost", 0))
+            basename = os.path.join(tempdir, "pack-clone")
+            f = open(basename + ".pack", 'wb')
+            try:
+                self.fetch(lambda refs: refs.values(), f.write)
+            finally:
+                f.close()
+            PackData(basename + ".pack").create_index_v2(basename + ".idx")
+            self.assertEquals(shas, set(Pack(basename)))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_fetch_common_history(self):
+        # The server acknowledges the first have and tells us it's ready 
+        # in its response to the first batch, which we read after sending 
+        # the second one
+        self.check_fetch_common_history(2 * HAVES_PER_FLUSH)
+
+    def test_fetch_common_history_multi_ack(self):
+        self.check_fetch_common_history(2 * HAVES_PER_FLUSH, MultiAckClient)
+
+    def test_fetch_common_history_single_ack(self):
+        # Without multi_ack all haves are sent before reading any response
+        self.check_fetch_common_history(200, SingleAckClient)
+
+    def test_max_connections(self):
+        backend = CountingBackend(wait_for=2)
+        self.start_server(ThreadedTCPGitServer(backend, "localhost", 0,
+                          max_connections=2))
+        self.run_clients(10)
+        self.assertEquals(10, backend.fetches)
+        self.assertEquals(2, backend.peak)
+
+    def test_connection_timeout(self):
+        backend = CountingBackend()
+        self.start_server(ThreadedTCPGitServer(backend, "localhost", 0,
+                          connection_timeout=0.2))
+        s = socket.create_connection(("localhost", self.port))
+        try:
+            s.settimeout(5)
+            # The server hangs up on us without waiting for a command
+            self.assertEquals("", s.recv(1))
+        finally:
+            s.close()
+        self.run_clients(1)
+
+    def test_shutdown_waits_for_sessions(self):
+        backend = CountingBackend(wait_for=2, timeout=0.5)
+        self.start_server(ThreadedTCPGitServer(backend, "localhost", 0))
+        client = threading.Thread(target=self.fetch)
+        client.start()
+        while not backend.fetches:
+            time.sleep(0.01)
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEquals(0, self.server.active_sessions())
+        self.assertEquals(0, backend.active)
+        client.join()
+
+
+class ForkingTCPGitServerTests(ServerTestCase):
+
+    def test_simultaneous_clients(self):
+        self.start_server(ForkingTCPGitServer(CountingBackend(), "localhost",
+                          0, max_connections=4))
+        self.run_clients(8)
+
+
+class MakeServerTests(TestCase):
+
+    def test_modes(self):
+        for mode, cls in [("single", TCPGitServer), 
+                          ("thread", ThreadedTCPGitServer), 
+                          ("fork", ForkingTCPGitServer),
+                          ("async", AsyncTCPGitServer)]:
+            server = make_server(CountingBackend(), "localhost", 0, mode, 
+                                 connection_timeout=10, max_connections=3)
+            try:
+                self.assertTrue(isinstance(server, cls))
+                self.assertEquals(10, server.connection_timeout)
+            finally:
+                server.server_close()
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, make_server, CountingBackend(), 
+                          "localhost", 0, "bogus")
@@ -14,10 +14,33 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-from bzrlib import osutils, ui, urlutils
-from bzrlib.errors import InvalidRevisionId
-from bzrlib.inventory import Inventory
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+from itertools import izip
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+from bzrlib import config, lru_cache, osutils, ui, urlutils
+from bzrlib.errors import (
+    InvalidRevisionId,
+    NoSuchFile,
+    NoSuchRevision,
+    NotLocalUrl,
+    )
+from bzrlib.inventory import (
+    ROOT_ID,
+    Inventory,
+    InventoryDirectory,
+    InventoryFile,
+    )
 from bzrlib.repository import InterRepository
+from bzrlib.revision import NULL_REVISION
 from bzrlib.trace import info
 from bzrlib.tsort import topo_sort
 
@@ -28,163 +51,833 @@ from bzrlib.plugins.git.repository import (
         GitFormat,
         )
 from bzrlib.plugins.git.remote import RemoteGitRepository
+from bzrlib.plugins.git.shamap import GitShaMap
 
-from dulwich.client import SimpleFetchGraphWalker
-from dulwich.objects import Commit
+from dulwich.client import SkippingFetchGraphWalker
+from dulwich.objects import Blob, Commit, Tree, sha_to_hex
+from dulwich.pack import Pack
+from dulwich.repo import Repo
 
 from cStringIO import StringIO
 
+# Maximum total size of the git objects kept in memory during an import
+OBJECT_CACHE_SIZE = 50 * 1024 * 1024
+
+# Maximum total number of entries of the inventories kept in memory during 
+# an import
+INVENTORY_CACHE_SIZE = 200000
 
-class BzrFetchGraphWalker(object):
+# Default number of revisions imported between write group commits
+CHECKPOINT_INTERVAL = 1000
 
-    def __init__(self, repository, mapping):
+
+class BzrFetchGraphWalker(SkippingFetchGraphWalker):
+    """Graph walker over the revisions in a Bazaar repository.
+
+    Revisions that weren't imported from git are walked through, but can't 
+    be sent as haves.
+    """
+
+    def __init__(self, repository, mapping, heads=None):
+        """Create a new graph walker.
+
+        :param heads: Revisions to start walking from. Defaults to the heads 
+            of all revisions in the repository, which means reading the 
+            parents of all of them.
+        """
         self.repository = repository
         self.mapping = mapping
-        self.done = set()
-        self.heads = set(repository.all_revision_ids())
-        self.parents = {}
+        if heads is None:
+            self._parent_map = repository.get_parent_map(
+                repository.all_revision_ids())
+            heads = set(self._parent_map)
+            for parents in self._parent_map.itervalues():
+                heads.difference_update(parents)
+        else:
+            self._parent_map = {}
+        SkippingFetchGraphWalker.__init__(self, heads, self._get_parents, 
+                                          self._get_commit_time)
+
+    def _get_parents(self, revid):
+        if revid == NULL_REVISION:
+            raise KeyError(revid)
+        parents = self._parent_map.get(revid)
+        if parents is None:
+            # Ghosts are left out of the parent map
+            parents = self.repository.get_parent_map([revid])[revid]
+            self._parent_map[revid] = parents
+        return parents
+
+    def _get_commit_time(self, revid):
+        # Raises KeyError for ghosts and the null revision
+        self._get_parents(revid)
+        return self.repository.get_revision(revid).timestamp
 
     def ack(self, sha):
         revid = self.mapping.revision_id_foreign_to_bzr(sha)
-        self.remove(revid)
-
-    def remove(self, revid):
-        self.done.add(revid)
-        if revid in self.heads:
-            self.heads.remove(revid)
-        if revid in self.parents:
-            for p in self.parents[revid]:
-                self.remove(p)
+        SkippingFetchGraphWalker.ack(self, revid)
 
     def next(self):
-        while self.heads:
-            ret = self.heads.pop()
-            ps = self.repository.get_parent_map([ret])[ret]
-            self.parents[ret] = ps
-            self.heads.update([p for p in ps if not p in self.done])
+        revid = SkippingFetchGraphWalker.next(self)
+        while revid is not None:
             try:
-                self.done.add(ret)
-                return self.mapping.revision_id_bzr_to_foreign(ret)
+                return self.mapping.revision_id_bzr_to_foreign(revid)
             except InvalidRevisionId:
-                pass
+                revid = SkippingFetchGraphWalker.next(self)
         return None
 
 
-def import_git_blob(repo, mapping, path, blob, inv, parent_invs, executable):
-    """Import a git blob object into a bzr repository.
+def chunks_to_lines(chunks):
+    """Split an iterator over chunks of text into lines.
+
+    :return: Tuple with list of lines, sha1 of the text and size of the text.
+    """
+    lines = []
+    sha1 = osutils.sha()
+    size = 0
+    for chunk in chunks:
+        sha1.update(chunk)
+        size += len(chunk)
+        chunk_lines = osutils.split_lines(chunk)
+        if lines and chunk_lines and not lines[-1].endswith("\n"):
+            lines[-1] += chunk_lines.pop(0)
+        lines.extend(chunk_lines)
+    return lines, sha1.hexdigest(), size
+
+
+def _is_tree(mode):
+    return (mode & 0700000) / 0100000 == 0
+
+
+def _is_blob(mode):
+    return (mode & 0700000) / 0100000 == 1
+
+
+def make_object_lookup(get_object, fallback=None):
+    """Wrap a function to look up git objects in a bounded cache.
+
+    :param get_object: Function that returns the git object with a hex sha, 
+        and raises KeyError if there is no such object.
+    :param fallback: Optional function to call with the sha of objects 
+        that get_object doesn't have.
+    """
+    cache = lru_cache.LRUSizeCache(max_size=OBJECT_CACHE_SIZE,
+        compute_size=lambda obj: obj.raw_length())
+    def lookup_object(sha):
+        obj = cache.get(sha)
+        if obj is None:
+            try:
+                obj = get_object(sha)
+            except KeyError:
+                if fallback is None:
+                    raise
+                return fallback(sha)
+            cache.add(sha, obj)
+        return obj
+    return lookup_object
+
+
+def open_object_source(source):
+    """Open a source of git objects.
+
+    :param source: Either ("repo", path) for a git repository, or 
+        ("pack", basename) for a pack file and its index.
+    :return: Function that returns the git object with a hex sha, and 
+        raises KeyError if there is no such object.
+    """
+    (kind, path) = source
+    if kind == "repo":
+        return Repo(path).get_object
+    elif kind == "pack":
+        return Pack(path).__getitem__
+    raise ValueError("Unknown git object source %r" % (kind,))
+
+
+def diff_git_trees(lookup_object, path, tree, base_tree, changes):
+    """Find the changes between two git trees.
+
+    Entries are compared by mode and sha, so only changed subtrees are 
+    read. The contents of new and changed blobs are read and split into 
+    lines.
+
+    :param lookup_object: Function that returns the git object with a hex sha
+    :param path: Path of the trees
+    :param tree: A git tree object
+    :param base_tree: The git tree to compare with, or None
+    :param changes: List to which (path, old_mode, new_mode, hexsha, text) 
+        tuples are appended, with directories before their contents. 
+        old_mode is None for new entries, new_mode and hexsha are None for 
+        removed entries. text is a (lines, text_sha1, text_size) tuple for 
+        new and changed blobs and None otherwise.
+    """
+    base_entries = {}
+    if base_tree is not None:
+        for mode, name, hexsha in base_tree.entries():
+            base_entries[name] = (mode, hexsha)
+    for mode, name, hexsha in tree.entries():
+        base = base_entries.pop(name, None)
+        if base == (mode, hexsha):
+            continue
+        if path == "":
+            child_path = name
+        else:
+            child_path = urlutils.join(path, name)
+        if base is None:
+            old_mode = None
+        else:
+            old_mode = base[0]
+        if _is_tree(mode):
+            changes.append((child_path, old_mode, mode, hexsha, None))
+            if old_mode is not None and _is_tree(old_mode):
+                base_subtree = lookup_object(base[1])
+            else:
+                base_subtree = None
+            diff_git_trees(lookup_object, child_path, lookup_object(hexsha), 
+                           base_subtree, changes)
+        elif _is_blob(mode):
+            # Read the blob in chunks, so lazily read blobs never have to 
+            # be in memory in addition to their lines
+            text = chunks_to_lines(lookup_object(hexsha).iter_chunks())
+            changes.append((child_path, old_mode, mode, hexsha, text))
+        else:
+            raise AssertionError("Unknown blob kind, perms=%r." % (mode,))
+    for name in sorted(base_entries):
+        if path == "":
+            child_path = name
+        else:
+            child_path = urlutils.join(path, name)
+        changes.append((child_path, base_entries[name][0], None, None, None))
+
+
+def convert_git_commit(lookup_object, sha):
+    """Find the changes a git commit makes to the tree of its first parent.
+
+    This only reads git objects, so it can run in a different process 
+    than the one writing to the bzr repository.
+
+    :param lookup_object: Function that returns the git object with a hex sha
+    :param sha: Hex sha of the commit
+    :return: Tuple with a boolean indicating whether the tree of the first 
+        parent was found and the list of changes, as returned by 
+        diff_git_trees. The changes are against an empty tree if the tree 
+        of the first parent wasn't found.
+    """
+    commit = lookup_object(sha)
+    base_tree = None
+    if commit.parents:
+        try:
+            base_tree = lookup_object(lookup_object(commit.parents[0]).tree)
+        except KeyError:
+            pass
+    changes = []
+    diff_git_trees(lookup_object, "", lookup_object(commit.tree), base_tree, 
+                   changes)
+    return (base_tree is not None, changes)
+
+
+# Object lookup function of a conversion worker process
+_worker_lookup_object = None
+
+
+def _init_conversion_worker(source):
+    global _worker_lookup_object
+    _worker_lookup_object = make_object_lookup(open_object_source(source))
+
+
+def _convert_in_worker(sha):
+    """Convert a git commit with the objects in the git source alone.
+
+    :return: The result of convert_git_commit, or None if the commit needs 
+        objects that are only in the bzr repository, like the trees of 
+        parents that were imported by an earlier fetch. Those commits 
+        are converted by the process writing the revisions, which can 
+        reconstruct them.
+    """
+    try:
+        (has_basis, changes) = convert_git_commit(_worker_lookup_object, sha)
+    except KeyError:
+        return None
+    if not has_basis and _worker_lookup_object(sha).parents:
+        return None
+    return (has_basis, changes)
+
+
+def _iter_conversions_in_pool(pool, shas, window):
+    """Convert git commits in a process pool, yielding results in order.
+
+    At most window conversions are pending at a time, which bounds the 
+    memory used by converted texts that are waiting to be written.
+    """
+    pending = deque()
+    for sha in shas:
+        pending.append(pool.apply_async(_convert_in_worker, (sha,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def get_import_workers():
+    """Return the number of processes to convert git commits in.
+
+    This is set with the git_import_workers option, and defaults to 1.
+    """
+    workers = config.GlobalConfig().get_user_option("git_import_workers")
+    if workers is None:
+        return 1
+    return int(workers)
+
+
+class InventoryCache(object):
+    """Cache of recently used inventories of a repository.
+
+    Revisions are mostly imported right after their parents, so keeping 
+    the inventories that were just written avoids reading them back from 
+    the repository.
+    """
+
+    def __init__(self, repo, max_entries=INVENTORY_CACHE_SIZE):
+        self.repo = repo
+        self._cache = lru_cache.LRUSizeCache(max_size=max_entries, 
+            compute_size=len)
+        self.hits = 0
+        self.misses = 0
+
+    def get_inventory(self, revision_id):
+        inv = self._cache.get(revision_id)
+        if inv is None:
+            self.misses += 1
+            inv = self.repo.get_inventory(revision_id)
+            self._cache.add(revision_id, inv)
+        else:
+            self.hits += 1
+        return inv
+
+    def add(self, revision_id, inv):
+        """Add an inventory that was just written to the cache."""
+        self._cache.add(revision_id, inv)
+
+    def hit_rate(self):
+        """Return the fraction of lookups that were found in the cache."""
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+
+class ImportCheckpoint(object):
+    """Commits the write group of an import every so many revisions.
+
+    An interrupted import only loses the revisions imported since the 
+    last checkpoint, as revisions that are already present are skipped 
+    when it is restarted. Until the import finishes, a marker with its 
+    progress is kept in the control directory of the target, so a 
+    restarted import can report that it is resuming.
+    """
+
+    marker_name = "git-import-progress"
+
+    def __init__(self, repo, interval=None):
+        """Create a checkpoint.
+
+        :param repo: Repository being imported into, in a write group
+        :param interval: Number of revisions between checkpoints, defaults 
+            to the git_import_checkpoint_interval option
+        """
+        self.repo = repo
+        if interval is None:
+            interval = config.GlobalConfig().get_user_option(
+                "git_import_checkpoint_interval")
+            if interval is None:
+                interval = CHECKPOINT_INTERVAL
+        self.interval = int(interval)
+        self.transport = repo.bzrdir.transport
+        self.start_time = time.time()
+        self.last_time = self.start_time
+        self.last_revisions = 0
+        self.last_objects = 0
+
+    def read_marker(self):
+        """Read the progress of an interrupted import.
+
+        :return: Tuple with the number of revisions that were imported 
+            and the total, or None if there is no interrupted import
+        """
+        try:
+            text = self.transport.get_bytes(self.marker_name)
+        except NoSuchFile:
+            return None
+        (done, total) = text.split()
+        return (int(done), int(total))
+
+    def report_resume(self):
+        progress = self.read_marker()
+        if progress is not None:
+            info("git: resuming import interrupted after %d of %d revisions",
+                 progress[0], progress[1])
+
+    def __call__(self, revisions, total, objects):
+        """Record that a revision has been imported.
+
+        :param revisions: Number of revisions imported so far
+        :param total: Number of revisions being imported
+        :param objects: Number of git objects imported so far
+        """
+        if revisions % self.interval != 0 or revisions == total:
+            return
+        self.repo.commit_write_group()
+        self.repo.start_write_group()
+        self.transport.put_bytes(self.marker_name, 
+                                 "%d %d\n" % (revisions, total))
+        now = time.time()
+        elapsed = max(now - self.last_time, 1e-6)
+        info("git: checkpoint at %d of %d revisions "
+             "(%.1f revisions/s, %.1f objects/s; %.1f revisions/s overall)",
+             revisions, total, (revisions - self.last_revisions) / elapsed,
+             (objects - self.last_objects) / elapsed,
+             revisions / max(now - self.start_time, 1e-6))
+        self.last_time = now
+        self.last_revisions = revisions
+        self.last_objects = objects
+
+    def finish(self):
+        """Remove the progress marker after the import has finished."""
+        try:
+            self.transport.delete(self.marker_name)
+        except NoSuchFile:
+            pass
+
+
+def import_git_blob(repo, mapping, path, text, revision_id, parent_id, 
+                    parent_invs, executable):
+    """Import the text of a git blob into a bzr repository.
 
     :param repo: bzr repository
     :param path: Path in the tree
-    :param blob: A git blob
+    :param text: Tuple with the lines, SHA1 and size of the blob contents
+    :param revision_id: Revision the blob is imported in
+    :param parent_id: File id of the directory containing the blob
+    :return: The new inventory entry
     """
     file_id = mapping.generate_file_id(path)
-    text_revision = inv.revision_id
-    repo.texts.add_lines((file_id, text_revision),
+    (lines, text_sha1, text_size) = text
+    repo.texts.add_lines((file_id, revision_id),
         [(file_id, p[file_id].revision) for p in parent_invs if file_id in p],
-        osutils.split_lines(blob.data))
-    ie = inv.add_path(path, "file", file_id)
-    ie.revision = text_revision
-    ie.text_size = len(blob.data)
-    ie.text_sha1 = osutils.sha_string(blob.data)
+        lines)
+    ie = InventoryFile(file_id, urlutils.basename(path).decode("utf-8"), 
+                       parent_id)
+    ie.revision = revision_id
+    ie.text_size = text_size
+    ie.text_sha1 = text_sha1
     ie.executable = executable
+    return ie
 
 
-def import_git_tree(repo, mapping, path, tree, inv, parent_invs, lookup_object):
-    """Import a git tree object into a bzr repository.
+def import_git_directory(repo, mapping, path, revision_id, parent_id, 
+                         parent_invs):
+    """Import a new directory into a bzr repository.
 
-    :param repo: A Bzr repository object
-    :param path: Path in the tree
-    :param tree: A git tree object
-    :param inv: Inventory object
+    :return: The new inventory entry
     """
     file_id = mapping.generate_file_id(path)
-    text_revision = inv.revision_id
-    repo.texts.add_lines((file_id, text_revision),
+    repo.texts.add_lines((file_id, revision_id),
         [(file_id, p[file_id].revision) for p in parent_invs if file_id in p],
         [])
-    ie = inv.add_path(path, "directory", file_id)
-    ie.revision = text_revision
-    for mode, name, hexsha in tree.entries():
-        entry_kind = (mode & 0700000) / 0100000
-        basename = name.decode("utf-8")
-        if path == "":
-            child_path = name
+    ie = InventoryDirectory(file_id, urlutils.basename(path).decode("utf-8"), 
+                            parent_id)
+    ie.revision = revision_id
+    return ie
+
+
+def _remove_children(basis_inv, file_id, delta):
+    """Add the removal of the contents of a directory to an inventory delta.
+    """
+    for path, ie in basis_inv.iter_entries(from_dir=file_id):
+        delta.append((basis_inv.id2path(ie.file_id), None, ie.file_id, None))
+
+
+def import_git_changes(repo, mapping, changes, basis_inv, revision_id, 
+                       parent_invs, delta, new_blobs=None, new_objects=None):
+    """Import changes to a git tree into a bzr repository.
+
+    Texts are only added for new and changed files and new directories; 
+    unchanged entries keep the revision of the basis inventory.
+
+    :param repo: A Bzr repository object
+    :param changes: Changes as returned by diff_git_trees
+    :param basis_inv: Inventory of the tree the changes are against, or 
+        None if they are against an empty tree
+    :param revision_id: Revision the changes are imported in
+    :param delta: List to which the inventory delta is appended
+    :param new_blobs: Optional list to which the sha, SHA1 and size of 
+        the imported blobs are appended
+    :param new_objects: Optional list to which the entries for the new 
+        and changed trees and blobs are appended, as taken by 
+        GitShaMap.add_entries
+    """
+    for path, old_mode, new_mode, hexsha, text in changes:
+        file_id = mapping.generate_file_id(path)
+        if old_mode is None:
+            old_path = None
         else:
-            child_path = urlutils.join(path, name)
-        if entry_kind == 0:
-            tree = lookup_object(hexsha)
-            import_git_tree(repo, mapping, child_path, tree, inv, parent_invs, lookup_object)
-        elif entry_kind == 1:
-            blob = lookup_object(hexsha)
-            fs_mode = mode & 0777
-            import_git_blob(repo, mapping, child_path, blob, inv, parent_invs, bool(fs_mode & 0111))
+            old_path = path.decode("utf-8")
+            if (_is_tree(old_mode) and 
+                (new_mode is None or not _is_tree(new_mode))):
+                _remove_children(basis_inv, file_id, delta)
+        if new_mode is None:
+            delta.append((old_path, None, file_id, None))
+            continue
+        if "/" in path:
+            parent_id = mapping.generate_file_id(path.rsplit("/", 1)[0])
         else:
-            raise AssertionError("Unknown blob kind, perms=%r." % (mode,))
+            parent_id = mapping.generate_file_id("")
+        if _is_tree(new_mode):
+            if new_objects is not None:
+                new_objects.append((hexsha, "tree", file_id, revision_id))
+            if old_mode is not None and _is_tree(old_mode):
+                continue
+            ie = import_git_directory(repo, mapping, path, revision_id, 
+                                      parent_id, parent_invs)
+        else:
+            ie = import_git_blob(repo, mapping, path, text, revision_id, 
+                parent_id, parent_invs, bool(new_mode & 0111))
+            if new_blobs is not None:
+                new_blobs.append((hexsha, ie.text_sha1, ie.text_size))
+            if new_objects is not None:
+                new_objects.append((hexsha, "blob", file_id, revision_id))
+        delta.append((old_path, path.decode("utf-8"), file_id, ie))
 
 
-def import_git_objects(repo, mapping, num_objects, object_iter, pb=None):
-    """Import a set of git objects into a bzr repository.
+def import_merged_entries(repo, basis_inv, parent_invs, revision_id, delta, 
+                          new_objects=None):
+    """Import the entries a merge commit keeps from its first parent.
+
+    The changes of a commit are found against its first parent only. An 
+    entry that is unchanged from the first parent keeps its revision, 
+    unless another parent has a version of it that is not an ancestor of 
+    that revision. Such entries get a new version with the versions of 
+    all parents as parents, as the per-file graph would have several 
+    heads otherwise.
+
+    :param basis_inv: Inventory of the first parent
+    :param parent_invs: Inventories of all parents
+    :param delta: Inventory delta against basis_inv, to which the new 
+        versions are appended
+    :param new_objects: Optional list to which entries for the blobs of 
+        the new versions are appended, as taken by GitShaMap.add_entries
+    """
+    changed = set([file_id for (old_path, new_path, file_id, ie) in delta])
+    graph = repo.get_graph()
+    for path, ie in basis_inv.iter_entries():
+        if ie.file_id in changed:
+            continue
+        revisions = set([p[ie.file_id].revision for p in parent_invs[1:] 
+                         if ie.file_id in p])
+        revisions.discard(ie.revision)
+        if not revisions:
+            continue
+        revisions.add(ie.revision)
+        if graph.heads(revisions) == set([ie.revision]):
+            continue
+        text_parents = []
+        for p in parent_invs:
+            if ie.file_id in p:
+                key = (ie.file_id, p[ie.file_id].revision)
+                if key not in text_parents:
+                    text_parents.append(key)
+        if ie.kind == "file":
+            text = repo.texts.get_record_stream([(ie.file_id, ie.revision)], 
+                "unordered", True).next().get_bytes_as("fulltext")
+            lines = osutils.split_lines(text)
+            if new_objects is not None:
+                new_objects.append((Blob.from_string(text).id, "blob", 
+                                    ie.file_id, revision_id))
+        else:
+            lines = []
+        repo.texts.add_lines((ie.file_id, revision_id), text_parents, lines)
+        new_ie = ie.copy()
+        new_ie.revision = revision_id
+        delta.append((path, path, ie.file_id, new_ie))
+
+
+def import_git_objects(repo, mapping, heads, get_object, pb=None, 
+                       blob_map=None, source=None, workers=1, 
+                       checkpoint=None, sha_map=None):
+    """Import the history of a set of git commits into a bzr repository.
+
+    Git objects are looked up when they are needed, and only the graph of 
+    the commits to import and a bounded cache of recently used objects are 
+    kept in memory. Each revision is imported as a delta against its first 
+    parent, when the tree of that parent can be found. For merges, the 
+    entries that are unchanged from the first parent are checked against 
+    the other parents, see import_merged_entries.
+
+    Reading the trees and blobs of the commits can be done by a pool of 
+    worker processes, while this process writes the revisions in 
+    topological order. Commits whose first parent was imported before 
+    are converted in this process, as only it can reconstruct the trees 
+    of that parent, so the result is the same as for a serial import.
 
     :param repo: Bazaar repository
     :param mapping: Mapping to use
-    :param num_objects: Number of objects.
-    :param object_iter: Iterator over Git objects.
+    :param heads: Hex shas of the commits to import. Their ancestors are 
+        imported as well, up to the revisions repo already has.
+    :param get_object: Function that returns the git object with a hex sha, 
+        and raises KeyError if there is no such object.
+    :param blob_map: Optional BlobShaMap to record the SHA1s and sizes of 
+        the imported blobs in.
+    :param source: Optional description of where the worker processes can 
+        read the git objects from, see open_object_source.
+    :param workers: Number of worker processes. The commits are converted 
+        in this process if this is 1, or if source is None.
+    :param checkpoint: Optional function that is called after each 
+        revision with the number of revisions imported so far, the number 
+        of revisions to import and the number of git objects imported so 
+        far, see ImportCheckpoint.
+    :param sha_map: GitShaMap to record the imported objects in, and to 
+        look up objects that were imported before. Defaults to the map 
+        of repo.
     """
-    # TODO: a more (memory-)efficient implementation of this
-    objects = {}
-    for i, o in enumerate(object_iter):
-        if pb is not None:
-            pb.update("fetching objects", i, num_objects) 
-        objects[o.id] = o
-    graph = []
-    root_trees = {}
-    revisions = {}
-    # Find and convert commit objects
-    for o in objects.itervalues():
-        if isinstance(o, Commit):
-            rev = mapping.import_commit(o)
-            root_trees[rev.revision_id] = objects[o.tree]
-            revisions[rev.revision_id] = rev
-            graph.append((rev.revision_id, rev.parent_ids))
-    # Order the revisions
-    # Create the inventory objects
-    for i, revid in enumerate(topo_sort(graph)):
-        if pb is not None:
-            pb.update("fetching revisions", i, len(graph))
-        root_tree = root_trees[revid]
-        rev = revisions[revid]
-        # We have to do this here, since we have to walk the tree and 
-        # we need to make sure to import the blobs / trees with the riht 
-        # path; this may involve adding them more than once.
-        inv = Inventory()
-        inv.revision_id = rev.revision_id
-        def lookup_object(sha):
-            if sha in objects:
-                return objects[sha]
-            return reconstruct_git_object(repo, mapping, sha)
-        parent_invs = [repo.get_inventory(r) for r in rev.parent_ids]
-        import_git_tree(repo, mapping, "", root_tree, inv, parent_invs, 
-            lookup_object)
-        repo.add_revision(rev.revision_id, rev, inv)
-
-
-def reconstruct_git_commit(repo, rev):
-    raise NotImplementedError(self.reconstruct_git_commit)
-
-
-def reconstruct_git_object(repo, mapping, sha):
-    # Commit
-    revid = mapping.revision_id_foreign_to_bzr(sha)
+    inventories = InventoryCache(repo)
+    close_sha_map = (sha_map is None)
+    if close_sha_map:
+        sha_map = get_git_sha_map(repo)
+    lookup_object = make_object_lookup(get_object, 
+        lambda sha: reconstruct_git_object(repo, mapping, sha, inventories, 
+                                           sha_map))
+    # Find the commits that are missing from repo
+    graph = {}
+    todo = list(heads)
+    while todo:
+        sha = todo.pop()
+        revid = mapping.revision_id_foreign_to_bzr(sha)
+        if revid in graph or repo.has_revision(revid):
+            continue
+        try:
+            commit = get_object(sha)
+        except KeyError:
+            # Ghost
+            continue
+        graph[revid] = [mapping.revision_id_foreign_to_bzr(p) 
+                        for p in commit.parents]
+        todo.extend(commit.parents)
+    revids = topo_sort(graph.items())
+    shas = [mapping.revision_id_bzr_to_foreign(revid) for revid in revids]
+    pool = None
+    if (workers > 1 and source is not None and multiprocessing is not None 
+        and len(shas) > 1):
+        pool = multiprocessing.Pool(workers, _init_conversion_worker, 
+                                    (source,))
+        conversions = _iter_conversions_in_pool(pool, shas, workers * 4)
+    else:
+        conversions = (convert_git_commit(lookup_object, sha) for sha in shas)
+    supports_delta = getattr(repo, "add_inventory_by_delta", None) is not None
+    objects = 0
     try:
-        rev = repo.get_revision(revid)
+        # Create the inventory objects, in topological order
+        for i, (sha, conversion) in enumerate(izip(shas, conversions)):
+            if conversion is None:
+                conversion = convert_git_commit(lookup_object, sha)
+            (has_basis, changes) = conversion
+            if pb is not None:
+                pb.update("fetching revisions (inventory cache hit rate "
+                          "%d%%)" % (100 * inventories.hit_rate()), 
+                          i, len(graph))
+            commit = lookup_object(sha)
+            rev = mapping.import_commit(commit)
+            parent_invs = [inventories.get_inventory(r) 
+                           for r in rev.parent_ids]
+            delta = []
+            if has_basis:
+                basis_inv = parent_invs[0]
+            else:
+                basis_inv = None
+                delta.append((None, u"", ROOT_ID, import_git_directory(repo, 
+                    mapping, "", rev.revision_id, None, parent_invs)))
+            new_blobs = []
+            new_objects = [(commit.tree, "tree", ROOT_ID, rev.revision_id)]
+            import_git_changes(repo, mapping, changes, basis_inv, 
+                rev.revision_id, parent_invs, delta, new_blobs, new_objects)
+            if basis_inv is not None and len(parent_invs) > 1:
+                import_merged_entries(repo, basis_inv, parent_invs, 
+                    rev.revision_id, delta, new_objects)
+            if basis_inv is not None and supports_delta:
+                rev.inventory_sha1, inv = repo.add_inventory_by_delta(
+                    rev.parent_ids[0], delta, rev.revision_id, 
+                    rev.parent_ids)
+                repo.add_revision(rev.revision_id, rev)
+            else:
+                if basis_inv is None:
+                    inv = Inventory(root_id=None)
+                else:
+                    inv = basis_inv.copy()
+                inv.revision_id = rev.revision_id
+                inv.apply_delta(delta)
+                repo.add_revision(rev.revision_id, rev, inv)
+            inventories.add(rev.revision_id, inv)
+            if blob_map is not None and new_blobs:
+                blob_map.add_entries(new_blobs)
+            sha_map.add_entries(rev.revision_id, sha, commit.tree, 
+                                new_objects)
+            # The commit and the changed trees and blobs
+            objects += 1 + len(changes)
+            if checkpoint is not None:
+                checkpoint(i + 1, len(shas), objects)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if close_sha_map:
+            sha_map.close()
+
+
+def get_git_sha_map(repo):
+    """Open the map of the git objects imported into a bzr repository.
+
+    It is kept in the control directory of the repository, or in memory 
+    if that is not local.
+    """
+    try:
+        path = repo.bzrdir.transport.local_abspath("git-shas.db")
+    except NotLocalUrl:
+        return GitShaMap()
+    return GitShaMap(path)
+
+
+def reconstruct_git_commit(repo, mapping, rev, tree_sha):
+    """Create a git commit for an imported bzr revision.
+
+    Only the tree and parents are guaranteed to be the same as those of 
+    the commit the revision was imported from.
+    """
+    commit = Commit()
+    commit._tree = tree_sha
+    commit._parents = [mapping.revision_id_bzr_to_foreign(p) 
+                       for p in rev.parent_ids]
+    commit._author = commit._committer = rev.committer.encode("utf-8")
+    commit._commit_time = int(rev.timestamp)
+    commit._message = rev.message.encode("utf-8")
+    commit.serialize()
+    return commit
+
+
+def reconstruct_git_blob(repo, file_id, revision):
+    """Create a git blob for a text in a bzr repository."""
+    record = repo.texts.get_record_stream([(file_id, revision)], 
+                                          "unordered", True).next()
+    if record.storage_kind == "absent":
+        raise KeyError((file_id, revision))
+    return Blob.from_string(record.get_bytes_as("fulltext"))
+
+
+def reconstruct_git_tree(repo, mapping, inventories, sha_map, file_id, 
+                         revid):
+    """Create a git tree for a directory in an imported bzr revision.
+
+    The shas of the subtrees and blobs are looked up in sha_map, and 
+    only the ones that are not in it are reconstructed. Symlinks become 
+    blobs with their target, tree references become gitlinks.
+    """
+    inv = inventories.get_inventory(revid)
+    entries = []
+    for name, ie in inv[file_id].children.iteritems():
+        if ie.kind == "directory":
+            mode = 040000
+            sha = sha_map.lookup_tree(ie.file_id, revid)
+            if sha is None:
+                sha = reconstruct_git_tree(repo, mapping, inventories, 
+                                           sha_map, ie.file_id, revid).id
+        elif ie.kind == "file":
+            if ie.executable:
+                mode = 0100755
+            else:
+                mode = 0100644
+            sha = sha_map.lookup_blob(ie.file_id, ie.revision)
+            if sha is None:
+                sha = reconstruct_git_blob(repo, ie.file_id, ie.revision).id
+        elif ie.kind == "symlink":
+            mode = 0120000
+            sha = Blob.from_string(ie.symlink_target.encode("utf-8")).id
+        elif ie.kind == "tree-reference":
+            mode = 0160000
+            sha = mapping.revision_id_bzr_to_foreign(ie.reference_revision)
+        else:
+            raise AssertionError("Unknown inventory entry kind %r" % 
+                                 (ie.kind,))
+        entries.append((mode, name.encode("utf-8"), sha))
+    # Git sorts tree entries as if the names of subtrees end with a slash
+    def sort_key(entry):
+        if _is_tree(entry[0]):
+            return entry[1] + "/"
+        return entry[1]
+    tree = Tree()
+    for mode, name, sha in sorted(entries, key=sort_key):
+        tree.add(mode, name, sha)
+    tree.serialize()
+    return tree
+
+
+def reconstruct_git_object(repo, mapping, sha, inventories=None, 
+                           sha_map=None):
+    """Reconstruct a git object from the contents of a bzr repository.
+
+    The object is looked up in sha_map, so only objects that were 
+    imported into repo can be reconstructed.
+
+    Trees and blobs are only returned if they have the requested sha. 
+    Commits can't be reconstructed exactly, but the sha of their tree is 
+    the one recorded in sha_map.
+
+    :param inventories: Optional InventoryCache to read inventories from
+    :param sha_map: GitShaMap of repo, opened if it is not specified
+    :raise KeyError: If the object can't be reconstructed
+    """
+    if inventories is None:
+        inventories = InventoryCache(repo)
+    if sha_map is None:
+        sha_map = get_git_sha_map(repo)
+    (kind, data) = sha_map.lookup_git_sha(sha)
+    try:
+        if kind == "commit":
+            (revid, tree_sha) = data
+            return reconstruct_git_commit(repo, mapping, 
+                repo.get_revision(revid), tree_sha)
+        elif kind == "tree":
+            (file_id, revid) = data
+            obj = reconstruct_git_tree(repo, mapping, inventories, sha_map, 
+                                       file_id, revid)
+        else:
+            (file_id, revision) = data
+            obj = reconstruct_git_blob(repo, file_id, revision)
     except NoSuchRevision:
-        pass
-    else:
-        return reconstruct_git_commit(rev)
+        # The revision was recorded in the map, but the write group it 
+        # was added in was not committed
+        raise KeyError(sha)
+    if obj.id != sha:
+        # Something was lost when the object was imported
+        raise KeyError(sha)
+    return obj
+
+
+def make_ext_ref_resolver(repo, mapping, sha_map):
+    """Create a function that rebuilds the delta bases of a thin pack.
+
+    The bases have to be git objects that were imported into repo, and 
+    are reconstructed with reconstruct_git_object.
 
-    # TODO: Tree
-    # TODO: Blob
-    raise KeyError("No such object %s" % sha)
+    :return: Function that returns the (type, contents) of an object by 
+        binary SHA1, and raises KeyError if it can't be reconstructed
+    """
+    inventories = InventoryCache(repo)
+    def resolve_ext_ref(name):
+        sha = sha_to_hex(name)
+        obj = reconstruct_git_object(repo, mapping, sha, inventories, 
+                                     sha_map)
+        if obj.id != sha:
+            # Commits are not reconstructed exactly
+            raise KeyError(sha)
+        return obj.as_raw_string()
+    return resolve_ext_ref
 
 
 class InterGitNonGitRepository(InterRepository):
@@ -200,18 +893,28 @@ class InterGitNonGitRepository(InterRepository):
         self.fetch(revision_id, pb, find_ghosts=False)
 
     def fetch(self, revision_id=None, pb=None, find_ghosts=False, 
-              mapping=None):
+              mapping=None, workers=None):
+        """See InterRepository.fetch.
+
+        :param workers: Number of processes to convert git commits in, 
+            defaults to the git_import_workers option.
+        """
         if mapping is None:
             mapping = self.source.get_mapping()
+        if workers is None:
+            workers = get_import_workers()
         def progress(text):
             pb.update("git: %s" % text.rstrip("\r\n"), 0, 0)
+        wants = []
+        refs = {}
         def determine_wants(heads):
+            refs.update(heads)
             if revision_id is None:
                 ret = heads.values()
             else:
                 ret = [mapping.revision_id_bzr_to_foreign(revision_id)]
-            return [rev for rev in ret if not self.target.has_revision(mapping.revision_id_foreign_to_bzr(rev))]
-        graph_walker = BzrFetchGraphWalker(self.target, mapping)
+            wants.extend([rev for rev in ret if not self.target.has_revision(mapping.revision_id_foreign_to_bzr(rev))])
+            return wants
         create_pb = None
         if pb is None:
             create_pb = pb = ui.ui_factory.nested_progress_bar()
@@ -219,20 +922,84 @@ class InterGitNonGitRepository(InterRepository):
             self.target.lock_write()
             try:
                 self.target.start_write_group()
+                checkpoint = ImportCheckpoint(self.target)
+                checkpoint.report_resume()
+                sha_map = get_git_sha_map(self.target)
                 try:
-                    (num_objects, objects_iter) = \
-                            self.source.fetch_objects(determine_wants, 
-                                graph_walker, progress)
-                    import_git_objects(self.target, mapping, num_objects, 
-                                       objects_iter, pb)
+                    try:
+                        if isinstance(self.source, LocalGitRepository):
+                            determine_wants(self.source._git.get_refs())
+                            import_git_objects(self.target, mapping, wants, 
+                                self.source._git.get_object, pb, 
+                                self.source._get_blob_map(), 
+                                ("repo", self.source._git.path), workers, 
+                                checkpoint, sha_map)
+                        else:
+                            graph_walker = self._get_graph_walker(mapping, 
+                                sha_map, checkpoint)
+                            # Keep the pack on disk and look objects 
+                            # up through its index, rather than holding 
+                            # them all in memory
+                            tempdir = tempfile.mkdtemp()
+                            try:
+                                basename = os.path.join(tempdir, "fetch")
+                                pack = self.source.fetch_pack_file(
+                                    determine_wants, graph_walker, basename, 
+                                    progress, make_ext_ref_resolver(
+                                        self.target, mapping, sha_map))
+                                if pack is not None:
+                                    try:
+                                        import_git_objects(self.target, 
+                                            mapping, wants, 
+                                            pack.__getitem__, pb, 
+                                            source=("pack", basename), 
+                                            workers=workers, 
+                                            checkpoint=checkpoint, 
+                                            sha_map=sha_map)
+                                    finally:
+                                        pack.close()
+                            finally:
+                                shutil.rmtree(tempdir)
+                    finally:
+                        self.target.commit_write_group()
+                    sha_map.set_fetched_refs(self.source.base, 
+                        dict([(name, sha) for (name, sha) in refs.iteritems()
+                              if self.target.has_revision(
+                                mapping.revision_id_foreign_to_bzr(sha))]))
                 finally:
-                    self.target.commit_write_group()
+                    sha_map.close()
+                checkpoint.finish()
             finally:
                 self.target.unlock()
         finally:
             if create_pb:
                 create_pb.finished()
 
+    def _get_graph_walker(self, mapping, sha_map, checkpoint=None):
+        """Create a graph walker over the revisions in the target.
+
+        The walk starts from the commits the refs of the source pointed at 
+        in the last fetch from it, if the target still has any of them. 
+        Otherwise all revisions in the target have to be read to find 
+        the heads. They are read as well when an interrupted import is 
+        resumed, as the revisions it committed at its checkpoints are 
+        newer than those refs.
+
+        :param checkpoint: Optional ImportCheckpoint of the fetch
+        """
+        heads = []
+        if checkpoint is None or checkpoint.read_marker() is None:
+            fetched_refs = sha_map.get_fetched_refs(self.source.base)
+        else:
+            fetched_refs = {}
+        for sha in set(fetched_refs.values()):
+            revid = mapping.revision_id_foreign_to_bzr(sha)
+            if self.target.has_revision(revid):
+                heads.append(revid)
+        if not heads:
+            heads = None
+        return BzrFetchGraphWalker(self.target, mapping, heads)
+
     @staticmethod
     def is_compatible(source, target):
         """Be compatible with GitRepository."""
@@ -261,21 +1028,31 @@ class InterGitRepository(InterRepository):
         def progress(text):
             info("git: %s", text)
         r = self.target._git
-        if revision_id is None:
-            determine_wants = lambda x: [y for y in x.values() if not y in r.object_store]
-        else:
-            args = [mapping.revision_id_bzr_to_foreign(revision_id)]
-            determine_wants = lambda x: [y for y in args if not y in r.object_store]
+        wants = []
+        def determine_wants(refs):
+            if revision_id is None:
+                candidates = refs.values()
+            else:
+                candidates = [mapping.revision_id_bzr_to_foreign(revision_id)]
+            wants.extend([y for y in candidates if not y in r.object_store])
+            return wants
 
-        graphwalker = SimpleFetchGraphWalker(r.heads().values(), r.get_parents)
+        if isinstance(self.source, LocalGitRepository):
+            # Copy the objects straight from the packs of the source
+            self.source._git.fetch(r, determine_wants, progress)
+            return
+        graphwalker = SkippingFetchGraphWalker(r.heads().values(), 
+            r.get_parents, r.get_commit_time)
         f, commit = r.object_store.add_pack()
         try:
-            self.source._git.fetch_pack(path, determine_wants, graphwalker, f.write, progress)
+            self.source.fetch_pack(determine_wants, graphwalker, f.write, 
+                                   progress)
             f.close()
             commit()
         except:
             f.close()
             raise
+        r.object_store.add_to_commit_graph(wants)
 
     @staticmethod
     def is_compatible(source, target):
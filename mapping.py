@@ -53,6 +53,15 @@ class BzrGitMapping(foreign.VcsMapping):
             return ROOT_ID
         return escape_file_id(path.encode('utf-8'))
 
+    def parse_file_id(self, file_id):
+        """Find the path of a file from its file id.
+
+        This is the inverse of generate_file_id.
+        """
+        if file_id == ROOT_ID:
+            return u""
+        return unescape_file_id(file_id).decode('utf-8')
+
     def import_commit(self, commit):
         """Convert a git commit to a bzr revision.
 
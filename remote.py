@@ -35,7 +35,7 @@ import tempfile
 import urllib
 import urlparse
 
-from dulwich.pack import PackData, Pack
+from dulwich.pack import Pack, PackReceiver, write_pack_index_v2
 
 # Don't run any tests on GitSmartTransport as it is not intended to be 
 # a full implementation of Transport
@@ -113,16 +113,54 @@ class RemoteGitRepository(GitRepository):
         self._transport.fetch_pack(determine_wants, graph_walker, pack_data, 
             progress)
 
+    def fetch_pack_file(self, determine_wants, graph_walker, basename, 
+                        progress=None, resolve_ext_ref=None):
+        """Fetch a pack and write it to disk, with an index.
+
+        :param basename: Path of the pack, without the .pack or .idx 
+            extension
+        :param resolve_ext_ref: Function that returns the (type, contents) 
+            of an object the pack has deltas against but does not contain, 
+            by binary SHA1. The server sends a thin pack, so this is needed 
+            if the graph walker reports any haves. The bases are appended 
+            to the pack.
+        :return: The Pack, or None if no objects were fetched
+        """
+        f = open(basename + ".pack", 'w+b')
+        try:
+            # The pack is indexed while it is received
+            receiver = PackReceiver(f, resolve_ext_ref, 
+                                    fix_thin=(resolve_ext_ref is not None))
+            self.fetch_pack(determine_wants, graph_walker, receiver.write, 
+                            progress)
+            result = receiver.finish()
+        finally:
+            f.close()
+        if result is None:
+            return None
+        (entries, pack_checksum) = result
+        entries.sort()
+        write_pack_index_v2(basename + ".idx", entries, pack_checksum)
+        return Pack(basename)
+
     def fetch_objects(self, determine_wants, graph_walker, progress=None):
         fd, path = tempfile.mkstemp(suffix=".pack")
-        self.fetch_pack(determine_wants, graph_walker, lambda x: os.write(fd, x), progress)
         os.close(fd)
         basename = path[:-len(".pack")]
-        p = PackData(path)
-        p.create_index_v2(basename+".idx")
-        pack = Pack(basename)
-        os.remove(path)
-        return (len(p), pack.iterobjects())
+        pack = self.fetch_pack_file(determine_wants, graph_walker, basename, 
+                                    progress)
+        if pack is None:
+            os.remove(path)
+            return (0, iter([]))
+        def iterobjects():
+            try:
+                for obj in pack.iterobjects():
+                    yield obj
+            finally:
+                pack.close()
+                os.remove(path)
+                os.remove(basename + ".idx")
+        return (len(pack), iterobjects())
 
 
 class RemoteGitBranch(GitBranch):
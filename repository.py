@@ -17,6 +17,7 @@
 """An adapter between a Git Repository and a Bazaar Branch"""
 
 import os
+import stat
 import time
 
 import bzrlib
@@ -25,6 +26,7 @@ from bzrlib import (
     errors,
     graph,
     inventory,
+    lru_cache,
     osutils,
     repository,
     revision,
@@ -35,16 +37,22 @@ from bzrlib import (
 from bzrlib.foreign import (
         ForeignRepository,
         )
-from bzrlib.trace import mutter
 from bzrlib.transport import get_transport
 
 from bzrlib.plugins.git.foreign import (
     versionedfiles,
     )
 from bzrlib.plugins.git.mapping import default_mapping
+from bzrlib.plugins.git.shamap import (
+    BlobShaMap,
+    sqlite3,
+    )
 
 from bzrlib.plugins.git import git
 
+# Number of git trees whose entries are kept in memory
+TREE_CACHE_SIZE = 1000
+
 
 class GitTags(object):
 
@@ -86,16 +94,19 @@ class GitRepository(ForeignRepository):
 class LocalGitRepository(GitRepository):
 
     def __init__(self, gitdir, lockfiles):
-        # FIXME: This also caches negatives. Need to be more careful 
-        # about this once we start writing to git
-        self._parents_provider = graph.CachingParentsProvider(self)
         GitRepository.__init__(self, gitdir, lockfiles)
+        # Parents of revisions looked up while the repository is locked, 
+        # None for revisions that are missing
+        self._parent_map_cache = None
         self.base = gitdir.root_transport.base
         self._git = gitdir._git
         self.texts = None
         self.signatures = versionedfiles.VirtualSignatureTexts(self)
         self.revisions = versionedfiles.VirtualRevisionTexts(self)
         self.tags = GitTags(self._git.get_tags())
+        # Entries of recently used git trees, by tree sha
+        self._tree_cache = lru_cache.LRUCache(TREE_CACHE_SIZE)
+        self._blob_map = None
 
     def all_revision_ids(self):
         ret = set([revision.NULL_REVISION])
@@ -113,26 +124,118 @@ class LocalGitRepository(GitRepository):
     #    diff = self._git.diff(ids.convert_revision_id_bzr_to_git(parent_revid),
     #                   ids.convert_revision_id_bzr_to_git(revision_id))
 
-    def _make_parents_provider(self):
-        """See Repository._make_parents_provider()."""
-        return self._parents_provider
+    def lock_read(self):
+        ret = GitRepository.lock_read(self)
+        if self._parent_map_cache is None:
+            self._parent_map_cache = {}
+        return ret
+
+    def unlock(self):
+        GitRepository.unlock(self)
+        if not self.is_locked():
+            self._parent_map_cache = None
+
+    def get_graph(self, other_repository=None):
+        """See Repository.get_graph()."""
+        if (other_repository is not None and 
+            not self.has_same_location(other_repository)):
+            return GitRepository.get_graph(self, other_repository)
+        return GitGraph(self, self._make_parents_provider())
 
     def get_parent_map(self, revids):
+        """See Repository.get_parent_map().
+
+        The commits are looked up in a single pass over the git repository. 
+        While the repository is locked the results are cached, including 
+        which revisions are missing.
+        """
         parent_map = {}
-        mutter("get_parent_map(%r)", revids)
+        cache = self._parent_map_cache
+        mapping = self.get_mapping()
+        todo = {}
         for revision_id in revids:
             assert isinstance(revision_id, str)
             if revision_id == revision.NULL_REVISION:
                 parent_map[revision_id] = ()
-                continue
-            hexsha = self.lookup_git_revid(revision_id, self.get_mapping())
-            commit  = self._git.commit(hexsha)
-            if commit is None:
-                continue
+            elif cache is not None and revision_id in cache:
+                if cache[revision_id] is not None:
+                    parent_map[revision_id] = cache[revision_id]
             else:
-                parent_map[revision_id] = [self.get_mapping().revision_id_foreign_to_bzr(p) for p in commit.parents]
+                try:
+                    hexsha = mapping.revision_id_bzr_to_foreign(revision_id)
+                except errors.InvalidRevisionId:
+                    continue
+                todo[hexsha] = revision_id
+        if not todo:
+            return parent_map
+        found = self._git.get_parent_map(todo.keys())
+        for hexsha, revision_id in todo.iteritems():
+            if hexsha in found:
+                parents = tuple([mapping.revision_id_foreign_to_bzr(p) 
+                                 for p in found[hexsha]])
+                parent_map[revision_id] = parents
+            else:
+                parents = None
+            if cache is not None:
+                cache[revision_id] = parents
         return parent_map
 
+    def _get_blob_map(self):
+        """Return the map with the SHA1s and sizes of the git blobs.
+
+        It is kept in the bzr directory of the git repository, or in memory 
+        if that can't be created.
+        """
+        if self._blob_map is None:
+            controldir = os.path.join(self._git.path, 'bzr')
+            try:
+                if not os.path.isdir(controldir):
+                    os.makedirs(controldir)
+                self._blob_map = BlobShaMap(
+                    os.path.join(controldir, 'git-blobs.db'))
+            except (OSError, sqlite3.Error):
+                self._blob_map = BlobShaMap()
+        return self._blob_map
+
+    def _get_tree_entries(self, tree_id):
+        """Return the entries of a git tree, with the sizes and SHA1s of 
+        its blobs.
+
+        The results are cached by tree sha, so subtrees that are the same 
+        in several revisions are only read once. The SHA1s of blobs are 
+        looked up in the blob map first, and only blobs that are not in it 
+        yet are inflated.
+
+        :return: List of (mode, name, hexsha, text_size, text_sha1) tuples. 
+            text_size and text_sha1 are None for subtrees.
+        """
+        ret = self._tree_cache.get(tree_id)
+        if ret is not None:
+            return ret
+        ret = []
+        blob_map = self._get_blob_map()
+        new_blobs = []
+        for mode, name, hexsha in self._git.tree(tree_id).entries():
+            if (mode & 0700000) / 0100000 == 0:
+                ret.append((mode, name, hexsha, None, None))
+                continue
+            if (mode & 070000) / 010000 == 2:
+                text_size = self._git.object_store.get_object_size(hexsha)
+                text_sha1 = osutils.sha_string("")
+            else:
+                info = blob_map.lookup(hexsha)
+                if info is None:
+                    blob = self._git.get_lazy_blob(hexsha)
+                    info = (osutils.sha_strings(blob.iter_chunks()), 
+                            self._git.object_store.get_object_size(hexsha))
+                    new_blobs.append((hexsha, ) + info)
+                (text_sha1, text_size) = info
+            ret.append((mode, name, hexsha, text_size, text_sha1))
+        if new_blobs:
+            blob_map.add_entries(new_blobs)
+        self._tree_cache[tree_id] = ret
+        return ret
+
     def get_ancestry(self, revision_id, topo_sorted=True):
         """See Repository.get_ancestry().
         """
@@ -216,35 +319,106 @@ class LocalGitRepository(GitRepository):
         return self._git.fetch_objects(determine_wants, graph_walker, progress)
 
 
-class GitRevisionTree(revisiontree.RevisionTree):
-
-    def __init__(self, repository, mapping, revision_id):
+class GitGraph(graph.Graph):
+    """Graph of the revisions in a local git repository.
+
+    heads(), is_ancestor() and find_unique_ancestors() are answered by 
+    walking the git history directly, which can use the generation 
+    numbers in the commit-graph to stop early, rather than through 
+    get_parent_map. Queries involving revisions that aren't in the git 
+    repository are left to graph.Graph.
+    """
+
+    def __init__(self, repository, parents_provider):
+        graph.Graph.__init__(self, parents_provider)
+        self._git = repository._git
+        self._mapping = repository.get_mapping()
+
+    def _lookup_git_shas(self, revids):
+        return [self._mapping.revision_id_bzr_to_foreign(revid) 
+                for revid in revids]
+
+    def heads(self, keys):
+        """See Graph.heads()."""
+        keys = set(keys)
+        if revision.NULL_REVISION in keys and len(keys) > 1:
+            keys.remove(revision.NULL_REVISION)
+        if len(keys) < 2:
+            return keys
+        keys = list(keys)
+        try:
+            shas = self._lookup_git_shas(keys)
+            heads = self._git.independent(shas)
+        except (errors.InvalidRevisionId, KeyError):
+            return graph.Graph.heads(self, keys)
+        revids = dict(zip(shas, keys))
+        return set([revids[sha] for sha in heads])
+
+    def is_ancestor(self, candidate_ancestor, candidate_descendant):
+        """See Graph.is_ancestor()."""
+        if candidate_ancestor == revision.NULL_REVISION:
+            return True
+        if candidate_descendant == revision.NULL_REVISION:
+            return False
+        try:
+            (ancestor, descendant) = self._lookup_git_shas(
+                [candidate_ancestor, candidate_descendant])
+            return self._git.is_ancestor(ancestor, descendant)
+        except (errors.InvalidRevisionId, KeyError):
+            return graph.Graph.is_ancestor(self, candidate_ancestor, 
+                                           candidate_descendant)
+
+    def find_unique_ancestors(self, unique_revision, common_revisions):
+        """See Graph.find_unique_ancestors()."""
+        common_revisions = [revid for revid in common_revisions 
+                            if revid != revision.NULL_REVISION]
+        if unique_revision == revision.NULL_REVISION:
+            return graph.Graph.find_unique_ancestors(self, unique_revision, 
+                                                     common_revisions)
+        try:
+            unique = self._lookup_git_shas([unique_revision])[0]
+            common = self._lookup_git_shas(common_revisions)
+            shas = self._git.find_unique_ancestors(unique, common)
+        except (errors.InvalidRevisionId, KeyError):
+            return graph.Graph.find_unique_ancestors(self, unique_revision, 
+                                                     common_revisions)
+        return set([self._mapping.revision_id_foreign_to_bzr(sha) 
+                    for sha in shas])
+
+
+class GitInventory(inventory.Inventory):
+    """Inventory of a git tree, whose directories are read when needed.
+
+    The root directory is read up front. Looking up a file id only reads 
+    the directories on its path, and the children of the directory it 
+    refers to. Iterating over the inventory, copying or comparing it reads 
+    the whole tree. Directories that are reached through the children of 
+    their parent, rather than looked up, may not have been read yet.
+    """
+
+    def __init__(self, repository, mapping, tree_id, revision_id):
+        inventory.Inventory.__init__(self, revision_id=revision_id)
+        self.root.revision = revision_id
         self._repository = repository
-        self.revision_id = revision_id
-        assert isinstance(revision_id, str)
         self.mapping = mapping
-        git_id = repository.lookup_git_revid(revision_id, self.mapping)
-        try:
-            commit = repository._git.commit(git_id)
-        except KeyError, r:
-            raise errors.NoSuchRevision(repository, revision_id)
-        self.tree = commit.tree
-        self._inventory = inventory.Inventory(revision_id=revision_id)
-        self._inventory.root.revision = revision_id
-        self._build_inventory(self.tree, self._inventory.root, "")
+        # File id -> (tree sha, path) of the directories that are not read 
+        # yet
+        self._unloaded = {self.root.file_id: (tree_id, "")}
+        self._load_children(self.root.file_id)
 
-    def get_revision_id(self):
-        return self.revision_id
+    def is_loaded(self, file_id):
+        """Check whether the entry of a file id has been read already."""
+        return file_id in self._byid
 
-    def get_file_text(self, file_id):
-        entry = self._inventory[file_id]
-        if entry.kind == 'directory': return ""
-        return self._repository._git.get_blob(entry.text_id).data
-
-    def _build_inventory(self, tree_id, ie, path):
-        assert isinstance(path, str)
-        tree = self._repository._git.tree(tree_id)
-        for mode, name, hexsha in tree.entries():
+    def _load_children(self, file_id):
+        """Add the entries of a directory, if they were not read yet."""
+        try:
+            (tree_id, path) = self._unloaded.pop(file_id)
+        except KeyError:
+            return
+        ie = self._byid[file_id]
+        entries = self._repository._get_tree_entries(tree_id)
+        for mode, name, hexsha, text_size, text_sha1 in entries:
             basename = name.decode("utf-8")
             if path == "":
                 child_path = name
@@ -254,29 +428,184 @@ class GitRevisionTree(revisiontree.RevisionTree):
             entry_kind = (mode & 0700000) / 0100000
             if entry_kind == 0:
                 child_ie = inventory.InventoryDirectory(file_id, basename, ie.file_id)
+                self._unloaded[file_id] = (hexsha, child_path)
             elif entry_kind == 1:
                 file_kind = (mode & 070000) / 010000
-                b = self._repository._git.get_blob(hexsha)
                 if file_kind == 0:
                     child_ie = inventory.InventoryFile(file_id, basename, ie.file_id)
-                    child_ie.text_sha1 = osutils.sha_string(b.data)
                 elif file_kind == 2:
                     child_ie = inventory.InventoryLink(file_id, basename, ie.file_id)
-                    child_ie.text_sha1 = osutils.sha_string("")
                 else:
                     raise AssertionError(
                         "Unknown file kind, perms=%o." % (mode,))
-                child_ie.text_id = b.id
-                child_ie.text_size = len(b.data)
+                child_ie.text_sha1 = text_sha1
+                child_ie.text_id = hexsha
+                child_ie.text_size = text_size
             else:
                 raise AssertionError(
                     "Unknown blob kind, perms=%r." % (mode,))
             fs_mode = mode & 0777
             child_ie.executable = bool(fs_mode & 0111)
             child_ie.revision = self.revision_id
-            self._inventory.add(child_ie)
-            if entry_kind == 0:
-                self._build_inventory(hexsha, child_ie, child_path)
+            self.add(child_ie)
+
+    def _load_names(self, names):
+        """Read the directories on a path, given as a list of names."""
+        ie = self.root
+        for name in names:
+            self._load_children(ie.file_id)
+            ie = ie.children.get(name)
+            if ie is None or ie.kind != 'directory':
+                return
+        self._load_children(ie.file_id)
+
+    def _load_file_id(self, file_id):
+        if not self._unloaded or (file_id in self._byid and 
+                                  file_id not in self._unloaded):
+            return
+        try:
+            path = self.mapping.parse_file_id(file_id)
+        except UnicodeDecodeError:
+            return
+        self._load_names(filter(None, path.split(u"/")))
+
+    def _load_all(self):
+        while self._unloaded:
+            self._load_children(iter(self._unloaded).next())
+
+    def __getitem__(self, file_id):
+        self._load_file_id(file_id)
+        return inventory.Inventory.__getitem__(self, file_id)
+
+    def has_id(self, file_id):
+        self._load_file_id(file_id)
+        return inventory.Inventory.has_id(self, file_id)
+
+    def __contains__(self, file_id):
+        self._load_file_id(file_id)
+        return inventory.Inventory.__contains__(self, file_id)
+
+    def id2path(self, file_id):
+        self._load_file_id(file_id)
+        return inventory.Inventory.id2path(self, file_id)
+
+    def get_idpath(self, file_id):
+        self._load_file_id(file_id)
+        return inventory.Inventory.get_idpath(self, file_id)
+
+    def path2id(self, name):
+        if isinstance(name, basestring):
+            self._load_names(osutils.splitpath(name))
+        else:
+            self._load_names(name)
+        return inventory.Inventory.path2id(self, name)
+
+    def iter_entries(self, *args, **kwargs):
+        self._load_all()
+        return inventory.Inventory.iter_entries(self, *args, **kwargs)
+
+    def iter_entries_by_dir(self, *args, **kwargs):
+        self._load_all()
+        return inventory.Inventory.iter_entries_by_dir(self, *args, **kwargs)
+
+    def copy(self):
+        self._load_all()
+        return inventory.Inventory.copy(self)
+
+    def __iter__(self):
+        self._load_all()
+        return inventory.Inventory.__iter__(self)
+
+    def __len__(self):
+        self._load_all()
+        return inventory.Inventory.__len__(self)
+
+    def __eq__(self, other):
+        self._load_all()
+        if isinstance(other, GitInventory):
+            other._load_all()
+        return inventory.Inventory.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+class GitRevisionTree(revisiontree.RevisionTree):
+
+    def __init__(self, repository, mapping, revision_id):
+        self._repository = repository
+        self.revision_id = revision_id
+        assert isinstance(revision_id, str)
+        self.mapping = mapping
+        git_id = repository.lookup_git_revid(revision_id, self.mapping)
+        try:
+            commit = repository._git.commit(git_id)
+        except KeyError, r:
+            raise errors.NoSuchRevision(repository, revision_id)
+        self.tree = commit.tree
+        self._inv = None
+
+    def _get_inventory(self):
+        """Return the inventory of this tree, creating it on first use.
+
+        Its directories are only read from git when they are needed.
+        """
+        if self._inv is None:
+            self._inv = GitInventory(self._repository, self.mapping, 
+                                     self.tree, self.revision_id)
+        return self._inv
+
+    inventory = property(_get_inventory)
+    _inventory = property(_get_inventory)
+
+    def get_revision_id(self):
+        return self.revision_id
+
+    def _lookup_file(self, file_id):
+        """Find the git object of a file.
+
+        Unless the inventory entry of the file has been loaded already, 
+        this only reads the trees on the path to the file.
+
+        :return: Tuple with the mode and the sha of the git object
+        """
+        if self._inv is not None and self._inv.is_loaded(file_id):
+            entry = self._inv[file_id]
+            if entry.kind == 'directory':
+                return (stat.S_IFDIR, None)
+            return (stat.S_IFREG, entry.text_id)
+        path = self.mapping.parse_file_id(file_id).encode("utf-8")
+        mode, hexsha = stat.S_IFDIR, self.tree
+        for name in filter(None, path.split("/")):
+            if not stat.S_ISDIR(mode):
+                raise errors.NoSuchId(self, file_id)
+            for child_mode, child_name, child_sha in \
+                    self._repository._git.tree(hexsha).entries():
+                if child_name == name:
+                    mode, hexsha = child_mode, child_sha
+                    break
+            else:
+                raise errors.NoSuchId(self, file_id)
+        return mode, hexsha
+
+    def get_file_text(self, file_id):
+        mode, hexsha = self._lookup_file(file_id)
+        if stat.S_ISDIR(mode): return ""
+        return self._repository._git.get_blob(hexsha).data
+
+    def iter_files_bytes(self, desired_files):
+        """See Tree.iter_files_bytes.
+
+        Blob contents are inflated incrementally, rather than loaded into 
+        memory as a whole.
+        """
+        for file_id, identifier in desired_files:
+            mode, hexsha = self._lookup_file(file_id)
+            if stat.S_ISDIR(mode):
+                yield identifier, []
+            else:
+                blob = self._repository._git.get_lazy_blob(hexsha)
+                yield identifier, blob.iter_chunks()
 
 
 class GitFormat(object):
@@ -19,12 +19,16 @@ from bzrlib.repository import Repository
 from bzrlib.inventory import InventoryDirectory, InventoryFile
 from bzrlib.osutils import splitpath
 
-from bzrlib.plugins.git.fetch import import_git_objects
+from bzrlib.plugins.git.fetch import (
+    get_git_sha_map,
+    import_git_objects,
+    make_ext_ref_resolver,
+    )
 from bzrlib.plugins.git.mapping import default_mapping
 
 from dulwich.server import Backend
-from dulwich.pack import Pack, PackData, write_pack_index_v2
-from dulwich.objects import ShaFile, Commit, Tree, Blob
+from dulwich.pack import Pack, PackReceiver, write_pack_index_v2
+from dulwich.objects import CHUNK_SIZE, ShaFile, Commit, Tree, Blob
 
 import os, tempfile
 
@@ -53,29 +57,35 @@ class BzrBackend(Backend):
     def apply_pack(self, refs, read):
         """ apply pack from client to current repository """
 
-        fd, path = tempfile.mkstemp(suffix=".pack")
-        f = os.fdopen(fd, 'w')
-        f.write(read())
-        f.close()
-
-        p = PackData(path)
-        entries = p.sorted_entries()
-        write_pack_index_v2(path[:-5]+".idx", entries, p.calculate_checksum())
-
-        def get_objects():
-            pack = Pack(path[:-5])
-            for obj in pack.iterobjects():
-                yield obj
-
         target = Repository.open(self.directory)
 
         target.lock_write()
         try:
-            target.start_write_group()
+            sha_map = get_git_sha_map(target)
             try:
-                import_git_objects(target, self.mapping, iter(get_objects()))
+                # The client sends a thin pack, with deltas against objects 
+                # it was told the repository has
+                fd, path = tempfile.mkstemp(suffix=".pack")
+                f = PackReceiver(os.fdopen(fd, 'w+b'), 
+                    make_ext_ref_resolver(target, self.mapping, sha_map), 
+                    fix_thin=True)
+                data = read(CHUNK_SIZE)
+                while data:
+                    f.write(data)
+                    data = read(CHUNK_SIZE)
+                (entries, pack_checksum) = f.close()
+                entries.sort()
+                write_pack_index_v2(path[:-5]+".idx", entries, pack_checksum)
+
+                target.start_write_group()
+                try:
+                    import_git_objects(target, self.mapping, 
+                        [sha for (oldsha, sha, ref) in refs if sha != "0" * 40],
+                        Pack(path[:-5]).__getitem__, sha_map=sha_map)
+                finally:
+                    target.commit_write_group()
             finally:
-                target.commit_write_group()
+                sha_map.close()
         finally:
             target.unlock()
 
@@ -0,0 +1,236 @@
+# Copyright (C) 2008 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Maps between git object shas and bzr data.
+
+Git names blobs by the SHA1 of their header and contents, while bzr
+inventories need the SHA1 of the contents alone. Computing it means
+inflating the blob, so the results are kept in a database.
+
+When git objects are imported into a bzr repository, the bzr objects they
+became are kept in a database too, so they can be found again without
+converting the bzr objects back.
+"""
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+
+class BlobShaMap(object):
+    """Persistent map from git blob shas to (text_sha1, text_size)."""
+
+    def __init__(self, path=None):
+        """Open a blob sha map.
+
+        :param path: Path of the database, created if it doesn't exist.
+            The map is kept in memory if this is None.
+        """
+        if path is None:
+            path = ":memory:"
+        self.db = sqlite3.connect(path)
+        self.db.execute("""create table if not exists blobs (
+            sha text primary key,
+            text_sha1 text not null,
+            text_size integer not null)""")
+
+    def lookup(self, sha):
+        """Look up the SHA1 and size of the contents of a blob.
+
+        :param sha: Hex sha of the git blob
+        :return: Tuple with the SHA1 and size, or None if the blob is not
+            in the map
+        """
+        row = self.db.execute(
+            "select text_sha1, text_size from blobs where sha = ?",
+            (sha,)).fetchone()
+        if row is None:
+            return None
+        return (str(row[0]), row[1])
+
+    def add_entries(self, entries):
+        """Add blobs to the map.
+
+        :param entries: Iterable over (sha, text_sha1, text_size) tuples
+        """
+        self.db.executemany(
+            "insert or replace into blobs (sha, text_sha1, text_size) "
+            "values (?, ?, ?)", entries)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class GitShaMap(object):
+    """Persistent map between git object shas and imported bzr objects.
+
+    Commits map to the revision they were imported as. Trees map to the 
+    file id of a directory and a revision whose inventory has that 
+    directory with those contents. Blobs map to the (file_id, revision) 
+    key of the text they were imported as.
+
+    The refs of the repositories that were fetched from are kept as well.
+    """
+
+    def __init__(self, path=None):
+        """Open a git sha map.
+
+        :param path: Path of the database, created if it doesn't exist.
+            The map is kept in memory if this is None.
+        """
+        if path is None:
+            path = ":memory:"
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            create table if not exists commits (
+                sha text primary key,
+                revid text not null,
+                tree_sha text not null);
+            create index if not exists commits_revid on commits(revid);
+            create table if not exists trees (
+                sha text primary key,
+                fileid text not null,
+                revid text not null);
+            create index if not exists trees_fileid_revid 
+                on trees(fileid, revid);
+            create table if not exists blobs (
+                sha text primary key,
+                fileid text not null,
+                revid text not null);
+            create index if not exists blobs_fileid_revid 
+                on blobs(fileid, revid);
+            create table if not exists fetched_refs (
+                location text not null,
+                name text not null,
+                sha text not null,
+                primary key (location, name));
+            """)
+
+    def add_entries(self, revid, commit_sha, tree_sha, entries):
+        """Add the objects imported in a revision to the map.
+
+        :param revid: Revision id the commit was imported as
+        :param commit_sha: Hex sha of the commit
+        :param tree_sha: Hex sha of the tree of the commit
+        :param entries: Iterable over (sha, kind, file_id, revid) tuples 
+            for the trees and blobs imported in the revision, including 
+            the root tree, with kind "tree" or "blob". Objects that are 
+            already in the map keep their existing entry.
+        """
+        self.db.execute(
+            "insert or replace into commits (sha, revid, tree_sha) "
+            "values (?, ?, ?)", (commit_sha, revid, tree_sha))
+        trees = []
+        blobs = []
+        for (sha, kind, file_id, entry_revid) in entries:
+            if kind == "tree":
+                trees.append((sha, file_id, entry_revid))
+            elif kind == "blob":
+                blobs.append((sha, file_id, entry_revid))
+            else:
+                raise AssertionError("Unknown object kind %r" % (kind,))
+        self.db.executemany("insert or ignore into trees (sha, fileid, revid) "
+                            "values (?, ?, ?)", trees)
+        self.db.executemany("insert or ignore into blobs (sha, fileid, revid) "
+                            "values (?, ?, ?)", blobs)
+        self.db.commit()
+
+    def lookup_git_sha(self, sha):
+        """Look up the bzr object a git object was imported as.
+
+        :param sha: Hex sha of the git object
+        :return: Tuple with the kind of object and its data, which is 
+            (revid, tree_sha) for a "commit" and (file_id, revid) for a 
+            "tree" or "blob"
+        :raise KeyError: If the object is not in the map
+        """
+        row = self.db.execute(
+            "select revid, tree_sha from commits where sha = ?", 
+            (sha,)).fetchone()
+        if row is not None:
+            return ("commit", (str(row[0]), str(row[1])))
+        for kind in ("tree", "blob"):
+            row = self.db.execute(
+                "select fileid, revid from %ss where sha = ?" % kind, 
+                (sha,)).fetchone()
+            if row is not None:
+                return (kind, (str(row[0]), str(row[1])))
+        raise KeyError(sha)
+
+    def _lookup_sha(self, table, file_id, revid):
+        row = self.db.execute(
+            "select sha from %s where fileid = ? and revid = ?" % table, 
+            (file_id, revid)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def lookup_tree(self, file_id, revid):
+        """Look up the git tree of a directory in the inventory of a revision.
+
+        :return: Hex sha of the tree, or None if it is not in the map
+        """
+        return self._lookup_sha("trees", file_id, revid)
+
+    def lookup_blob(self, file_id, revid):
+        """Look up the git blob a text was imported from.
+
+        :param revid: Revision of the text, as in the inventory entry
+        :return: Hex sha of the blob, or None if it is not in the map
+        """
+        return self._lookup_sha("blobs", file_id, revid)
+
+    def lookup_commit(self, revid):
+        """Look up the git commit a revision was imported from.
+
+        :return: Hex sha of the commit, or None if it is not in the map
+        """
+        row = self.db.execute("select sha from commits where revid = ?", 
+                              (revid,)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def get_fetched_refs(self, location):
+        """Return the refs of a repository at the last fetch from it.
+
+        :param location: URL of the repository
+        :return: Dictionary mapping ref names to hex shas
+        """
+        ret = {}
+        for (name, sha) in self.db.execute(
+                "select name, sha from fetched_refs where location = ?", 
+                (location,)):
+            ret[str(name)] = str(sha)
+        return ret
+
+    def set_fetched_refs(self, location, refs):
+        """Record the refs of a repository that was fetched from.
+
+        :param location: URL of the repository
+        :param refs: Dictionary mapping ref names to hex shas
+        """
+        self.db.execute("delete from fetched_refs where location = ?", 
+                        (location,))
+        self.db.executemany(
+            "insert into fetched_refs (location, name, sha) values (?, ?, ?)",
+            [(location, name, sha) for (name, sha) in refs.iteritems()])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -230,8 +230,10 @@ def test_suite():
         'test_builder',
         'test_branch',
         'test_dir',
+        'test_fetch',
         'test_repository',
         'test_ids',
+        'test_shamap',
         'test_blackbox',
         ]
     testmod_names = ['%s.%s' % (__name__, t) for t in testmod_names]
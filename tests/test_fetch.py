@@ -0,0 +1,351 @@
+# Copyright (C) 2008 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Tests for importing git objects into bzr repositories."""
+
+import os
+
+from bzrlib.repository import Repository
+from bzrlib.tests import SymlinkFeature
+
+from bzrlib.plugins.git import tests
+from bzrlib.plugins.git.fetch import (
+    ImportCheckpoint,
+    InterGitNonGitRepository,
+    InventoryCache,
+    get_git_sha_map,
+    import_git_objects,
+    make_ext_ref_resolver,
+    reconstruct_git_object,
+    reconstruct_git_tree,
+    )
+from bzrlib.plugins.git.mapping import default_mapping
+from bzrlib.plugins.git.shamap import GitShaMap
+
+from dulwich.objects import Blob, hex_to_sha
+from dulwich.pack import Pack, write_pack
+from dulwich.repo import Repo
+
+
+class Interrupted(Exception):
+    """Raised to interrupt an import."""
+
+
+class TestImportGitObjects(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        super(TestImportGitObjects, self).setUp()
+        self.requireFeature(tests.GitCommandFeature)
+        os.mkdir("git")
+        os.chdir("git")
+        try:
+            tests.run_git("init")
+            builder = tests.GitBranchBuilder()
+            builder.set_file("a", "text for a\n", False)
+            builder.set_file("dir/b", "text for b\n", False)
+            mark = builder.commit("Joe Foo <joe@foo.com>", u"first")
+            self.old_head = builder.finish()[mark]
+            # Extend the history in a second fast-import, which continues
+            # from the current head of the branch
+            builder = tests.GitBranchBuilder()
+            builder.set_file("a", "new text for a\n", False)
+            builder.commit("Joe Foo <joe@foo.com>", u"second")
+            builder.set_file("dir/c", "text for c\n", False)
+            mark = builder.commit("Joe Foo <joe@foo.com>", u"third")
+            self.new_head = builder.finish()[mark]
+            self.new_shas = [line.split()[0] for line in tests.run_git(
+                "rev-list", "--objects", self.new_head,
+                "^" + self.old_head).splitlines()]
+        finally:
+            os.chdir("..")
+        self.git = Repo("git")
+
+    def import_objects(self, repo, head, get_object, source=None,
+                       workers=1):
+        repo.lock_write()
+        try:
+            repo.start_write_group()
+            try:
+                import_git_objects(repo, default_mapping, [head], get_object,
+                                   source=source, workers=workers)
+            finally:
+                repo.commit_write_group()
+        finally:
+            repo.unlock()
+
+    def fetch_incrementally(self, path, workers):
+        """Import the old history, then the rest from a pack.
+
+        The pack only has the objects that are new in the rest of the
+        history, like a pack fetched from a remote repository.
+        """
+        repo = self.make_repository(path, format="rich-root-pack")
+        self.import_objects(repo, self.old_head, self.git.get_object)
+        basename = os.path.abspath(path + "-pack")
+        write_pack(basename, [self.git.get_object(sha)
+                              for sha in self.new_shas], len(self.new_shas))
+        pack = Pack(basename)
+        try:
+            self.import_objects(repo, self.new_head, pack.__getitem__,
+                                ("pack", basename), workers)
+        finally:
+            pack.close()
+        return repo
+
+    def get_entries(self, repo, sha):
+        inv = repo.get_inventory(
+            default_mapping.revision_id_foreign_to_bzr(sha))
+        return [(path, ie.file_id, ie.revision, ie.text_sha1)
+                for (path, ie) in inv.iter_entries()]
+
+    def test_workers_incremental(self):
+        serial = self.fetch_incrementally("serial", 1)
+        pooled = self.fetch_incrementally("pooled", 2)
+        old_revid = default_mapping.revision_id_foreign_to_bzr(self.old_head)
+        # The unchanged file keeps the revision it was imported in
+        self.assertTrue(("dir/b", old_revid) in [(path, revision)
+            for (path, file_id, revision, text_sha1)
+            in self.get_entries(serial, self.new_head)])
+        for sha in [self.new_head, self.git.commit(self.new_head).parents[0]]:
+            self.assertEqual(self.get_entries(serial, sha),
+                             self.get_entries(pooled, sha))
+
+
+    def import_interrupted(self, repo):
+        """Import the history, failing on the last revision.
+
+        The checkpoints are taken after every revision, so only the last 
+        revision is missing afterwards.
+        """
+        head_tree = self.git.commit(self.new_head).tree
+        def get_object(sha):
+            if sha == head_tree:
+                raise Interrupted()
+            return self.git.get_object(sha)
+        repo.lock_write()
+        try:
+            repo.start_write_group()
+            checkpoint = ImportCheckpoint(repo, interval=1)
+            try:
+                import_git_objects(repo, default_mapping, [self.new_head], 
+                                   get_object, checkpoint=checkpoint)
+            except Interrupted:
+                repo.abort_write_group()
+            else:
+                self.fail("The import was not interrupted")
+        finally:
+            repo.unlock()
+
+    def test_checkpoint_interrupted(self):
+        repo = self.make_repository("bzr", format="rich-root-pack")
+        self.import_interrupted(repo)
+        revids = [default_mapping.revision_id_foreign_to_bzr(sha) for sha in 
+                  [self.old_head, self.git.commit(self.new_head).parents[0],
+                   self.new_head]]
+        repo.lock_read()
+        try:
+            self.assertEqual([True, True, False], 
+                             [repo.has_revision(revid) for revid in revids])
+        finally:
+            repo.unlock()
+        checkpoint = ImportCheckpoint(repo)
+        self.assertEqual((2, 3), checkpoint.read_marker())
+        # Resume the import
+        repo.lock_write()
+        try:
+            checkpoint.report_resume()
+            repo.start_write_group()
+            try:
+                import_git_objects(repo, default_mapping, [self.new_head], 
+                                   self.git.get_object, checkpoint=checkpoint)
+            finally:
+                repo.commit_write_group()
+            checkpoint.finish()
+            self.assertTrue(repo.has_revision(revids[2]))
+        finally:
+            repo.unlock()
+        self.assertEqual(None, checkpoint.read_marker())
+
+    def test_graph_walker_resume(self):
+        repo = self.make_repository("bzr", format="rich-root-pack")
+        self.import_interrupted(repo)
+        source = Repository.open("git")
+        inter = InterGitNonGitRepository(source, repo)
+        checkpoint = ImportCheckpoint(repo)
+        sha_map = get_git_sha_map(repo)
+        repo.lock_read()
+        try:
+            sha_map.set_fetched_refs(source.base, 
+                                     {"refs/heads/master": self.old_head})
+            # The revisions committed at the checkpoints are offered first
+            self.assertEqual(self.git.commit(self.new_head).parents[0], 
+                inter._get_graph_walker(default_mapping, sha_map, 
+                                        checkpoint).next())
+            checkpoint.finish()
+            self.assertEqual(self.old_head, inter._get_graph_walker(
+                default_mapping, sha_map, checkpoint).next())
+        finally:
+            repo.unlock()
+            sha_map.close()
+
+
+class TestImportMerges(tests.TestCaseWithTransport):
+
+    def test_unchanged_from_first_parent(self):
+        self.requireFeature(tests.GitCommandFeature)
+        os.mkdir("git")
+        os.chdir("git")
+        try:
+            tests.run_git("init")
+            builder = tests.GitBranchBuilder()
+            builder.set_file("a", "text for a\n", False)
+            builder.set_file("b", "text for b\n", False)
+            base = builder.commit("Joe Foo <joe@foo.com>", u"base")
+            builder.set_file("a", "new text for a\n", False)
+            left = builder.commit("Joe Foo <joe@foo.com>", u"left")
+            builder.set_file("b", "new text for b\n", False)
+            right = builder.commit("Joe Foo <joe@foo.com>", u"right", 
+                                   base=base)
+            # Keep the text of b from the first parent
+            builder.set_file("b", "text for b\n", False)
+            merge = builder.commit("Joe Foo <joe@foo.com>", u"merge", 
+                                   base=left, merge=[right])
+            marks = builder.finish()
+        finally:
+            os.chdir("..")
+        git = Repo("git")
+        repo = self.make_repository("bzr", format="rich-root-pack")
+        repo.lock_write()
+        try:
+            repo.start_write_group()
+            try:
+                import_git_objects(repo, default_mapping, [marks[merge]],
+                                   git.get_object)
+            finally:
+                repo.commit_write_group()
+        finally:
+            repo.unlock()
+        revids = dict((mark, default_mapping.revision_id_foreign_to_bzr(
+            marks[mark])) for mark in (base, left, right, merge))
+        repo.lock_read()
+        try:
+            inv = repo.get_inventory(revids[merge])
+            # The version of a from the first parent supersedes the other one
+            self.assertEqual(revids[left], inv["a"].revision)
+            # b has different versions in both parents, so it needs a new one
+            self.assertEqual(revids[merge], inv["b"].revision)
+            self.assertEqual({("b", revids[merge]): (("b", revids[base]), 
+                                                     ("b", revids[right]))},
+                repo.texts.get_parent_map([("b", revids[merge])]))
+            self.assertEqual("text for b\n", repo.revision_tree(
+                revids[merge]).get_file_text("b"))
+        finally:
+            repo.unlock()
+
+
+class TestReconstructGitObject(tests.TestCaseWithTransport):
+
+    def import_history(self, builder_calls):
+        os.mkdir("git")
+        os.chdir("git")
+        try:
+            tests.run_git("init")
+            builder = tests.GitBranchBuilder()
+            builder_calls(builder)
+            mark = builder.commit("Joe Foo <joe@foo.com>", u"first")
+            head = builder.finish()[mark]
+        finally:
+            os.chdir("..")
+        git = Repo("git")
+        repo = self.make_repository("bzr", format="rich-root-pack")
+        repo.lock_write()
+        try:
+            repo.start_write_group()
+            try:
+                import_git_objects(repo, default_mapping, [head],
+                                   git.get_object)
+            finally:
+                repo.commit_write_group()
+        finally:
+            repo.unlock()
+        return git, repo, head
+
+    def test_tree(self):
+        self.requireFeature(tests.GitCommandFeature)
+        def build(builder):
+            builder.set_file("a", "text for a\n", False)
+            builder.set_file("dir/b", "text for b\n", True)
+        git, repo, head = self.import_history(build)
+        tree_sha = git.commit(head).tree
+        repo.lock_read()
+        try:
+            self.assertEqual(git.get_object(tree_sha).as_raw_string(),
+                reconstruct_git_object(repo, default_mapping,
+                                       tree_sha).as_raw_string())
+        finally:
+            repo.unlock()
+
+    def test_mismatch(self):
+        # Symlinks are imported as files, so the tree can't be rebuilt
+        self.requireFeature(tests.GitCommandFeature)
+        def build(builder):
+            builder.set_file("a", "text for a\n", False)
+            builder.set_link("link", "a")
+        git, repo, head = self.import_history(build)
+        repo.lock_read()
+        try:
+            self.assertRaises(KeyError, reconstruct_git_object, repo,
+                default_mapping, git.commit(head).tree)
+        finally:
+            repo.unlock()
+
+    def test_ext_ref_resolver(self):
+        self.requireFeature(tests.GitCommandFeature)
+        def build(builder):
+            builder.set_file("a", "text for a\n", False)
+        git, repo, head = self.import_history(build)
+        tree_sha = git.commit(head).tree
+        repo.lock_read()
+        try:
+            sha_map = get_git_sha_map(repo)
+            try:
+                resolve_ext_ref = make_ext_ref_resolver(repo, default_mapping,
+                                                        sha_map)
+                [(mode, name, blob_sha)] = git.tree(tree_sha).entries()
+                for sha in [tree_sha, blob_sha]:
+                    self.assertEqual(git.get_object(sha).as_raw_string(),
+                                     resolve_ext_ref(hex_to_sha(sha)))
+                self.assertRaises(KeyError, resolve_ext_ref, "\xff" * 20)
+            finally:
+                sha_map.close()
+        finally:
+            repo.unlock()
+
+    def test_symlink(self):
+        self.requireFeature(SymlinkFeature)
+        tree = self.make_branch_and_tree("bzr", format="rich-root-pack")
+        os.symlink("target", "bzr/link")
+        tree.add(["link"])
+        revid = tree.commit("symlink")
+        repo = tree.branch.repository
+        repo.lock_read()
+        try:
+            git_tree = reconstruct_git_tree(repo, default_mapping,
+                InventoryCache(repo), GitShaMap(), tree.path2id(""), revid)
+        finally:
+            repo.unlock()
+        self.assertEqual([(0120000, "link", Blob.from_string("target").id)],
+                         git_tree.entries())
@@ -93,6 +93,49 @@ class TestGitRepositoryFeatures(tests.TestCaseInTempDir):
         self.assertEquals(tree.get_revision_id(), revid)
         self.assertEquals("text\n", tree.get_file_text(tree.path2id("data")))
 
+    def test_revision_tree_get_file_text_lazy(self):
+        commit_id = self.simple_commit()
+        revid = default_mapping.revision_id_foreign_to_bzr(commit_id)
+        repo = Repository.open('.')
+        tree = repo.revision_tree(revid)
+        self.assertEquals("subdir text\n", 
+                          tree.get_file_text("subdir/subfile"))
+        self.assertEquals("", tree.get_file_text("subdir"))
+        self.assertRaises(errors.NoSuchId, tree.get_file_text, "missing")
+        self.assertIs(None, tree._inv)
+
+    def test_revision_tree_inventory_lazy(self):
+        commit_id = self.simple_commit()
+        revid = default_mapping.revision_id_foreign_to_bzr(commit_id)
+        repo = Repository.open('.')
+        inv = repo.revision_tree(revid).inventory
+        self.assertEquals([u"data", u"executable", u"link", u"subdir"],
+                          sorted(inv.root.children))
+        self.assertFalse(inv.is_loaded("subdir/subfile"))
+        self.assertEquals("subdir/subfile", inv.id2path("subdir/subfile"))
+        self.assertEquals("subdir", inv["subdir/subfile"].parent_id)
+        self.assertFalse(inv.has_id("subdir/missing"))
+
+    def test_revision_tree_inventory_copy(self):
+        commit_id = self.simple_commit()
+        revid = default_mapping.revision_id_foreign_to_bzr(commit_id)
+        repo = Repository.open('.')
+        inv = repo.revision_tree(revid).inventory
+        copy = inv.copy()
+        self.assertFalse(isinstance(copy, repository.GitInventory))
+        self.assertTrue(copy.has_id("subdir/subfile"))
+        self.assertEquals(6, len(copy))
+
+    def test_revision_tree_iter_files_bytes(self):
+        commit_id = self.simple_commit()
+        revid = default_mapping.revision_id_foreign_to_bzr(commit_id)
+        repo = Repository.open('.')
+        tree = repo.revision_tree(revid)
+        files = dict((identifier, "".join(chunks)) for identifier, chunks in
+            tree.iter_files_bytes([(tree.path2id("data"), "data"),
+                                   (tree.path2id("subdir"), "subdir")]))
+        self.assertEquals({"data": "text\n", "subdir": ""}, files)
+
     def test_get_inventory(self):
         # GitRepository.get_inventory gives a GitInventory object with
         # plausible entries for typical cases.
@@ -171,6 +214,15 @@ class TestGitRepository(tests.TestCaseWithTransport):
         self.assertEquals({revision.NULL_REVISION: ()}, 
                            self.git_repo.get_parent_map([revision.NULL_REVISION]))
 
+    def test_get_parent_map_missing(self):
+        revid = default_mapping.revision_id_foreign_to_bzr("a" * 40)
+        self.git_repo.lock_read()
+        try:
+            self.assertEquals({}, self.git_repo.get_parent_map([revid]))
+            self.assertEquals({}, self.git_repo.get_parent_map([revid]))
+        finally:
+            self.git_repo.unlock()
+
 
 class GitRepositoryFormat(tests.TestCase):
 
@@ -0,0 +1,92 @@
+# Copyright (C) 2008 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Tests for the maps between git object shas and bzr data."""
+
+from bzrlib.plugins.git import tests
+from bzrlib.plugins.git.shamap import BlobShaMap, GitShaMap
+
+
+class TestBlobShaMap(tests.TestCaseInTempDir):
+
+    def test_lookup_missing(self):
+        self.assertEquals(None, BlobShaMap().lookup("a" * 40))
+
+    def test_add_entries(self):
+        blob_map = BlobShaMap()
+        blob_map.add_entries([("a" * 40, "b" * 40, 5), ("c" * 40, "d" * 40, 0)])
+        self.assertEquals(("b" * 40, 5), blob_map.lookup("a" * 40))
+        self.assertEquals(("d" * 40, 0), blob_map.lookup("c" * 40))
+
+    def test_persistent(self):
+        blob_map = BlobShaMap("blobs.db")
+        blob_map.add_entries([("a" * 40, "b" * 40, 5)])
+        blob_map.close()
+        self.assertEquals(("b" * 40, 5), 
+                          BlobShaMap("blobs.db").lookup("a" * 40))
+
+
+class TestGitShaMap(tests.TestCaseInTempDir):
+
+    def test_lookup_missing(self):
+        sha_map = GitShaMap()
+        self.assertRaises(KeyError, sha_map.lookup_git_sha, "a" * 40)
+        self.assertEquals(None, sha_map.lookup_commit("revid"))
+        self.assertEquals(None, sha_map.lookup_tree("TREE_ROOT", "revid"))
+        self.assertEquals(None, sha_map.lookup_blob("fileid", "revid"))
+
+    def test_add_entries(self):
+        sha_map = GitShaMap()
+        sha_map.add_entries("revid", "a" * 40, "b" * 40, 
+            [("b" * 40, "tree", "TREE_ROOT", "revid"), 
+             ("c" * 40, "blob", "fileid", "revid")])
+        self.assertEquals(("commit", ("revid", "b" * 40)), 
+                          sha_map.lookup_git_sha("a" * 40))
+        self.assertEquals(("tree", ("TREE_ROOT", "revid")), 
+                          sha_map.lookup_git_sha("b" * 40))
+        self.assertEquals(("blob", ("fileid", "revid")), 
+                          sha_map.lookup_git_sha("c" * 40))
+        self.assertEquals("a" * 40, sha_map.lookup_commit("revid"))
+        self.assertEquals("b" * 40, sha_map.lookup_tree("TREE_ROOT", "revid"))
+        self.assertEquals("c" * 40, sha_map.lookup_blob("fileid", "revid"))
+
+    def test_keeps_first_entry(self):
+        sha_map = GitShaMap()
+        sha_map.add_entries("rev1", "a" * 40, "b" * 40, 
+            [("b" * 40, "tree", "TREE_ROOT", "rev1")])
+        sha_map.add_entries("rev2", "c" * 40, "b" * 40, 
+            [("b" * 40, "tree", "TREE_ROOT", "rev2")])
+        self.assertEquals(("tree", ("TREE_ROOT", "rev1")), 
+                          sha_map.lookup_git_sha("b" * 40))
+
+    def test_persistent(self):
+        sha_map = GitShaMap("git.db")
+        sha_map.add_entries("revid", "a" * 40, "b" * 40, [])
+        sha_map.close()
+        self.assertEquals(("commit", ("revid", "b" * 40)), 
+                          GitShaMap("git.db").lookup_git_sha("a" * 40))
+
+    def test_fetched_refs(self):
+        sha_map = GitShaMap()
+        self.assertEquals({}, sha_map.get_fetched_refs("http://a/"))
+        sha_map.set_fetched_refs("http://a/", 
+            {"refs/heads/master": "a" * 40, "refs/heads/next": "b" * 40})
+        sha_map.set_fetched_refs("http://b/", {"HEAD": "c" * 40})
+        sha_map.set_fetched_refs("http://a/", {"refs/heads/master": "d" * 40})
+        self.assertEquals({"refs/heads/master": "d" * 40}, 
+                          sha_map.get_fetched_refs("http://a/"))
+        self.assertEquals({"HEAD": "c" * 40}, 
+                          sha_map.get_fetched_refs("http://b/"))